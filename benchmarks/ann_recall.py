@@ -0,0 +1,179 @@
+"""
+按作用域过滤的向量检索：recall@k 与延迟。
+
+在一个空的测试库里生成合成图库（见 synthetic.py），对每个查询先做精确检索作为标准答案，
+再用不同的检索方式、ef_search 与迭代扫描模式检索，统计：
+
+- recall@k：近似结果中属于精确 top-k 的比例；
+- fill：返回条数 / k，过滤后结果不足时小于 1；
+- p50 / p99 延迟（毫秒）。
+
+查询按作用域大小分为 small / medium / large 三组，小群最容易因为过滤而丢结果。
+
+    python benchmarks/ann_recall.py postgresql://localhost/savepic_bench \\
+        --rows 100k --queries 200 -k 5 --ef 20,40,100,200 --partial 4 --json ann.json
+
+测试库必须是空库或只有本脚本生成的数据，picdata 中有真实数据时拒绝运行。
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from synthetic import (  # noqa: E402
+    add_library_arguments,
+    ensure_loaded,
+    init_plugin,
+    library_from,
+)
+
+
+MODES = ["off", "relaxed_order", "strict_order"]
+
+
+def scope_buckets(counts: dict[str, int]) -> dict[str, list[str]]:
+    """按图片数排序，前 5% 为 large，后 50% 为 small，其余为 medium"""
+    ranked = sorted((s for s in counts if s != "globe"), key=counts.get, reverse=True)
+    large = max(1, len(ranked) // 20)
+    small = len(ranked) // 2
+    return {
+        "large": ranked[:large],
+        "medium": ranked[large : len(ranked) - small] or ranked[:large],
+        "small": ranked[len(ranked) - small :] or ranked[-1:],
+    }
+
+
+async def timed(conn, query: str, *args) -> tuple[list, float]:
+    start = time.perf_counter()
+    rows = await conn.fetch(query, *args)
+    return rows, (time.perf_counter() - start) * 1000
+
+
+async def run(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.cache import SCOPE_COUNTER
+    from nonebot_plugin_savepic.core.vecsearch import VEC_SEARCH
+
+    library = library_from(args)
+    await sql.init_db(listen=False)
+    try:
+        assert sql.POOL
+        async with sql.POOL.acquire() as conn:
+            await ensure_loaded(conn, library, sql.VEC_INDEX_SQL, args.regenerate)
+            await SCOPE_COUNTER.reload(conn)
+        if args.partial:
+            await VEC_SEARCH.build_indexes(sql.POOL, args.partial, 1)
+
+        rng = np.random.default_rng(args.seed + 1)
+        buckets = scope_buckets(SCOPE_COUNTER.totals)
+        queries = library.queries(args.queries)
+        cases = [
+            (bucket, str(rng.choice(scopes)), queries[i])
+            for i in range(args.queries)
+            for bucket, scopes in buckets.items()
+        ]
+
+        configs: list[tuple[str, int, str]] = [("exact", 0, "")]
+        modes = MODES if VEC_SEARCH.version >= (0, 8) else [""]
+        for ef in args.ef:
+            for mode in modes:
+                configs.append(("hnsw", ef, mode))
+                configs.append(("auto", ef, mode))
+            if VEC_SEARCH.indexes:
+                configs.append(("partial", ef, modes[0]))
+
+        results = []
+        async with sql.POOL.acquire() as conn:
+            truth = []
+            for _, scope, vec in cases:
+                query, _ = VEC_SEARCH.sql(scope, args.k, "url", plan="exact")
+                rows = await conn.fetch(query, vec, scope)
+                truth.append({r["url"] for r in rows})
+
+            for plan, ef, mode in configs:
+                if ef:
+                    await conn.execute(f"SET hnsw.ef_search = {ef};")
+                if mode:
+                    await conn.execute(f"SET hnsw.iterative_scan = {mode};")
+                stats: dict[str, dict[str, list[float]]] = {}
+                for (bucket, scope, vec), expect in zip(cases, truth):
+                    if plan == "partial" and scope not in VEC_SEARCH.indexes:
+                        continue
+                    query, with_scope = VEC_SEARCH.sql(
+                        scope, args.k, "url", plan=None if plan == "auto" else plan
+                    )
+                    params = (vec, scope) if with_scope else (vec,)
+                    # 第一次执行包含 prepare，不计入延迟
+                    await conn.fetch(query, *params)
+                    rows, ms = await timed(conn, query, *params)
+                    got = {r["url"] for r in rows}
+                    s = stats.setdefault(bucket, {"recall": [], "fill": [], "ms": []})
+                    s["recall"].append(len(got & expect) / len(expect) if expect else 1)
+                    s["fill"].append(len(rows) / args.k)
+                    s["ms"].append(ms)
+                for bucket, s in stats.items():
+                    results.append(
+                        {
+                            "bucket": bucket,
+                            "plan": plan,
+                            "ef_search": ef or None,
+                            "iterative_scan": mode or None,
+                            "queries": len(s["ms"]),
+                            f"recall@{args.k}": float(np.mean(s["recall"])),
+                            "fill": float(np.mean(s["fill"])),
+                            "p50_ms": float(np.percentile(s["ms"], 50)),
+                            "p99_ms": float(np.percentile(s["ms"], 99)),
+                        }
+                    )
+                await conn.execute("RESET ALL;")
+    finally:
+        await sql.close_db()
+
+    print(
+        f"{'bucket':<8}{'plan':<9}{'ef':>5}  {'iterative':<14}"
+        f"{'recall':>8}{'fill':>7}{'p50 ms':>9}{'p99 ms':>9}"
+    )
+    for r in sorted(results, key=lambda r: (r["bucket"], r["plan"])):
+        print(
+            f"{r['bucket']:<8}{r['plan']:<9}{r['ef_search'] or '-':>5}  "
+            f"{r['iterative_scan'] or '-':<14}{r[f'recall@{args.k}']:>8.3f}"
+            f"{r['fill']:>7.2f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+        )
+    if args.json:
+        meta = {
+            "library": library.signature(),
+            "k": args.k,
+            "pgvector": ".".join(map(str, VEC_SEARCH.version)),
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量检索的召回率与延迟")
+    add_library_arguments(parser)
+    parser.add_argument("--queries", type=int, default=100, help="每组的查询数")
+    parser.add_argument("-k", type=int, default=5, help="recall@k 的 k")
+    parser.add_argument(
+        "--ef",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[20, 40, 100, 200],
+        help="要比较的 ef_search，逗号分隔",
+    )
+    parser.add_argument("--partial", type=int, default=0, help="为最大的几个群建部分索引")
+    parser.add_argument("--json", help="结果另存为 JSON")
+    args = parser.parse_args()
+
+    init_plugin(args.dsn)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
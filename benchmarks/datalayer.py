@@ -0,0 +1,301 @@
+"""
+core/sql.py 数据层的基准测试。
+
+在测试库中生成合成图库（见 synthetic.py），以不同的并发数调用
+select_pic / randpic / regexp_pic / countpic / listpic / simpic / savepic，
+统计每个函数的 p50 / p99 延迟与吞吐量，结果可存为 JSON，并与之前的结果对比：
+
+    python benchmarks/datalayer.py postgresql://localhost/savepic_bench \\
+        --rows 100k --concurrency 1,8,32 --json v0.6.6.json
+    python benchmarks/datalayer.py postgresql://localhost/savepic_bench \\
+        --rows 100k --concurrency 1,8,32 --compare v0.6.6.json
+
+默认不加载内存索引与牌堆（--listen 加载），测的是数据库本身。
+查询参数（名字、关键词、作用域、向量）由种子决定，不同版本之间可以直接比较。
+savepic 写入的行在结束后删除，测试库仍然是原来那份合成数据。
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import itertools
+import subprocess
+import numpy as np
+
+from typing import Callable, Awaitable
+from pathlib import Path
+from datetime import datetime, timezone
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from synthetic import (  # noqa: E402
+    UPLOADER,
+    add_library_arguments,
+    ensure_loaded,
+    init_plugin,
+    library_from,
+)
+
+
+FUNCTIONS = [
+    "select_pic",
+    "randpic",
+    "regexp_pic",
+    "countpic",
+    "listpic",
+    "simpic",
+    "savepic",
+]
+BENCH_URL = "synthetic/bench/"
+"""savepic 写入的行的 url 前缀，结束后按前缀删除"""
+
+Call = Callable[[int], Awaitable[object]]
+
+
+def _version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+async def prepare(args: argparse.Namespace, library) -> dict[str, Call]:
+    """生成各函数的调用，第 i 次调用的参数只由种子与 i 决定"""
+    from nonebot_plugin_savepic.core import sql
+
+    assert sql.POOL
+    rng = np.random.default_rng(args.seed + 2)
+    n = args.requests + args.warmup
+    async with sql.POOL.acquire() as conn:
+        await conn.execute("SELECT setseed(0.5);")
+        existing = [
+            (r["name"], r["scope"][0])
+            for r in await conn.fetch(
+                "SELECT name, scope FROM picdata WHERE uploader = $1 "
+                "ORDER BY random() LIMIT $2;",
+                UPLOADER,
+                n,
+            )
+        ]
+    scopes = [
+        library.scope_name(int(i))
+        for i in rng.choice(library.scopes, n, p=library.scope_weights)
+    ]
+    words = library.sample_words(rng, n)
+    vectors = library.queries(n, stream=2)
+    save_vectors = library.queries(n, stream=3)
+    serial = itertools.count()
+    """savepic 每次调用用不同的 url 与名字，各轮之间也不冲突"""
+
+    def pick(i: int):
+        return words[i % n], scopes[i % n]
+
+    async def select_pic(i: int):
+        name, scope = existing[i % len(existing)]
+        return await sql.select_pic(name, scope)
+
+    async def randpic(i: int):
+        word, scope = pick(i)
+        # 两成是不带关键词的纯随机
+        return await sql.randpic("" if i % 5 == 0 else word, scope)
+
+    async def regexp_pic(i: int):
+        return await sql.regexp_pic(*pick(i))
+
+    async def countpic(i: int):
+        return await sql.countpic(*pick(i))
+
+    async def listpic(i: int):
+        return await sql.listpic(*pick(i))
+
+    async def simpic(i: int):
+        return await sql.simpic(vectors[i % n], scopes[i % n])
+
+    async def savepic(i: int):
+        word, scope = pick(i)
+        key = next(serial)
+        return await sql.savepic(
+            f"{word}bench{key}",
+            f"{BENCH_URL}{key}",
+            scope,
+            UPLOADER,
+            save_vectors[i % n],
+        )
+
+    calls = {
+        "select_pic": select_pic,
+        "randpic": randpic,
+        "regexp_pic": regexp_pic,
+        "countpic": countpic,
+        "listpic": listpic,
+        "simpic": simpic,
+        "savepic": savepic,
+    }
+    return {name: calls[name] for name in args.functions}
+
+
+async def measure(call: Call, requests: int, warmup: int, concurrency: int) -> dict:
+    """以 concurrency 个协程共调用 requests 次，先顺序预热 warmup 次"""
+    from nonebot_plugin_savepic.core.error import (
+        SameNameException,
+        SimilarPictureException,
+    )
+
+    for i in range(warmup):
+        try:
+            await call(i)
+        except Exception:
+            pass
+
+    latencies: list[float] = []
+    counts = {"errors": 0, "rejected": 0}
+    todo = iter(range(warmup, warmup + requests))
+
+    async def worker():
+        for i in todo:
+            start = time.perf_counter()
+            try:
+                await call(i)
+            except (SameNameException, SimilarPictureException):
+                # 判重拒绝也是一次完整的调用
+                counts["rejected"] += 1
+            except Exception:
+                counts["errors"] += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    ms = np.asarray(latencies or [float("nan")])
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        **counts,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def compare(results: list[dict], baseline_path: str):
+    """打印与基线结果相比的变化，延迟升高、吞吐降低为正数表示变差"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    old = {(r["function"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\n对比 {baseline_path}（{baseline['meta'].get('version', '?')}）：")
+    print(f"{'function':<12}{'conc':>6}{'p50':>10}{'p99':>10}{'qps':>10}")
+    for r in results:
+        o = old.get((r["function"], r["concurrency"]))
+        if not o:
+            continue
+
+        def delta(key: str) -> str:
+            if not o[key]:
+                return "-"
+            return f"{(r[key] / o[key] - 1) * 100:+.1f}%"
+
+        print(
+            f"{r['function']:<12}{r['concurrency']:>6}"
+            f"{delta('p50_ms'):>10}{delta('p99_ms'):>10}{delta('throughput'):>10}"
+        )
+
+
+async def run(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.vecsearch import VEC_SEARCH
+
+    library = library_from(args)
+    await sql.init_db(listen=False)
+    try:
+        assert sql.POOL
+        async with sql.POOL.acquire() as conn:
+            await ensure_loaded(conn, library, sql.VEC_INDEX_SQL, args.regenerate)
+            server = await conn.fetchval("SHOW server_version;")
+    finally:
+        await sql.close_db()
+
+    # 数据准备好之后再连接，内存索引加载的是完整的图库
+    await sql.init_db(listen=args.listen)
+    results = []
+    try:
+        calls = await prepare(args, library)
+        for name, call in calls.items():
+            for concurrency in args.concurrency:
+                r = {"function": name}
+                r.update(
+                    await measure(call, args.requests, args.warmup, concurrency)
+                )
+                results.append(r)
+                print(
+                    f"{name:<12}{concurrency:>5} 并发  p50 {r['p50_ms']:8.2f} ms  "
+                    f"p99 {r['p99_ms']:8.2f} ms  {r['throughput']:9.1f}/s"
+                    + (f"  错误 {r['errors']}" if r["errors"] else "")
+                )
+    finally:
+        if sql.POOL:
+            async with sql.POOL.acquire() as conn:
+                await conn.execute(
+                    "DELETE FROM picdata WHERE url LIKE $1;", BENCH_URL + "%"
+                )
+        await sql.close_db()
+
+    if args.json:
+        meta = {
+            "version": args.label or _version(),
+            "time": datetime.now(timezone.utc).isoformat(),
+            "library": library.signature(),
+            "listen": args.listen,
+            "requests": args.requests,
+            "postgres": server,
+            "pgvector": ".".join(map(str, VEC_SEARCH.version)),
+            "python": platform.python_version(),
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="数据层基准测试")
+    add_library_arguments(parser)
+    parser.add_argument(
+        "--functions",
+        type=lambda s: s.split(","),
+        default=FUNCTIONS,
+        help=f"要测试的函数，逗号分隔，默认全部：{','.join(FUNCTIONS)}",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[1, 8, 32],
+        help="并发数，逗号分隔",
+    )
+    parser.add_argument("--requests", type=int, default=500, help="每组的调用次数")
+    parser.add_argument("--warmup", type=int, default=20, help="每组预热的调用次数")
+    parser.add_argument("--listen", action="store_true", help="加载内存索引与牌堆")
+    parser.add_argument("--label", help="结果中记录的版本名，默认为 git describe")
+    parser.add_argument("--json", help="结果另存为 JSON")
+    parser.add_argument("--compare", help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+    unknown = set(args.functions) - set(FUNCTIONS)
+    if unknown:
+        parser.error(f"未知的函数：{', '.join(unknown)}")
+
+    init_plugin(args.dsn)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
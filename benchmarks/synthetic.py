@@ -0,0 +1,259 @@
+"""
+可复现的合成图库，用于基准测试。
+
+相同的参数与种子总是生成相同的数据：
+- 作用域 qq_group:0 .. qq_group:{scopes-1} 的大小服从 Zipf 分布，少数大群、大量小群，
+  另有 globe_ratio 的图片属于全局；
+- 名字由 1~3 个词拼成，词频服从 Zipf 分布（少数热门词出现在大量名字里），
+  同一作用域内重名时加数字后缀，与 /savepic 的约束一致；
+- 向量是若干簇中心加噪声后归一化的 halfvec，比均匀随机的向量更接近真实的嵌入分布；
+- url 与 hash 由行号决定，uploader 固定为 synthetic，便于识别与清理。
+
+只能在测试库中使用：picdata 中存在非合成的行时拒绝写入。
+也可以单独运行，预先生成大图库：
+
+    python benchmarks/synthetic.py postgresql://localhost/savepic_bench --rows 1M
+"""
+
+import asyncio
+import hashlib
+import asyncpg
+import argparse
+import numpy as np
+
+from typing import Iterator
+
+import nonebot
+
+
+UPLOADER = "synthetic"
+DIM = 2048
+
+_COLUMNS = ["name", "scope", "url", "vec", "uploader", "hash"]
+_LATIN = ["doge", "cat", "hhh", "awsl", "orz", "qwq", "yyds", "emm", "xswl", "nb"]
+
+
+def parse_count(text: str) -> int:
+    """解析 10k / 100k / 1M 这样的行数"""
+    text = text.strip().lower()
+    for suffix, scale in (("k", 1000), ("m", 1000_000)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * scale)
+    return int(text)
+
+
+def init_plugin(dsn: str):
+    """以 dsn 为数据库加载插件，其余配置仍来自当前目录的 .env"""
+    nonebot.init(driver="~none", savepic_sqlurl=dsn, cache_sqlurl="", read_sqlurls=[])
+    nonebot.load_plugin("nonebot_plugin_savepic")
+
+
+class SyntheticLibrary:
+    """合成图库的参数
+
+    Parameters
+    ----------
+    rows: int
+        行数
+    scopes: int
+        群的个数
+    seed: int
+        随机种子
+    clusters: int
+        向量簇的个数
+    noise: float
+        簇内噪声的标准差（相对于单位向量）
+    zipf: float
+        作用域大小与词频的 Zipf 指数，越大越集中
+    globe_ratio: float
+        属于全局的比例
+    vocabulary: int
+        名字的词表大小
+    """
+
+    def __init__(
+        self,
+        rows: int,
+        scopes: int = 200,
+        seed: int = 0,
+        clusters: int = 256,
+        noise: float = 0.6,
+        zipf: float = 1.1,
+        globe_ratio: float = 0.02,
+        vocabulary: int = 2000,
+    ):
+        self.rows = rows
+        self.scopes = scopes
+        self.seed = seed
+        self.noise = noise
+        self.globe_ratio = globe_ratio
+        rng = np.random.default_rng(seed)
+        centers = rng.standard_normal((clusters, DIM)).astype(np.float32)
+        self.centers = centers / np.linalg.norm(centers, axis=1, keepdims=True)
+        weights = 1.0 / np.arange(1, scopes + 1) ** zipf
+        self.scope_weights = weights / weights.sum()
+
+        # 两个汉字的词，夹杂少量常见的拉丁字母梗
+        chars = rng.integers(0x4E00, 0x4E00 + 3000, size=(vocabulary, 2))
+        self.words = ["".join(map(chr, c)) for c in chars]
+        for i, word in enumerate(_LATIN):
+            self.words[i * 7] = word
+        weights = 1.0 / np.arange(1, vocabulary + 1) ** zipf
+        self.word_weights = weights / weights.sum()
+
+    def signature(self) -> str:
+        """记录在 picdata 的表注释里，参数相同就不必重新生成"""
+        return (
+            f"{UPLOADER} rows={self.rows} scopes={self.scopes} seed={self.seed} "
+            f"noise={self.noise} globe={self.globe_ratio} words={len(self.words)}"
+        )
+
+    def scope_name(self, i: int) -> str:
+        return f"qq_group:{i}"
+
+    def _rng(self, stream: int, batch: int) -> np.random.Generator:
+        return np.random.default_rng([self.seed, stream, batch])
+
+    def vectors(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        """从簇分布中采样 count 个单位向量（float32）"""
+        which = rng.integers(0, len(self.centers), count)
+        vec = self.centers[which] + rng.standard_normal((count, DIM)).astype(
+            np.float32
+        ) * (self.noise / np.sqrt(DIM))
+        return vec / np.linalg.norm(vec, axis=1, keepdims=True)
+
+    def sample_words(self, rng: np.random.Generator, count: int) -> list[str]:
+        """按词频采样，用作查询关键词"""
+        picked = rng.choice(len(self.words), count, p=self.word_weights)
+        return [self.words[i] for i in picked]
+
+    def batches(self, batch_size: int = 5000) -> Iterator[list[tuple]]:
+        """按批生成 picdata 的行，列顺序与 _COLUMNS 一致"""
+        seen: dict[int, int] = {}
+        """hash((作用域, 名字)) -> 已出现次数，用于给重名加后缀"""
+        for b, start in enumerate(range(0, self.rows, batch_size)):
+            rng = self._rng(0, b)
+            count = min(batch_size, self.rows - start)
+            scopes = rng.choice(self.scopes, size=count, p=self.scope_weights)
+            globe = rng.random(count) < self.globe_ratio
+            lengths = rng.integers(1, 4, count)
+            words = rng.choice(len(self.words), (count, 3), p=self.word_weights)
+            vecs = self.vectors(rng, count).astype(np.float16)
+            batch = []
+            for i in range(count):
+                row = start + i
+                digest = hashlib.sha256(f"{self.seed}:{row}".encode()).hexdigest()
+                scope = "globe" if globe[i] else self.scope_name(int(scopes[i]))
+                name = "".join(self.words[w] for w in words[i, : lengths[i]])
+                key = hash((scope, name))
+                n = seen.get(key, 0)
+                seen[key] = n + 1
+                if n:
+                    name = f"{name}{n + 1}"
+                batch.append(
+                    (
+                        name,
+                        [scope],
+                        f"synthetic/{digest}",
+                        vecs[i],
+                        UPLOADER,
+                        digest,
+                    )
+                )
+            yield batch
+
+    def queries(self, count: int, stream: int = 1) -> np.ndarray:
+        """与图库同分布、但不在库中的查询向量"""
+        return self.vectors(self._rng(stream, 0), count)
+
+
+async def check_scratch(conn: asyncpg.Connection):
+    """确认 picdata 中只有合成数据，否则抛出异常"""
+    if await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM picdata WHERE uploader <> $1);", UPLOADER
+    ):
+        raise RuntimeError("picdata 中有真实数据，请换一个空的测试库")
+
+
+async def load(
+    conn: asyncpg.Connection,
+    library: SyntheticLibrary,
+    vec_index_sql: str,
+    batch_size: int = 5000,
+):
+    """清空 picdata 并写入合成数据
+
+    写入期间删除向量索引、关闭变更通知触发器，写完后重建索引并 ANALYZE。
+    """
+    await check_scratch(conn)
+    async with conn.transaction():
+        await conn.execute(
+            "TRUNCATE picdata; \n"
+            "DROP INDEX IF EXISTS picdata_vec_hnsw_ip; \n"
+            "ALTER TABLE picdata DISABLE TRIGGER picdata_notify_trigger;"
+        )
+        done = 0
+        for batch in library.batches(batch_size):
+            await conn.copy_records_to_table("picdata", records=batch, columns=_COLUMNS)
+            done += len(batch)
+            print(f"\r已写入 {done}/{library.rows}", end="", flush=True)
+        print()
+        await conn.execute("ALTER TABLE picdata ENABLE TRIGGER picdata_notify_trigger;")
+    print("正在重建向量索引…")
+    await conn.execute(vec_index_sql)
+    await conn.execute("ANALYZE picdata;")
+    await conn.execute(f"COMMENT ON TABLE picdata IS '{library.signature()}';")
+
+
+async def ensure_loaded(
+    conn: asyncpg.Connection,
+    library: SyntheticLibrary,
+    vec_index_sql: str,
+    force: bool = False,
+):
+    """测试库中还不是这份合成数据时（或 force）重新生成"""
+    await check_scratch(conn)
+    current = await conn.fetchval("SELECT obj_description('picdata'::regclass);")
+    if force or current != library.signature():
+        await load(conn, library, vec_index_sql)
+
+
+def add_library_arguments(parser: argparse.ArgumentParser):
+    """各基准脚本共用的图库参数"""
+    parser.add_argument("dsn", help="测试库的连接串（不要用生产库）")
+    parser.add_argument(
+        "--rows", type=parse_count, default=100000, help="行数，如 10k / 100k / 1M"
+    )
+    parser.add_argument("--scopes", type=int, default=200, help="群的个数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--regenerate", action="store_true", help="重新生成合成数据")
+
+
+def library_from(args: argparse.Namespace) -> SyntheticLibrary:
+    return SyntheticLibrary(args.rows, args.scopes, args.seed)
+
+
+async def _generate(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+
+    await sql.init_db(listen=False)
+    try:
+        assert sql.POOL
+        async with sql.POOL.acquire() as conn:
+            await ensure_loaded(
+                conn, library_from(args), sql.VEC_INDEX_SQL, args.regenerate
+            )
+    finally:
+        await sql.close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成合成图库")
+    add_library_arguments(parser)
+    args = parser.parse_args()
+    init_plugin(args.dsn)
+    asyncio.run(_generate(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from pathlib import Path
 from nonebot import on_command
 from nonebot.params import CommandArg, Arg
 from nonebot.adapters.onebot.v11.message import Message as V11Msg
@@ -15,11 +16,12 @@ from .rule import PIC_ADMIN
 from .config import Config, plugin_config
 from .listpic import rkey
 from .command import url_to_image
-from .core.sql import savepic, regexp_pic
+from .core.sql import savepic, regexp_pic, check_hash
 from .core.utils import img2vec
 from .core.error import SameNameException
-from .core.error import SimilarPictureException
-from .core.fileio import write_pic, del_pic
+from .core.error import SimilarPictureException, NearDuplicateException
+from .core.fileio import write_pic, release_pic
+from .core.imageinfo import image_info
 
 
 __plugin_meta__ = PluginMetadata(
@@ -126,17 +128,40 @@ async def _(bot: Bot, state: T_State, event, picture: V11Msg = Arg()):
         await spic.finish("存图失败。" + "\n" + str(ex))
 
     try:
+        # 相同内容或感知哈希相近的图片已经存过，就不必再算向量
+        digest = Path(dir).name
+        info = await image_info(dir)
+        vec = await check_hash(
+            digest, state["savepiv_group"], info.phash, state["savepiv_ac"]
+        )
+        if vec is None:
+            vec = await img2vec(dir, state["savepiv_filename"])
         r = await savepic(
             filename=state["savepiv_filename"],
             url=dir,
             scope=state["savepiv_group"],
             uploader=f"{bot.adapter.get_name().split(maxsplit=1)[0].lower()}:{event.get_user_id()}",
-            vec=await img2vec(url, state["savepiv_filename"]),
+            vec=vec,
             collision_allow=state["savepiv_ac"],
+            digest=digest,
+            info=info,
         )
     except SameNameException:
-        await del_pic(dir)
         await spic.finish("文件名重复")
+    except NearDuplicateException as ex:
+        await spic.finish(
+            V11Msg(
+                [
+                    V11Seg.text(
+                        "存在相似图片"
+                        + "\n\n"
+                        + ex.name
+                        + f"\n(感知哈希距离：{ex.distance})\n"
+                    ),
+                    await url_to_image(ex.url),
+                ]
+            )
+        )
     except SimilarPictureException as ex:
         if ex.similarity >= 0.999:
             await spic.finish(
@@ -147,7 +172,6 @@ async def _(bot: Bot, state: T_State, event, picture: V11Msg = Arg()):
                     ]
                 )
             )
-        await del_pic(dir)
         await spic.finish(
             V11Msg(
                 [
@@ -162,8 +186,10 @@ async def _(bot: Bot, state: T_State, event, picture: V11Msg = Arg()):
             )
         )
     except Exception as ex:
-        await del_pic(dir)
         await spic.finish(f"出错了。{ex}")
+    finally:
+        # 保存成功时文件已被新行引用；失败时若没有其它行引用则删除
+        await release_pic(dir)
 
     if r:
         await spic.send(f"保存成功，但是名字为`{r}`")
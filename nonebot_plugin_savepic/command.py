@@ -13,19 +13,28 @@ from nonebot.adapters.onebot.v11.message import Message as V11Msg
 from nonebot.adapters.onebot.v11.message import MessageSegment as V11Seg
 
 from .listpic import rkey
-from .core.sql import simpic, randpic, countpic, select_pic
+from .config import plugin_config
+from .core.sql import simpic, randpic, countpic, estimate_pic, select_pic
 from .core.utils import img2vec
+from .core.cache import TEXT_CACHE
+from .core.metrics import METRICS
+from .core.slowlog import SLOW_LOG
+from .core.derivative import DERIVATIVES
 
 cpic = on_command("countpic", priority=5)
 rpic = on_command("randpic", priority=5)
 s_simpic = on_command("simpic", priority=5)
 pic_listen = on_endswith((".jpg", ".png", ".gif"), priority=50, block=False)
 pic_clear = on_command("pic.clear", permission=SUPERUSER, priority=1, block=True)
+pic_stats = on_command("pic.stats", permission=SUPERUSER, priority=1, block=True)
+pic_slow = on_command("pic.slow", permission=SUPERUSER, priority=1, block=True)
 
 
 async def url_to_image(url: str) -> V11Seg:
     if url.startswith("http"):
         return V11Seg.image(url)
+    if plugin_config.derivative_cache:
+        url = await DERIVATIVES.get(url)
     return V11Seg.image(Path(url))
 
 
@@ -36,7 +45,14 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
         "globe" if not isinstance(event, V11GME) else f"qq_group:{event.group_id}"
     )
     try:
-        await bot.send(event, f"共查找到 {await countpic(reg, group_id)} 张图片。")
+        if plugin_config.countpic_approximate:
+            count, approximate = await estimate_pic(reg, group_id)
+        else:
+            count, approximate = await countpic(reg, group_id), False
+        if approximate:
+            await bot.send(event, f"共查找到约 {count} 张图片（抽样估算）。")
+        else:
+            await bot.send(event, f"共查找到 {count} 张图片。")
     except Exception as ex:
         await cpic.finish(f"出错了喵~\n\n{ex}")
 
@@ -118,21 +134,28 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
 async def _():
     # 清理孤儿图片
     from .core import sql
+    from .core.storage import STORE
 
     if not sql.POOL:
         await pic_clear.finish("数据库未初始化")
     await pic_clear.send("开始清理孤儿图片...")
-    img = set(Path("savepic").glob("*"))
-    async with sql.POOL.acquire() as conn, conn.transaction():
-        async for record in conn.cursor("SELECT name, url FROM picdata;"):
-            if not record["url"].startswith("savepic/"):
-                continue
-            p = Path(record["url"])
-            img.remove(p)
-    if img:
-        await pic_clear.send(f"发现 {len(img)} 张孤儿图片，正在删除...")
-        for p in img:
-            p.unlink(missing_ok=True)
-        await pic_clear.send("删除完成！")
-    else:
-        await pic_clear.send("没有发现孤儿图片！")
+    if removed := await STORE.sweep():
+        await pic_clear.finish(f"删除了 {removed} 张孤儿图片！")
+    await pic_clear.finish("没有发现孤儿图片！")
+
+
+@pic_stats.handle()
+async def _():
+    # 文本嵌入缓存的命中率不依赖 metrics，始终可以查看
+    cache = TEXT_CACHE.summary() if plugin_config.text_cache else ""
+    if not METRICS.enabled:
+        await pic_stats.finish("\n".join(filter(None, [cache, "未开启 metrics"])))
+    await pic_stats.finish("\n".join(filter(None, [cache, METRICS.summary()])))
+
+
+@pic_slow.handle()
+async def _(args: Message = CommandArg()):
+    if not SLOW_LOG.enabled:
+        await pic_slow.finish("未开启慢查询日志（slow_query_ms 为 0）")
+    count = args.extract_plain_text().strip()
+    await pic_slow.finish(SLOW_LOG.dump(int(count) if count.isdigit() else 5))
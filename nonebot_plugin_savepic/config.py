@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 from nonebot import get_plugin_config
 from pydantic import BaseModel
 
@@ -8,11 +8,26 @@ class Config(BaseModel):
 
     savepic_admin: list[str] = []
     savepic_dir: str = "savepic"
+    savepic_fsync: bool = False
+    """ 保存图片后 fsync 文件与目录，断电也不会丢图，但写入更慢 """
+    download_max_bytes: int = 20 * 1024 * 1024
+    """ 下载图片的大小上限（字节），0 表示不限制 """
+    download_timeout: float = 30.0
+    """ 下载一张图片的总时间上限（秒），0 表示不限制 """
     savepic_sqlurl: str
 
-    embedding_key: str
-    embedding_url: str
-    embedding_model: str
+    embedding_key: str = ""
+    embedding_url: str = ""
+    embedding_model: str = ""
+
+    embedding_provider: Literal["http", "local", "stub"] = "http"
+    """ 嵌入向量的来源：http 为远程接口，local 为本机 CPU 上的模型，stub 为测试用的假向量 """
+    embedding_local_path: Optional[str] = None
+    """ local 模式下 sentence-transformers 模型（如 CLIP）的本地路径 """
+    embedding_local_workers: int = 0
+    """ local 模式下的推理进程数，0 表示在 bot 进程的线程中运行 """
+    embedding_project: bool = False
+    """ 模型输出维度不是 2048 时，补零或随机投影到 2048 维（否则拒绝） """
 
     notfound_with_jpg: bool = True
     """ randpic 的时候，尝试带 .jpg 再度检索向量 """
@@ -25,9 +40,105 @@ class Config(BaseModel):
 
     cache_sqlurl: Optional[str] = None
     """ 额外的只读连接池地址，若不填写则与 savepic_sqlurl 共用 """
+    read_sqlurls: list[str] = []
+    """ 更多只读副本的地址，与 cache_sqlurl 一起参与读取的负载均衡 """
+    read_max_lag: float = 5.0
+    """ 副本的复制延迟（秒）超过此值时不再分配读取 """
+    read_probe_interval: float = 5.0
+    """ 探测副本健康状态与复制延迟的间隔（秒） """
+    read_your_writes: float = 10.0
+    """ 作用域写入后多少秒内，该作用域的读取走主库，0 表示关闭 """
 
     normalize_vector: Optional[str] = None
-    """ 向量归一化，路径指向一个 txt 文件，文件内是均值向量 """
+    """ 向量归一化，路径指向均值向量的 .npy 文件或 txt 文件（会在旁边生成 .npy 加速下次加载） """
+
+    name_cache: bool = True
+    """ 在内存中缓存 名字 -> URL 索引，通过 LISTEN/NOTIFY 与数据库保持同步 """
+
+    http2: bool = False
+    """ 共享 HTTP 客户端是否启用 HTTP/2，需要安装 h2 """
+    http_max_connections: int = 100
+    """ 共享 HTTP 客户端的最大连接数 """
+    http_max_keepalive: int = 20
+    """ 共享 HTTP 客户端最多保持多少条空闲连接 """
+    http_keepalive_expiry: float = 30.0
+    """ 空闲连接保持多久（秒） """
+    http_timeout: float = 5.0
+    """ 请求超时（秒） """
+
+    embedding_batch_size: int = 1
+    """ 单次嵌入请求最多合并多少个输入，1 表示不合并（多模态接口会把 input 融合成一个向量）；
+    大于 1 时接口需逐项返回向量，标题 + 图片 这类多段输入会拆开合并请求，再在本地融合 """
+    embedding_batch_window: float = 0.02
+    """ 合并嵌入请求时等待的时间窗口（秒） """
+
+    random_deck: bool = True
+    """ 随机抽图使用内存中的洗牌牌堆，代替 ORDER BY random() """
+    random_deck_max: int = 256
+    """ 最多保留多少副牌堆（每个作用域、每个关键词各一副） """
+
+    countpic_cache_ttl: float = 30.0
+    """ countpic 结果缓存多久（秒），0 表示不缓存 """
+    countpic_approximate: bool = False
+    """ countpic 在可见图片过多时抽样估算，回复中会标明是估算值 """
+    countpic_approximate_above: int = 50000
+    """ 可见图片超过多少张时才估算 """
+    countpic_sample_rows: int = 10000
+    """ 估算时大约抽样多少行 """
+
+    text_cache: bool = True
+    """ 缓存文本的嵌入向量（内存 + 数据库），randpic / cipdnar 的关键词不必重复请求 """
+    text_cache_bytes: int = 16 * 1024 * 1024
+    """ 文本嵌入缓存在内存中最多占用的字节数 """
+
+    backfill_workers: int = 4
+    """ pic.vec.update 并发计算向量的数量 """
+    backfill_batch_size: int = 50
+    """ pic.vec.update 每次写回数据库（并记录检查点）的行数 """
+
+    phash_distance: int = -1
+    """ 保存时感知哈希汉明距离不超过该值即视为相似（在请求嵌入之前检查），-1 表示不检查；
+    文字配图之类的图片哈希容易相近，默认不开启 """
+    phash_workers: int = 1
+    """ 解析图片、计算感知哈希的进程数，0 表示在 bot 进程的线程中运行 """
+    derivative_cache: bool = False
+    """ 发送大图时改发缩小 / 重新压缩后的衍生图 """
+    derivative_threshold: int = 2 * 1024 * 1024
+    """ 原图超过此字节数时才生成衍生图 """
+    derivative_max_side: int = 1280
+    """ 衍生图的最长边（像素） """
+    derivative_target_bytes: int = 1024 * 1024
+    """ 衍生图的目标字节数，静态图降低质量、动图抽帧直到不超过它 """
+    derivative_cache_bytes: int = 512 * 1024 * 1024
+    """ 衍生图缓存的总大小上限，超过时淘汰最久未使用的 """
+    derivative_workers: int = 1
+    """ 生成衍生图的进程数，0 表示在 bot 进程的线程中运行 """
+    derivative_wait: float = 3.0
+    """ 发送时等待衍生图生成的秒数，超时先发原图，生成在后台继续 """
+    vec_ef_search: int = 40
+    """ HNSW 检索的候选数（hnsw.ef_search），越大召回率越高、越慢 """
+    vec_iterative_scan: Literal["off", "relaxed_order", "strict_order"] = (
+        "relaxed_order"
+    )
+    """ pgvector 0.8 起的迭代扫描，按作用域过滤后结果不足时继续扫描索引 """
+    vec_max_scan_tuples: int = 20000
+    """ 迭代扫描最多扫过的元组数（hnsw.max_scan_tuples） """
+    vec_exact_threshold: int = 5000
+    """ 本域与全局图片数不超过此值时做精确检索，不走 HNSW 索引 """
+    metrics: bool = False
+    """ 记录调用耗时、连接池状态等指标，可通过 pic.stats 与 HTTP 接口查看 """
+    metrics_path: str = "/savepic/metrics"
+    """ Prometheus 指标的 HTTP 路径，需要带 HTTP 服务端的驱动（如 FastAPI） """
+    slow_query_ms: int = 1000
+    """ 慢查询阈值（毫秒），超过时记录到日志与 pic.slow，0 表示关闭 """
+    slow_query_explain: float = 0.0
+    """ 对慢查询执行 EXPLAIN (ANALYZE, BUFFERS) 的抽样比例，只针对只读查询 """
+    slow_query_buffer: int = 50
+    """ pic.slow 保留的最近慢查询条数 """
+    db_warmup: bool = True
+    """ 新连接建立时预先执行常用语句，首个请求不必等待语句准备 """
+    db_prewarm_index: bool = False
+    """ 启动时在后台用 pg_prewarm 把向量索引读入共享缓冲区，需要 pg_prewarm 扩展 """
 
 
 plugin_config: Config = get_plugin_config(Config)
@@ -0,0 +1,328 @@
+"""
+整库导出与恢复。
+
+导出的归档是一个目录：
+    manifest.json   元数据（格式版本、行数、向量维度、嵌入模型等）
+    rows.jsonl      每行一条 picdata 记录，vec 字段为向量矩阵中的行号（没有向量为 -1）
+    vectors.npy     float16 向量矩阵，可以用 np.load(..., mmap_mode="r") 直接映射
+    files/ab/abcd…  按 SHA-256 存放的图片文件，相同内容只存一份
+
+导出在只读快照里用服务端游标逐批读取，不会把整张表读进内存；
+恢复时用 COPY 批量写入，并先删除 HNSW 索引、写完后再一次性重建。
+"""
+
+import json
+import shutil
+import asyncio
+import hashlib
+import numpy as np
+
+from typing import Optional, Iterator
+from pathlib import Path
+from datetime import datetime, timezone
+from nonebot import logger
+
+from . import sql
+from .listen import RELOAD_SQL
+from .storage import STORE
+from .provider import VECTOR_DIM
+from .embedding import DISPATCHER
+from .vecsearch import SCOPE_INDEX_PREFIX
+
+
+FORMAT = "savepic-archive"
+VERSION = 1
+META = ["width", "height", "size", "mime", "frames", "phash"]
+"""图片元数据列，原样写入 rows.jsonl"""
+COLUMNS = ["name", "scope", "url", "vec", "uploader", "hash"] + META
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _store_file(src: Path, files: Path, digest: Optional[str]) -> str:
+    """把本地图片按内容存入归档，返回 SHA-256"""
+    digest = digest or _sha256(src)
+    dest = files / digest[:2] / digest
+    if not dest.exists():
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_suffix(".tmp")
+        shutil.copyfile(src, tmp)
+        tmp.replace(dest)
+    return digest
+
+
+def _export_batch(rows: list, files: Path) -> list[dict]:
+    out = []
+    for row, index in rows:
+        url = row["url"]
+        item = {
+            "name": row["name"],
+            "scope": list(row["scope"]),
+            "uploader": row["uploader"],
+            "hash": row["hash"],
+            "file": None,
+            "url": None,
+            "vec": index,
+        }
+        item.update({k: row[k] for k in META})
+        if url.startswith("http"):
+            item["url"] = url
+        elif Path(url).is_file():
+            item["hash"] = item["file"] = _store_file(Path(url), files, row["hash"])
+        else:
+            logger.warning(f"导出时找不到图片文件，跳过: {row['name']} {url}")
+            continue
+        out.append(item)
+    return out
+
+
+async def export_library(
+    dest: Path, scope: Optional[str] = None, batch_size: int = 500
+) -> dict:
+    """导出整个图库
+
+    Parameters
+    ----------
+    dest: Path
+        归档目录，不存在时自动创建，不能是非空目录
+    scope: Optional[str]
+        只导出该作用域（及全局）可见的图片，默认全部导出
+    batch_size: int
+        每批从游标读取的行数
+
+    Returns
+    -------
+    dict
+        写入的 manifest
+    """
+    if dest.exists() and any(dest.iterdir()):
+        raise FileExistsError(f"归档目录不为空：{dest}")
+    files = dest / "files"
+    files.mkdir(parents=True, exist_ok=True)
+
+    where = "WHERE scope && ARRAY[$1, 'globe']" if scope else ""
+    args = [scope] if scope else []
+    exported = 0
+    async with sql.POOL_LOCAL.acquire() as conn:
+        # 同一个快照里统计与读取，向量矩阵的大小才能提前确定
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            total, vectors, dim = await conn.fetchrow(
+                "SELECT COUNT(*), COUNT(vec), "
+                f"COALESCE(MAX(vector_dims(vec)), {VECTOR_DIM}) FROM picdata {where};",
+                *args,
+            )
+            matrix = np.lib.format.open_memmap(
+                dest / "vectors.npy", mode="w+", dtype="<f2", shape=(vectors, dim)
+            )
+            index = 0
+            batch: list = []
+            with open(dest / "rows.jsonl", "w", encoding="utf-8") as f:
+
+                async def write_batch():
+                    nonlocal exported
+                    items = await asyncio.to_thread(_export_batch, batch, files)
+                    for item in items:
+                        f.write(json.dumps(item, ensure_ascii=False) + "\n")
+                    exported += len(items)
+                    batch.clear()
+
+                async for r in conn.cursor(
+                    f"SELECT {', '.join(COLUMNS)} FROM picdata {where} ORDER BY url;",
+                    *args,
+                    prefetch=batch_size,
+                ):
+                    i = -1
+                    if r["vec"] is not None:
+                        i = index
+                        matrix[i] = r["vec"]
+                        index += 1
+                    batch.append((r, i))
+                    if len(batch) >= batch_size:
+                        await write_batch()
+                        logger.info(f"已导出 {exported} / {total}")
+                if batch:
+                    await write_batch()
+            matrix.flush()
+            del matrix
+
+    manifest = {
+        "format": FORMAT,
+        "version": VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "model": DISPATCHER.provider.name,
+        "scope": scope,
+        "rows": exported,
+        "vectors": int(vectors),
+        "dim": int(dim),
+    }
+    with open(dest / "manifest.json", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    logger.info(f"导出完成：{exported} 张图片，{vectors} 个向量 -> {dest}")
+    return manifest
+
+
+def read_manifest(src: Path) -> dict:
+    with open(src / "manifest.json", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT:
+        raise ValueError(f"不是 savepic 归档：{src}")
+    if manifest.get("version", 0) > VERSION:
+        raise ValueError(f"归档版本 {manifest['version']} 过新，请升级插件")
+    return manifest
+
+
+def _iter_rows(src: Path) -> Iterator[dict]:
+    with open(src / "rows.jsonl", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _restore_batch(items: list[dict], src: Path, matrix: np.ndarray) -> list[tuple]:
+    # 旧的平铺 url 与分片 url 指向同一内容时，copy_in 会给出相同的 url，合并为一行
+    records: dict[str, tuple] = {}
+    for item in items:
+        if item["file"]:
+            digest = item["file"]
+            url = STORE.copy_in(src / "files" / digest[:2] / digest, digest)
+        else:
+            url = item["url"]
+        vec = matrix[item["vec"]] if item["vec"] >= 0 else None
+        record = (
+            item["name"], item["scope"], url, vec, item["uploader"], item["hash"]
+        ) + tuple(item.get(k) for k in META)
+        if old := records.get(url):
+            scope = old[1] + [s for s in record[1] if s not in old[1]]
+            record = (old[0], scope) + tuple(
+                a if a is not None else b for a, b in zip(old[2:], record[2:])
+            )
+        records[url] = record
+    return list(records.values())
+
+
+async def restore_library(
+    src: Path,
+    batch_size: int = 1000,
+    maintenance_work_mem: Optional[str] = None,
+    build_workers: Optional[int] = None,
+) -> int:
+    """从归档恢复图库，已存在的 URL 会合并作用域
+
+    整个恢复在一个事务中完成：删除 HNSW 索引（包括各作用域的部分索引）、关闭变更触发器、
+    COPY 写入、重建索引，最后通知正在运行的 bot 重新加载内存索引。期间 picdata 被锁定。
+
+    Parameters
+    ----------
+    src: Path
+        export_library 导出的目录
+    batch_size: int
+        每批 COPY 的行数
+    maintenance_work_mem: Optional[str]
+        重建索引时使用的 maintenance_work_mem，如 "2GB"
+    build_workers: Optional[int]
+        重建索引的并行 worker 数（max_parallel_maintenance_workers）
+
+    Returns
+    -------
+    int
+        写入的行数
+    """
+    manifest = read_manifest(src)
+    if manifest["model"] != DISPATCHER.provider.name:
+        logger.warning(
+            f"归档的嵌入模型 {manifest['model']} 与当前配置 "
+            f"{DISPATCHER.provider.name} 不同，相似度检索可能失准"
+        )
+    matrix = np.load(src / "vectors.npy", mmap_mode="r")
+
+    assert sql.POOL
+    restored = 0
+    async with sql.POOL.acquire() as conn, conn.transaction():
+        # 作用域的部分索引与整表索引一样先删除，写完后按原定义重建
+        partial = await conn.fetch(
+            "SELECT c.relname, i.indisvalid, pg_get_indexdef(c.oid) AS create_sql, "
+            "format('COMMENT ON INDEX %I IS %L', c.relname, "
+            "obj_description(c.oid, 'pg_class')) AS comment_sql "
+            "FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname LIKE $1;",
+            SCOPE_INDEX_PREFIX + "%",
+        )
+        for r in partial:
+            await conn.execute(f'DROP INDEX IF EXISTS "{r["relname"]}";')
+        await conn.execute(
+            "DROP INDEX IF EXISTS picdata_vec_hnsw_ip; \n"
+            "ALTER TABLE picdata DISABLE TRIGGER picdata_notify_trigger; \n"
+            "CREATE TEMP TABLE picdata_restore "
+            "(LIKE picdata INCLUDING DEFAULTS) ON COMMIT DROP;"
+        )
+
+        batch: list[dict] = []
+
+        async def load_batch():
+            nonlocal restored
+            records = await asyncio.to_thread(_restore_batch, batch, src, matrix)
+            batch.clear()
+            # 即使是空表也经过中转表合并：不同批次里可能有相同的 url
+            await conn.copy_records_to_table(
+                "picdata_restore", records=records, columns=COLUMNS
+            )
+            await conn.execute(
+                """
+INSERT INTO picdata (
+    name, scope, url, vec, uploader, hash, width, height, size, mime, frames, phash
+)
+SELECT DISTINCT ON (url)
+    name, scope, url, vec, uploader, hash, width, height, size, mime, frames, phash
+FROM picdata_restore
+ON CONFLICT (url) DO UPDATE
+SET
+    scope = ARRAY(SELECT DISTINCT unnest(picdata.scope || EXCLUDED.scope)),
+    vec   = COALESCE(picdata.vec, EXCLUDED.vec),
+    hash  = COALESCE(picdata.hash, EXCLUDED.hash),
+    width  = COALESCE(picdata.width, EXCLUDED.width),
+    height = COALESCE(picdata.height, EXCLUDED.height),
+    size   = COALESCE(picdata.size, EXCLUDED.size),
+    mime   = COALESCE(picdata.mime, EXCLUDED.mime),
+    frames = COALESCE(picdata.frames, EXCLUDED.frames),
+    phash  = COALESCE(picdata.phash, EXCLUDED.phash);
+TRUNCATE picdata_restore;"""
+            )
+            restored += len(records)
+            logger.info(f"已恢复 {restored} / {manifest['rows']}")
+
+        for item in _iter_rows(src):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                await load_batch()
+        if batch:
+            await load_batch()
+
+        logger.info("数据已写入，开始重建 HNSW 索引")
+        if maintenance_work_mem:
+            await conn.execute(
+                "SELECT set_config('maintenance_work_mem', $1, true);",
+                maintenance_work_mem,
+            )
+        if build_workers is not None:
+            await conn.execute(
+                "SELECT set_config('max_parallel_maintenance_workers', $1, true);",
+                str(build_workers),
+            )
+        await conn.execute(sql.VEC_INDEX_SQL)
+        for r in partial:
+            if r["indisvalid"]:
+                await conn.execute(r["create_sql"])
+                await conn.execute(r["comment_sql"])
+        await conn.execute(
+            "ALTER TABLE picdata ENABLE TRIGGER picdata_notify_trigger; \n"
+            "ANALYZE picdata;"
+        )
+        await conn.execute(RELOAD_SQL)
+    logger.info(f"恢复完成：{restored} 行")
+    return restored
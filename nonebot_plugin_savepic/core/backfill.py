@@ -0,0 +1,253 @@
+"""
+补全缺失的向量（pic.vec.update 与命令行 backfill）。
+
+按 url 分页扫描 vec IS NULL 的行，每页由若干 worker 并发计算向量，
+算完的一页在一个短事务里批量写回，并把页尾的 url 记为检查点。
+中断后再次运行从检查点继续；失败的行本轮跳过，完整跑完一轮后检查点清除，
+下次运行时再重试。
+
+每行的 标题 + 图片 经由嵌入调度发送：embedding_batch_size > 1 时各段拆开参与合并请求，
+否则每行单独请求一次，并发度由 backfill_workers 决定。
+
+backfill_info 为旧数据补全图片元数据与感知哈希，不需要嵌入接口。
+"""
+
+import time
+import asyncio
+import asyncpg
+import numpy as np
+
+from typing import Optional, Callable, Awaitable
+from nonebot import logger
+
+from . import sql
+from .utils import img2vec
+from .fileio import load_pic
+from .imageinfo import image_info
+
+
+JOB = "vec"
+LOCK_KEY = 0x7361_7665
+"""防止 bot 与命令行同时补全的咨询锁"""
+
+
+class BackfillRunning(Exception):
+    """已有补全任务在运行"""
+
+
+class VecBackfill:
+    """并发补全向量
+
+    Parameters
+    ----------
+    workers: int
+        并发上传、计算向量的数量
+    batch_size: int
+        每页（每次写回）的行数
+    """
+
+    def __init__(self, workers: int = 4, batch_size: int = 50):
+        self.workers = max(workers, 1)
+        self.batch_size = max(batch_size, 1)
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.cursor = ""
+        self._base = 0
+        self._started = 0.0
+
+    @staticmethod
+    async def _ensure_table(conn: asyncpg.Connection):
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS picdata_backfill (\n"
+            "  job        text PRIMARY KEY, \n"
+            "  cursor     text NOT NULL, \n"
+            "  done       int  NOT NULL DEFAULT 0, \n"
+            "  failed     int  NOT NULL DEFAULT 0, \n"
+            "  updated_at timestamptz NOT NULL DEFAULT now() \n"
+            ");"
+        )
+
+    async def _checkpoint(self, conn: asyncpg.Connection):
+        await conn.execute(
+            "INSERT INTO picdata_backfill (job, cursor, done, failed) "
+            "VALUES ($1, $2, $3, $4) "
+            "ON CONFLICT (job) DO UPDATE SET cursor = EXCLUDED.cursor, "
+            "done = EXCLUDED.done, failed = EXCLUDED.failed, updated_at = now();",
+            JOB,
+            self.cursor,
+            self.done,
+            self.failed,
+        )
+
+    async def _embed(self, name: str, url: str) -> Optional[np.ndarray]:
+        try:
+            vec = await img2vec(url, name)
+            if vec is None:
+                logger.warning(f"图片 {name} 特征提取失败，跳过")
+            return vec
+        except Exception as ex:
+            logger.error(f"图片 {name} 特征提取失败，跳过，错误信息：{ex}")
+            return None
+
+    async def _page(self, rows: list[asyncpg.Record]) -> list[tuple]:
+        sem = asyncio.Semaphore(self.workers)
+
+        async def one(r: asyncpg.Record):
+            async with sem:
+                return await self._embed(r["name"], r["url"])
+
+        vecs = await asyncio.gather(*(one(r) for r in rows))
+        return [(v, r["url"]) for r, v in zip(rows, vecs) if v is not None]
+
+    def progress(self) -> str:
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        processed = self.done + self.failed
+        # 速度只按本次运行统计
+        rate = (processed - self._base) / elapsed
+        msg = f"已完成 {processed}/{self.total}，失败 {self.failed}，{rate:.2f} 张/秒"
+        if rate > 0 and self.total > processed:
+            msg += f"，预计还需 {(self.total - processed) / rate / 60:.1f} 分钟"
+        return msg
+
+    async def run(
+        self,
+        restart: bool = False,
+        on_progress: Optional[Callable[[str], Awaitable[None]]] = None,
+        report_every: float = 60.0,
+    ) -> tuple[int, int]:
+        """补全向量
+
+        Parameters
+        ----------
+        restart: bool
+            忽略上次中断留下的检查点，从头开始
+        on_progress: Optional[Callable[[str], Awaitable[None]]]
+            进度回调，默认只写日志
+        report_every: float
+            进度回调的最短间隔（秒）
+
+        Returns
+        -------
+        tuple[int, int]
+            (成功数, 失败数)
+
+        Exceptions
+        ----------
+        BackfillRunning
+            已有补全任务在运行
+        """
+        assert sql.POOL
+        async with sql.POOL.acquire() as lock:
+            if not await lock.fetchval("SELECT pg_try_advisory_lock($1);", LOCK_KEY):
+                raise BackfillRunning()
+            try:
+                return await self._run(restart, on_progress, report_every)
+            finally:
+                await lock.execute("SELECT pg_advisory_unlock($1);", LOCK_KEY)
+
+    async def _run(self, restart, on_progress, report_every) -> tuple[int, int]:
+        assert sql.POOL
+        async with sql.POOL.acquire() as conn:
+            await self._ensure_table(conn)
+            if restart:
+                await conn.execute("DELETE FROM picdata_backfill WHERE job = $1;", JOB)
+            row = await conn.fetchrow(
+                "SELECT cursor, done, failed FROM picdata_backfill WHERE job = $1;", JOB
+            )
+            if row:
+                self.cursor, self.done, self.failed = row
+                logger.info(f"从检查点继续补全向量：{self.cursor}")
+            self.total = self.done + self.failed
+            self.total += await conn.fetchval(
+                "SELECT COUNT(*) FROM picdata WHERE vec IS NULL AND url > $1;",
+                self.cursor,
+            )
+
+        self._base = self.done + self.failed
+        self._started = time.monotonic()
+        last_report = time.monotonic()
+        while True:
+            async with sql.POOL.acquire() as conn:
+                rows = await conn.fetch(
+                    "SELECT name, url FROM picdata "
+                    "WHERE vec IS NULL AND url > $1 ORDER BY url LIMIT $2;",
+                    self.cursor,
+                    self.batch_size,
+                )
+            if not rows:
+                break
+
+            results = await self._page(rows)
+            self.cursor = rows[-1]["url"]
+            self.done += len(results)
+            self.failed += len(rows) - len(results)
+            async with sql.POOL.acquire() as conn, conn.transaction():
+                if results:
+                    # 其它途径（例如 mvpic）可能已经写了向量，不覆盖
+                    await conn.executemany(
+                        "UPDATE picdata SET vec = $1 WHERE url = $2 AND vec IS NULL;",
+                        results,
+                    )
+                await self._checkpoint(conn)
+
+            if time.monotonic() - last_report >= report_every:
+                last_report = time.monotonic()
+                msg = self.progress()
+                logger.info(msg)
+                if on_progress:
+                    await on_progress(msg)
+
+        # 完整跑完一遍后清除检查点，下次从头开始并重试失败的行
+        async with sql.POOL.acquire() as conn:
+            await conn.execute("DELETE FROM picdata_backfill WHERE job = $1;", JOB)
+        logger.info(f"向量补全完成：{self.progress()}")
+        return self.done, self.failed
+
+
+async def backfill_info(workers: int = 4, batch_size: int = 200) -> tuple[int, int]:
+    """为 size 为空的行补全图片元数据与感知哈希
+
+    Returns
+    -------
+    tuple[int, int]
+        (成功数, 失败数)
+    """
+    assert sql.POOL
+    sem = asyncio.Semaphore(max(workers, 1))
+    cursor = ""
+    done = failed = 0
+
+    async def one(url: str):
+        async with sem:
+            try:
+                if url.startswith("http"):
+                    return await image_info(await load_pic(url))
+                return await image_info(url)
+            except Exception as ex:
+                logger.warning(f"无法读取图片 {url}：{ex}")
+                return None
+
+    while True:
+        async with sql.POOL.acquire() as conn:
+            urls = await conn.fetch(
+                "SELECT url FROM picdata WHERE size IS NULL AND url > $1 "
+                "ORDER BY url LIMIT $2;",
+                cursor,
+                batch_size,
+            )
+        if not urls:
+            break
+        cursor = urls[-1]["url"]
+        infos = await asyncio.gather(*(one(r["url"]) for r in urls))
+        results = [(r["url"], *i) for r, i in zip(urls, infos) if i is not None]
+        done += len(results)
+        failed += len(urls) - len(results)
+        async with sql.POOL.acquire() as conn:
+            await conn.executemany(
+                "UPDATE picdata SET size = $2, mime = $3, width = $4, height = $5, "
+                "frames = $6, phash = $7 WHERE url = $1;",
+                results,
+            )
+        logger.info(f"已补全 {done} 张图片的元数据，失败 {failed}")
+    return done, failed
@@ -0,0 +1,472 @@
+"""
+批量导入：从目录、zip 压缩包或清单 CSV 导入图片。
+
+判重规则与 sql.savepic 一致：
+- 同一作用域内同名的跳过；
+- 相同内容已在本域或全局的视为重复；
+- 感知哈希与本域或全局中的图片相近的视为相似；
+- 与本域或全局中的图片向量相似度 >= 0.75 的视为相似（可用 allow_similar 放行）。
+
+文件并发写入 savepic_dir，向量由嵌入调度器并发计算，
+最后按批 COPY 到临时表，再合并进 picdata。
+"""
+
+import csv
+import time
+import asyncio
+import hashlib
+import zipfile
+import numpy as np
+
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, Callable, Awaitable
+from nonebot import logger
+
+from . import sql
+from .utils import img2vec
+from .fileio import load_pic, write_bytes, release_pic
+from .imageinfo import image_info, near_sql, bands, hamming
+from .vecsearch import VEC_SEARCH
+from ..config import plugin_config
+
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp")
+COLUMNS = [
+    "name",
+    "scope",
+    "url",
+    "vec",
+    "uploader",
+    "hash",
+    "width",
+    "height",
+    "size",
+    "mime",
+    "frames",
+    "phash",
+]
+
+
+class ImportItem(NamedTuple):
+    source: str
+    """来源（路径、压缩包成员或 URL），用于报告"""
+    name: str
+    scope: str
+    read: Callable[[], Awaitable[bytes]]
+
+
+def pic_name(filename: str) -> str:
+    """与 /savepic 相同的命名规则"""
+    if filename.endswith((".jpg", ".png", ".gif")):
+        return filename
+    suffix = Path(filename).suffix
+    if suffix.lower() in IMAGE_SUFFIXES:
+        filename = filename[: -len(suffix)]
+    return filename + ".jpg"
+
+
+def _reader(path: Path) -> Callable[[], Awaitable[bytes]]:
+    async def read() -> bytes:
+        return await asyncio.to_thread(path.read_bytes)
+
+    return read
+
+
+_ZIP_LOCKS: dict[int, asyncio.Lock] = {}
+
+
+def _zip_reader(
+    archive: zipfile.ZipFile, member: str
+) -> Callable[[], Awaitable[bytes]]:
+    lock = _ZIP_LOCKS.setdefault(id(archive), asyncio.Lock())
+
+    async def read() -> bytes:
+        # ZipFile 不能并发读取
+        async with lock:
+            return await asyncio.to_thread(archive.read, member)
+
+    return read
+
+
+def _url_reader(url: str) -> Callable[[], Awaitable[bytes]]:
+    async def read() -> bytes:
+        return await load_pic(url)
+
+    return read
+
+
+def iter_source(src: Path, scope: str = "globe") -> Iterator[ImportItem]:
+    """列出导入来源中的图片
+
+    Parameters
+    ----------
+    src: Path
+        目录、.zip 文件或 .csv 清单。清单的列为 path,name,scope，
+        path 可以是 URL 或相对清单所在目录的路径，name / scope 可省略
+    scope: str
+        默认作用域
+    """
+    if src.is_dir():
+        for p in sorted(src.rglob("*")):
+            if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES:
+                yield ImportItem(p.as_posix(), pic_name(p.name), scope, _reader(p))
+    elif src.suffix.lower() == ".zip":
+        archive = zipfile.ZipFile(src)
+        for info in archive.infolist():
+            member = Path(info.filename)
+            if info.is_dir() or member.suffix.lower() not in IMAGE_SUFFIXES:
+                continue
+            yield ImportItem(
+                f"{src.name}:{info.filename}",
+                pic_name(member.name),
+                scope,
+                _zip_reader(archive, info.filename),
+            )
+    elif src.suffix.lower() == ".csv":
+        with open(src, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                path = (row.get("path") or "").strip()
+                if not path:
+                    continue
+                if path.startswith("http"):
+                    read = _url_reader(path)
+                    name = path.rsplit("/", 1)[-1].split("?", 1)[0]
+                else:
+                    p = src.parent / path
+                    read = _reader(p)
+                    name = p.name
+                yield ImportItem(
+                    path,
+                    pic_name((row.get("name") or "").strip() or name),
+                    (row.get("scope") or "").strip() or scope,
+                    read,
+                )
+    else:
+        raise ValueError(f"不支持的导入来源：{src}")
+
+
+class BulkImporter:
+    """并发导入图片
+
+    Parameters
+    ----------
+    uploader: str
+        记录的上传者
+    workers: int
+        并发数
+    batch_size: int
+        每批 COPY 的行数
+    allow_similar: bool
+        是否放行相似图片
+    """
+
+    def __init__(
+        self,
+        uploader: str = "import",
+        workers: int = 8,
+        batch_size: int = 200,
+        allow_similar: bool = False,
+    ):
+        self.uploader = uploader
+        self.workers = max(workers, 1)
+        self.batch_size = max(batch_size, 1)
+        self.allow_similar = allow_similar
+        self.pending: list[tuple[str, tuple]] = []
+        """(来源, picdata 的行)，列顺序与 COLUMNS 一致"""
+        self.names: set[tuple[str, str]] = set()
+        self.hashes: dict[str, set[str]] = {}
+        self.vectors: list[tuple[str, str, np.ndarray]] = []
+        """本次导入中尚未写入数据库的 (作用域, 名字, 向量)"""
+        self.phashes: list[tuple[str, str, int]] = []
+        """本次导入中尚未写入数据库的 (作用域, 名字, 感知哈希)"""
+        self.report: list[tuple[str, str, str]] = []
+        """(来源, 结果, 说明)"""
+        self.stats = {
+            "processed": 0,
+            "imported": 0,
+            "same_name": 0,
+            "duplicate": 0,
+            "similar": 0,
+            "no_vector": 0,
+            "failed": 0,
+        }
+        self._flush_lock = asyncio.Lock()
+        self._started = 0.0
+
+    def _record(self, item: ImportItem, status: str, detail: str = ""):
+        self.stats["processed"] += 1
+        if status in self.stats:
+            self.stats[status] += 1
+        if status != "imported":
+            self.report.append((item.source, status, detail))
+
+    async def _check(self, item: ImportItem, digest: str):
+        assert sql.POOL
+        async with sql.POOL.acquire() as conn:
+            return await conn.fetchrow(
+                "SELECT "
+                "EXISTS (SELECT 1 FROM picdata WHERE name = $1 AND scope @> ARRAY[$2]) "
+                "AS same_name, "
+                "(SELECT name FROM picdata WHERE hash = $3 "
+                "AND scope && ARRAY[$2, 'globe'] LIMIT 1) AS same_hash, "
+                "(SELECT vec FROM picdata WHERE hash = $3 "
+                "AND vec IS NOT NULL LIMIT 1) AS vec;",
+                item.name,
+                item.scope,
+                digest,
+            )
+
+    async def _similar_phash(
+        self, scope: str, phash: int
+    ) -> Optional[tuple[str, float]]:
+        distance = plugin_config.phash_distance
+        if distance < 0:
+            return None
+        for s, name, h in self.phashes:
+            if s in (scope, "globe") and hamming(h, phash) <= distance:
+                return name, 1 - hamming(h, phash) / 64
+        assert sql.POOL
+        async with sql.POOL.acquire() as conn:
+            row = await conn.fetchrow(
+                near_sql(distance), phash, scope, distance, *bands(phash)
+            )
+        if row:
+            return row["name"], 1 - row["d"] / 64
+        return None
+
+    async def _similar(
+        self, scope: str, vec: np.ndarray
+    ) -> Optional[tuple[str, float]]:
+        assert sql.POOL
+        async with sql.POOL.acquire() as conn:
+            rows = await VEC_SEARCH.nearest(conn, vec, scope, columns="name")
+        if rows and rows[0]["similarity"] >= 0.75:
+            return rows[0]["name"], rows[0]["similarity"]
+        return None
+
+    def _similar_pending(
+        self, scope: str, vec: np.ndarray
+    ) -> Optional[tuple[str, float]]:
+        candidates = [(name, v) for s, name, v in self.vectors if s in (scope, "globe")]
+        if not candidates:
+            return None
+        sims = np.stack([v for _, v in candidates]) @ vec
+        i = int(np.argmax(sims))
+        if sims[i] >= 0.75:
+            return candidates[i][0], float(sims[i])
+        return None
+
+    async def _process(self, item: ImportItem):
+        byte = await item.read()
+        digest = hashlib.sha256(byte).hexdigest()
+
+        key = (item.scope, item.name)
+        seen = self.hashes.get(digest, set())
+        if key in self.names:
+            return self._record(item, "same_name", item.name)
+        if item.scope in seen or "globe" in seen:
+            return self._record(item, "duplicate", digest)
+
+        row = await self._check(item, digest)
+        if row["same_name"]:
+            return self._record(item, "same_name", item.name)
+        if row["same_hash"]:
+            return self._record(item, "duplicate", row["same_hash"])
+
+        info = await image_info(byte)
+        if info.phash is not None and not self.allow_similar:
+            similar = await self._similar_phash(item.scope, info.phash)
+            if similar:
+                return self._record(
+                    item, "similar", f"{similar[0]} ({similar[1] * 100:.2f}%)"
+                )
+
+        vec = row["vec"]
+        if vec is None:
+            vec = await img2vec(byte, item.name)
+        if vec is not None:
+            vec = np.asarray(vec, dtype=np.float32)
+            if not self.allow_similar:
+                similar = await self._similar(item.scope, vec)
+                similar = similar or self._similar_pending(item.scope, vec)
+                if similar:
+                    return self._record(
+                        item, "similar", f"{similar[0]} ({similar[1] * 100:.2f}%)"
+                    )
+
+        # 等待期间其它协程可能登记了相同的名字或内容，登记前再查一次
+        seen = self.hashes.get(digest, set())
+        if key in self.names:
+            return self._record(item, "same_name", item.name)
+        if item.scope in seen or "globe" in seen:
+            return self._record(item, "duplicate", digest)
+        self.names.add(key)
+        self.hashes.setdefault(digest, set()).add(item.scope)
+        if vec is not None:
+            self.vectors.append((item.scope, item.name, vec))
+        if info.phash is not None:
+            self.phashes.append((item.scope, item.name, info.phash))
+
+        url = await write_bytes(byte, plugin_config.savepic_dir)
+        self.pending.append(
+            (
+                item.source,
+                (
+                    item.name,
+                    [item.scope],
+                    url,
+                    vec,
+                    self.uploader,
+                    digest,
+                    info.width,
+                    info.height,
+                    info.size,
+                    info.mime,
+                    info.frames,
+                    info.phash,
+                ),
+            )
+        )
+        if vec is None:
+            self.stats["no_vector"] += 1
+        self._record(item, "imported")
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """将待写入的行 COPY 进临时表，再合并进 picdata
+
+        合并失败时整批记为失败，不向调用者抛出异常。
+        """
+        async with self._flush_lock:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            batch = [r for _, r in pending]
+            error = None
+            try:
+                await self._merge(batch)
+            except Exception as e:
+                error = e
+                logger.error(f"批量写入 {len(batch)} 张图片失败: {e}")
+            finally:
+                # 写入成功的文件已被行引用，失败的则被删除
+                for r in batch:
+                    await release_pic(r[2])
+            # 已入库的向量由数据库负责判重，失败的也不再参与判重
+            written = {(r[1][0], r[0]) for r in batch}
+            self.vectors = [v for v in self.vectors if (v[0], v[1]) not in written]
+            self.phashes = [h for h in self.phashes if (h[0], h[1]) not in written]
+            if error is None:
+                return
+            for source, r in pending:
+                self.names.discard((r[1][0], r[0]))
+                if scopes := self.hashes.get(r[5]):
+                    scopes.discard(r[1][0])
+                    if not scopes:
+                        del self.hashes[r[5]]
+                self.stats["imported"] -= 1
+                self.stats["failed"] += 1
+                if r[3] is None:
+                    self.stats["no_vector"] -= 1
+                self.report.append((source, "failed", str(error)))
+
+    @staticmethod
+    def _dedupe(batch: list[tuple]) -> list[tuple]:
+        """相同内容导入多个作用域时 url 相同，合并为一行，作用域取并集
+
+        一条 INSERT ... ON CONFLICT 不能两次修改同一行。
+        """
+        rows: dict[str, tuple] = {}
+        for r in batch:
+            url = r[2]
+            if url not in rows:
+                rows[url] = r
+                continue
+            old = rows[url]
+            if "globe" in old[1] or "globe" in r[1]:
+                scope = ["globe"]
+            else:
+                scope = old[1] + [s for s in r[1] if s not in old[1]]
+            rows[url] = (old[0], scope, *old[2:])
+        return list(rows.values())
+
+    async def _merge(self, batch: list[tuple]):
+        assert sql.POOL
+        async with sql.POOL.acquire() as conn, conn.transaction():
+            await conn.execute(
+                "CREATE TEMP TABLE picdata_import "
+                "(LIKE picdata INCLUDING DEFAULTS) ON COMMIT DROP;"
+            )
+            await conn.copy_records_to_table(
+                "picdata_import", records=self._dedupe(batch), columns=COLUMNS
+            )
+            await conn.execute(
+                """
+INSERT INTO picdata (
+    name, scope, url, vec, uploader, hash, width, height, size, mime, frames, phash
+)
+SELECT
+    name, scope, url, vec, uploader, hash, width, height, size, mime, frames, phash
+FROM picdata_import
+ON CONFLICT (url) DO UPDATE
+SET
+    scope = CASE
+            WHEN EXCLUDED.scope @> ARRAY['globe']::text[]
+                THEN ARRAY['globe']::text[]
+            WHEN NOT (picdata.scope @> EXCLUDED.scope)
+                THEN picdata.scope || ARRAY(
+                    SELECT s FROM unnest(EXCLUDED.scope) AS s
+                    WHERE s <> ALL (picdata.scope)
+                )
+            ELSE picdata.scope
+            END,
+    vec   = COALESCE(EXCLUDED.vec, picdata.vec),
+    hash  = COALESCE(EXCLUDED.hash, picdata.hash),
+    width  = COALESCE(EXCLUDED.width, picdata.width),
+    height = COALESCE(EXCLUDED.height, picdata.height),
+    size   = COALESCE(EXCLUDED.size, picdata.size),
+    mime   = COALESCE(EXCLUDED.mime, picdata.mime),
+    frames = COALESCE(EXCLUDED.frames, picdata.frames),
+    phash  = COALESCE(EXCLUDED.phash, picdata.phash);"""
+            )
+
+    def progress(self) -> str:
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        s = self.stats
+        return (
+            f"已处理 {s['processed']}，导入 {s['imported']}，重名 {s['same_name']}，"
+            f"重复 {s['duplicate']}，相似 {s['similar']}，失败 {s['failed']}，"
+            f"{s['processed'] / elapsed:.1f} 张/秒"
+        )
+
+    async def run(self, items: Iterator[ImportItem], report_every: float = 5.0):
+        """导入所有图片，定期输出进度"""
+        self._started = time.monotonic()
+        queue: asyncio.Queue[Optional[ImportItem]] = asyncio.Queue(self.workers * 4)
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                try:
+                    await self._process(item)
+                except Exception as e:
+                    self._record(item, "failed", str(e))
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(report_every)
+                logger.info(self.progress())
+
+        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        progress = asyncio.create_task(reporter())
+        try:
+            for item in items:
+                await queue.put(item)
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+            await self.flush()
+        finally:
+            progress.cancel()
+        logger.info("导入完成：" + self.progress())
+        return self.stats
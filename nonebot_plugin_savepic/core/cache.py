@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import asyncpg
+import unicodedata
+import numpy as np
+
+from typing import Optional
+from collections import OrderedDict
+from nonebot import logger
+
+from .listen import PicSubscriber
+from .metrics import METRICS
+from ..config import plugin_config
+
+
+class NameIndex(PicSubscriber):
+    """作用域 -> 名字 -> URL 的内存索引，用于加速按名字取图
+
+    同一作用域下理论上不会有重名，但数据库没有约束，所以值是 URL 列表。
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.data: dict[str, dict[str, list[str]]] = {}
+
+    async def reload(self, conn: asyncpg.Connection):
+        self.ready = False
+        data: dict[str, dict[str, list[str]]] = {}
+        async with conn.transaction():
+            async for r in conn.cursor("SELECT name, scope, url FROM picdata;"):
+                for s in r["scope"]:
+                    data.setdefault(s, {}).setdefault(r["name"], []).append(r["url"])
+        self.data = data
+        self.ready = True
+
+    def _add(self, row: dict):
+        for s in row["scope"]:
+            urls = self.data.setdefault(s, {}).setdefault(row["name"], [])
+            if row["url"] not in urls:
+                urls.append(row["url"])
+
+    def _remove(self, row: dict):
+        for s in row["scope"]:
+            names = self.data.get(s)
+            if not names or row["name"] not in names:
+                continue
+            urls = names[row["name"]]
+            if row["url"] in urls:
+                urls.remove(row["url"])
+            if not urls:
+                del names[row["name"]]
+
+    def apply(self, op: str, old: Optional[dict], new: Optional[dict]):
+        if old:
+            self._remove(old)
+        if new:
+            self._add(new)
+
+    def select(self, name: str, scope: str, strict: bool = False) -> Optional[str]:
+        """与 sql.select_pic 语义相同：先查本域，再查全局"""
+        urls = self.data.get(scope, {}).get(name)
+        if urls:
+            return urls[0]
+        if strict:
+            return None
+        urls = self.data.get("globe", {}).get(name)
+        return urls[0] if urls else None
+
+
+class ScopeCounter(PicSubscriber):
+    """按作用域统计图片总数，随变更通知增量维护"""
+
+    def __init__(self):
+        self.ready = False
+        self.totals: dict[str, int] = {}
+        """scope -> 图片数"""
+        self.with_globe: dict[str, int] = {}
+        """scope -> 同时属于全局的图片数，用于去重"""
+
+    async def reload(self, conn: asyncpg.Connection):
+        self.ready = False
+        totals: dict[str, int] = {}
+        with_globe: dict[str, int] = {}
+        for r in await conn.fetch(
+            "SELECT s, COUNT(*) AS total, "
+            "COUNT(*) FILTER (WHERE scope @> ARRAY['globe']) AS with_globe "
+            "FROM picdata, unnest(scope) AS s GROUP BY s;"
+        ):
+            totals[r["s"]] = r["total"]
+            with_globe[r["s"]] = r["with_globe"]
+        self.totals = totals
+        self.with_globe = with_globe
+        self.ready = True
+
+    def _add(self, scope: list[str], delta: int):
+        globe = "globe" in scope
+        for s in scope:
+            self.totals[s] = self.totals.get(s, 0) + delta
+            if globe:
+                self.with_globe[s] = self.with_globe.get(s, 0) + delta
+
+    def apply(self, op: str, old: Optional[dict], new: Optional[dict]):
+        if old:
+            self._add(old["scope"], -1)
+        if new:
+            self._add(new["scope"], 1)
+
+    def count(self, scope: str) -> int:
+        """本域与全局图片数（去重）"""
+        globe = self.totals.get("globe", 0)
+        if scope == "globe":
+            return globe
+        return self.totals.get(scope, 0) + globe - self.with_globe.get(scope, 0)
+
+
+class TextEmbeddingCache:
+    """文本嵌入的两级缓存：内存 LRU（按字节限制） + 数据库表 text_embedding
+
+    键为 (模型, 均值向量指纹, 规范化后的文本)，模型或均值向量变化后旧条目自动失效。
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.data: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.model = ""
+        self.mean = ""
+        self.pool: Optional[asyncpg.Pool] = None
+        self._tasks: set[asyncio.Task] = set()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+
+    @staticmethod
+    def fingerprint(mean: Optional[np.ndarray]) -> str:
+        if mean is None:
+            return ""
+        return hashlib.sha256(np.asarray(mean, dtype="<f8").tobytes()).hexdigest()[:16]
+
+    async def bind(
+        self,
+        pool: asyncpg.Pool,
+        model: str,
+        mean: Optional[np.ndarray],
+    ):
+        """绑定主库连接池并清理失效的条目，在 init_db 中调用"""
+        self.model = model
+        self.mean = self.fingerprint(mean)
+        self.data.clear()
+        self.nbytes = 0
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS text_embedding (\n"
+                "  model text NOT NULL, \n"
+                "  mean  text NOT NULL, \n"
+                "  text  text NOT NULL, \n"
+                "  vec   halfvec NOT NULL, \n"
+                "  PRIMARY KEY (model, mean, text) \n"
+                ");"
+            )
+            deleted = await conn.execute(
+                "DELETE FROM text_embedding WHERE model <> $1 OR mean <> $2;",
+                self.model,
+                self.mean,
+            )
+            logger.info(f"文本嵌入缓存已就绪，清理失效条目：{deleted}")
+        self.pool = pool
+
+    def _remember(self, key: str, vec: np.ndarray):
+        if key in self.data:
+            self.nbytes -= self.data.pop(key).nbytes
+        self.data[key] = vec
+        self.nbytes += vec.nbytes
+        while self.nbytes > self.max_bytes and self.data:
+            self.nbytes -= self.data.popitem(last=False)[1].nbytes
+
+    async def get(self, text: str) -> Optional[np.ndarray]:
+        key = self.normalize(text)
+        if (vec := self.data.get(key)) is not None:
+            self.data.move_to_end(key)
+            self.memory_hits += 1
+            return vec.copy()
+        if self.pool is not None:
+            async with self.pool.acquire() as conn:
+                vec = await conn.fetchval(
+                    "SELECT vec FROM text_embedding "
+                    "WHERE model = $1 AND mean = $2 AND text = $3;",
+                    self.model,
+                    self.mean,
+                    key,
+                )
+            if vec is not None:
+                vec = np.asarray(vec, dtype=np.float32)
+                self._remember(key, vec)
+                self.db_hits += 1
+                return vec.copy()
+        self.misses += 1
+        return None
+
+    def put(self, text: str, vec: np.ndarray):
+        """写入缓存，数据库写入在后台进行"""
+        key = self.normalize(text)
+        self._remember(key, np.asarray(vec, dtype=np.float32))
+        if self.pool is None:
+            return
+        task = asyncio.create_task(self._store(key, vec))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _store(self, key: str, vec: np.ndarray):
+        assert self.pool is not None
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute(
+                    "INSERT INTO text_embedding (model, mean, text, vec) "
+                    "VALUES ($1, $2, $3, $4) "
+                    "ON CONFLICT (model, mean, text) DO UPDATE SET vec = EXCLUDED.vec;",
+                    self.model,
+                    self.mean,
+                    key,
+                    vec,
+                )
+        except Exception as e:
+            logger.warning(f"文本嵌入缓存写入失败: {e}")
+
+    def stats(self) -> dict[str, float]:
+        """条目数、字节数与命中率，用于调整 text_cache_bytes"""
+        total = self.memory_hits + self.db_hits + self.misses
+        return {
+            "entries": len(self.data),
+            "bytes": self.nbytes,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.db_hits) / total if total else 0.0,
+            "memory_hit_rate": self.memory_hits / total if total else 0.0,
+            "db_hit_rate": self.db_hits / total if total else 0.0,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (
+            f"[文本嵌入缓存] {s['entries']:g} 条 {s['bytes'] / 1048576:.1f} MiB，"
+            f"命中率 {s['hit_rate']:.1%}（内存 {s['memory_hit_rate']:.1%}，"
+            f"数据库 {s['db_hit_rate']:.1%}），未命中 {s['misses']:g}"
+        )
+
+
+NAME_INDEX = NameIndex()
+SCOPE_COUNTER = ScopeCounter()
+TEXT_CACHE = TextEmbeddingCache(plugin_config.text_cache_bytes)
+METRICS.component("text_cache", TEXT_CACHE.stats)
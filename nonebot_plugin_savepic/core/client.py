@@ -0,0 +1,101 @@
+"""
+进程内共享的 httpx 客户端，复用 TCP/TLS 连接。
+
+httpx 的连接池本身就是按 (scheme, host, port) 分别保持 keep-alive 的，
+所以全进程只需要一个客户端。
+"""
+
+import httpx
+
+from typing import Optional
+from nonebot import get_driver, logger
+
+from .metrics import METRICS
+from ..config import plugin_config
+
+
+class ClientManager:
+    """管理共享的 httpx.AsyncClient，并统计请求情况"""
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.errors = 0
+
+    def _create(self) -> httpx.AsyncClient:
+        http2 = plugin_config.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("未安装 h2，无法启用 HTTP/2，改用 HTTP/1.1")
+                http2 = False
+
+        async def on_request(request: httpx.Request):
+            self.requests += 1
+
+        async def on_response(response: httpx.Response):
+            if response.is_error:
+                self.errors += 1
+
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=plugin_config.http_max_connections,
+                max_keepalive_connections=plugin_config.http_max_keepalive,
+                keepalive_expiry=plugin_config.http_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                plugin_config.http_timeout,
+                connect=min(plugin_config.http_timeout, 5.0),
+            ),
+            event_hooks={"request": [on_request], "response": [on_response]},
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """共享客户端，未启动（例如脱离 bot 使用）时惰性创建"""
+        if self._client is None or self._client.is_closed:
+            self._client = self._create()
+        return self._client
+
+    async def close(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    def stats(self) -> dict[str, int]:
+        """连接池统计：总连接数、空闲连接数、请求数、错误响应数"""
+        ret = {
+            "connections": 0,
+            "idle": 0,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+        if self._client is None:
+            return ret
+        # httpcore 的连接池没有公开的统计接口，只能从内部取
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        for conn in getattr(pool, "connections", []):
+            ret["connections"] += 1
+            if conn.is_idle():
+                ret["idle"] += 1
+        return ret
+
+
+CLIENT = ClientManager()
+METRICS.component("http_client", CLIENT.stats)
+
+
+def get_client() -> httpx.AsyncClient:
+    return CLIENT.client
+
+
+@get_driver().on_startup
+async def _():
+    CLIENT.client
+
+
+@get_driver().on_shutdown
+async def _():
+    await CLIENT.close()
@@ -0,0 +1,53 @@
+"""
+pgvector 的 halfvec / vector 二进制编解码，避免 str(vec.tolist()) 的文本往返。
+
+二进制格式（大端）：
+    halfvec: uint16 维度, uint16 保留, float16 * 维度
+    vector:  uint16 维度, uint16 保留, float32 * 维度
+"""
+
+import struct
+import asyncpg
+import numpy as np
+
+from nonebot import logger
+
+
+_HEADER = struct.Struct(">HH")
+
+
+def _encoder(dtype: str):
+    def encode(value) -> bytes:
+        arr = np.asarray(value, dtype=dtype)
+        if arr.ndim != 1:
+            raise ValueError(f"向量必须是一维的，实际为 {arr.shape}")
+        return _HEADER.pack(arr.shape[0], 0) + arr.tobytes()
+
+    return encode
+
+
+def _decoder(dtype: str):
+    def decode(data: bytes) -> np.ndarray:
+        dim, _ = _HEADER.unpack_from(data)
+        # 直接在返回的 buffer 上建立视图，不复制
+        return np.frombuffer(data, dtype=dtype, count=dim, offset=_HEADER.size)
+
+    return decode
+
+
+async def register_vector_codecs(conn: asyncpg.Connection):
+    """在连接上注册 halfvec / vector 的二进制编解码，作为连接池的 init 回调
+
+    vector 扩展尚未安装时静默跳过。
+    """
+    for typename, dtype in (("halfvec", ">f2"), ("vector", ">f4")):
+        try:
+            await conn.set_type_codec(
+                typename,
+                schema="public",
+                encoder=_encoder(dtype),
+                decoder=_decoder(dtype),
+                format="binary",
+            )
+        except ValueError:
+            logger.debug(f"数据库中没有 {typename} 类型，跳过编解码注册")
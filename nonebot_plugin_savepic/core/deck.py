@@ -0,0 +1,160 @@
+"""
+随机抽图用的洗牌牌堆。
+
+每个 (作用域, 过滤条件) 对应一副洗好的牌（本域 + 全局的图片 URL），每次从末尾取一张，
+抽完再重新洗牌。这样抽取是 O(1) 的，并且一轮之内不会重复。
+
+新增的图片随机插入到剩余的牌中；删除、改名、换域则在抽取时惰性校验。
+正则过滤的牌堆由数据库给出候选（不在事件循环里跑用户给的正则），
+相关的图片有变动时整副作废，下次抽取时重新查询。
+"""
+
+import random
+import asyncpg
+
+from typing import Optional
+from collections import OrderedDict
+
+from .types import PicData
+from .listen import PicSubscriber
+
+
+DeckKey = tuple[str, str, str]
+"""(作用域, 过滤方式, 过滤条件)，过滤方式为 "" / "like" / "regex" """
+
+
+class RandomDeck(PicSubscriber):
+    """按作用域维护的洗牌牌堆"""
+
+    def __init__(self, max_decks: int = 256):
+        self.ready = False
+        self.max_decks = max_decks
+        self.rows: dict[str, tuple[str, list[str]]] = {}
+        """url -> (name, scope)"""
+        self.members: dict[str, set[str]] = {}
+        """scope -> url 集合"""
+        self.decks: OrderedDict[DeckKey, list[str]] = OrderedDict()
+        self.sources: dict[DeckKey, list[str]] = {}
+        """正则牌堆的候选 URL，由数据库查询得到"""
+        self.last: dict[DeckKey, str] = {}
+
+    async def reload(self, conn: asyncpg.Connection):
+        self.ready = False
+        rows: dict[str, tuple[str, list[str]]] = {}
+        members: dict[str, set[str]] = {}
+        async with conn.transaction():
+            async for r in conn.cursor("SELECT name, scope, url FROM picdata;"):
+                rows[r["url"]] = (r["name"], list(r["scope"]))
+                for s in r["scope"]:
+                    members.setdefault(s, set()).add(r["url"])
+        self.rows = rows
+        self.members = members
+        self.decks.clear()
+        self.sources.clear()
+        self.last.clear()
+        self.ready = True
+
+    @staticmethod
+    def key(scope: str, like: str = "", regex: str = "") -> DeckKey:
+        if regex:
+            return (scope, "regex", regex)
+        if like:
+            return (scope, "like", like.lower())
+        return (scope, "", "")
+
+    def _visible(self, key: DeckKey, scope: list[str]) -> bool:
+        return key[0] in scope or "globe" in scope
+
+    def _eligible(self, key: DeckKey, name: str, scope: list[str]) -> bool:
+        if not self._visible(key, scope):
+            return False
+        # 正则牌堆的候选来自数据库，有变动时在 apply 中整副作废
+        return key[1] != "like" or key[2] in name.lower()
+
+    def _drop(self, key: DeckKey):
+        self.decks.pop(key, None)
+        self.sources.pop(key, None)
+        self.last.pop(key, None)
+
+    def apply(self, op: str, old: Optional[dict], new: Optional[dict]):
+        if old:
+            self.rows.pop(old["url"], None)
+            for s in old["scope"]:
+                self.members.get(s, set()).discard(old["url"])
+        if new:
+            self.rows[new["url"]] = (new["name"], list(new["scope"]))
+            for s in new["scope"]:
+                self.members.setdefault(s, set()).add(new["url"])
+
+        for key in list(self.decks):
+            if key[1] == "regex":
+                if (new and self._visible(key, new["scope"])) or (
+                    old and self._visible(key, old["scope"])
+                ):
+                    self._drop(key)
+                continue
+            if not new or not self._eligible(key, new["name"], new["scope"]):
+                continue
+            if old and self._eligible(key, old["name"], old["scope"]):
+                continue
+            # 放到末尾再与随机位置交换，相当于随机插入剩余的牌中
+            deck = self.decks[key]
+            deck.append(new["url"])
+            i = random.randrange(len(deck))
+            deck[i], deck[-1] = deck[-1], deck[i]
+
+    def _build(self, key: DeckKey) -> list[str]:
+        if key[1] == "regex":
+            urls = self.sources.get(key, [])
+        else:
+            urls = self.members.get(key[0], set()) | self.members.get("globe", set())
+        deck = [
+            u for u in urls if u in self.rows and self._eligible(key, *self.rows[u])
+        ]
+        random.shuffle(deck)
+        # 避免新一轮的第一张与上一轮最后一张相同
+        if len(deck) > 1 and deck[-1] == self.last.get(key):
+            deck[0], deck[-1] = deck[-1], deck[0]
+        return deck
+
+    def has(self, key: DeckKey) -> bool:
+        """牌堆是否存在；正则牌堆需要先用 fill 填入数据库查询到的候选"""
+        return key[1] != "regex" or key in self.sources
+
+    def fill(self, key: DeckKey, urls: list[str]):
+        self._drop(key)
+        self.sources[key] = urls
+
+    def draw(self, key: DeckKey) -> Optional[PicData]:
+        """抽一张图
+
+        Parameters
+        ----------
+        key: DeckKey
+            由 RandomDeck.key 生成
+
+        Returns
+        -------
+        Optional[PicData]
+            图片数据，没有符合条件的图片时为 None
+        """
+        deck = self.decks.get(key)
+        rebuilt = deck is None
+        if deck is None:
+            deck = self.decks[key] = self._build(key)
+            while len(self.decks) > self.max_decks:
+                self._drop(next(iter(self.decks)))
+        self.decks.move_to_end(key)
+
+        while True:
+            if not deck:
+                if rebuilt:
+                    return None
+                deck = self.decks[key] = self._build(key)
+                rebuilt = True
+                continue
+            url = deck.pop()
+            row = self.rows.get(url)
+            if row and self._eligible(key, *row):
+                self.last[key] = url
+                return PicData(name=row[0], scope=row[1], url=url)
@@ -0,0 +1,285 @@
+"""
+发送用的衍生图缓存。
+
+原图超过 derivative_threshold 字节时，在进程池里生成一份缩小 / 重新压缩的衍生图，
+保存在 savepic_dir/.derived/ 下（文件名沿用原图的 SHA-256），之后发送衍生图。
+动图逐帧缩放，仍然过大时隔帧抽取；静态图缩放后按质量递减重新编码。
+衍生图不比原图小、或生成失败时写入一个空文件作为标记，以后直接发送原图。
+
+缓存总大小超过 derivative_cache_bytes 时按最近使用时间淘汰，
+最近 SEND_GRACE 秒内交给发送方的衍生图暂不删除，避免发送途中文件消失。
+生成需要 Pillow，未安装时总是发送原图。
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+
+from io import BytesIO
+from typing import Optional
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from nonebot import get_driver, logger
+
+from .storage import STORE
+from .metrics import METRICS
+from ..config import plugin_config
+
+
+DERIVED_DIR = ".derived"
+SEND_GRACE = 300.0
+"""返回给发送方后，衍生图至少保留的秒数"""
+
+
+def _fit(image, max_side: int):
+    if max(image.size) <= max_side:
+        return image.copy()
+    scale = max_side / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size)
+
+
+def _encode_gif(image, max_side: int, target: int) -> bytes:
+    from PIL import ImageSequence
+
+    frames = []
+    durations = []
+    for frame in ImageSequence.Iterator(image):
+        frames.append(_fit(frame.convert("RGBA"), max_side))
+        durations.append(frame.info.get("duration", image.info.get("duration", 100)))
+    step = 1
+    while True:
+        out = BytesIO()
+        picked = frames[::step]
+        # 抽帧后把被跳过的帧的时长加到保留的帧上，保持播放速度
+        merged = [sum(durations[i : i + step]) for i in range(0, len(frames), step)]
+        picked[0].save(
+            out,
+            format="GIF",
+            save_all=True,
+            append_images=picked[1:],
+            duration=merged,
+            loop=image.info.get("loop", 0),
+            disposal=2,
+            optimize=True,
+        )
+        if out.tell() <= target or len(picked) <= 2:
+            return out.getvalue()
+        step *= 2
+
+
+def _encode_still(image, max_side: int, target: int) -> bytes:
+    image = _fit(image, max_side)
+    out = BytesIO()
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        # 有透明通道时 JPEG 会丢失透明度，改用 PNG
+        image.save(out, format="PNG", optimize=True)
+        return out.getvalue()
+    image = image.convert("RGB")
+    for quality in (85, 75, 65, 55):
+        out = BytesIO()
+        image.save(out, format="JPEG", quality=quality, optimize=True)
+        if out.tell() <= target:
+            break
+    return out.getvalue()
+
+
+def make_derivative(src: str, dest: str, max_side: int, target: int) -> int:
+    """生成衍生图，在 worker 中运行，返回写入的字节数（0 表示沿用原图）"""
+    from PIL import Image
+
+    original = os.path.getsize(src)
+    with Image.open(src) as image:
+        if getattr(image, "is_animated", False):
+            data = _encode_gif(image, max_side, target)
+        else:
+            data = _encode_still(image, max_side, target)
+    if len(data) >= original:
+        data = b""
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, dest)
+    return len(data)
+
+
+class DerivativeCache:
+    """按需生成并缓存发送用的衍生图"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.root = STORE.root / DERIVED_DIR
+        self.entries: Optional[OrderedDict[str, int]] = None
+        """衍生图路径 -> 字节数，按最近使用排序"""
+        self.nbytes = 0
+        self._pending: dict[str, asyncio.Task] = {}
+        self._served: dict[str, float] = {}
+        """衍生图路径 -> 最近一次返回给发送方的时间（time.monotonic）"""
+        self._executor: Optional[Executor] = None
+        self._disabled = False
+        self.hits = 0
+        self.misses = 0
+
+    def _scan(self) -> OrderedDict[str, int]:
+        files = []
+        if self.root.exists():
+            for p in self.root.rglob("*"):
+                if p.is_file() and not p.name.endswith(".tmp"):
+                    st = p.stat()
+                    files.append((st.st_mtime, p.as_posix(), st.st_size))
+        files.sort()
+        return OrderedDict((path, size) for _, path, size in files)
+
+    async def _load(self):
+        if self.entries is None:
+            self.entries = await asyncio.to_thread(self._scan)
+            self.nbytes = sum(self.entries.values())
+
+    def _path(self, url: str) -> Path:
+        name = Path(url).name
+        if len(name) != 64:
+            name = hashlib.sha256(url.encode()).hexdigest()
+        return self.root / name[:2] / name
+
+    def _touch(self, path: str):
+        assert self.entries is not None
+        self.entries.move_to_end(path)
+        try:
+            # 重启后按修改时间恢复 LRU 顺序
+            os.utime(path)
+        except OSError:
+            pass
+
+    async def _evict(self):
+        assert self.entries is not None
+        now = time.monotonic()
+        self._served = {
+            k: v for k, v in self._served.items() if v + SEND_GRACE > now
+        }
+        victims = []
+        for path, size in self.entries.items():
+            if self.nbytes <= self.max_bytes:
+                break
+            if path in self._served:
+                # 可能还在发送中，超出的部分留到下次淘汰
+                continue
+            self.nbytes -= size
+            victims.append(path)
+        for path in victims:
+            del self.entries[path]
+        for path in victims:
+            await asyncio.to_thread(Path(path).unlink, True)
+
+    async def _generate(self, url: str, dest: Path):
+        if self._executor is None:
+            workers = plugin_config.derivative_workers
+            self._executor = (
+                ProcessPoolExecutor(workers) if workers > 0 else ThreadPoolExecutor(1)
+            )
+        await asyncio.to_thread(dest.parent.mkdir, parents=True, exist_ok=True)
+        try:
+            size = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                make_derivative,
+                url,
+                dest.as_posix(),
+                plugin_config.derivative_max_side,
+                plugin_config.derivative_target_bytes,
+            )
+        except ImportError:
+            raise
+        except Exception as e:
+            # 原图无法解码等情况下记下空标记，不再每次发送都重新生成
+            logger.warning(f"生成衍生图失败，以后发送原图: {url}, {e}")
+            METRICS.count("derivative_failed")
+            await asyncio.to_thread(dest.write_bytes, b"")
+            size = 0
+        assert self.entries is not None
+        self.entries[dest.as_posix()] = size
+        self.nbytes += size
+        await self._evict()
+
+    async def get(self, url: str) -> str:
+        """返回发送时应使用的路径：衍生图，或原图
+
+        Parameters
+        ----------
+        url: str
+            原图 URL 或本地路径
+        """
+        if self._disabled or url.startswith("http"):
+            return url
+        try:
+            size = (await asyncio.to_thread(os.stat, url)).st_size
+        except OSError:
+            return url
+        if size <= plugin_config.derivative_threshold:
+            return url
+
+        await self._load()
+        assert self.entries is not None
+        dest = self._path(url)
+        key = dest.as_posix()
+        if key not in self.entries:
+            self.misses += 1
+            task = self._pending.get(key)
+            if task is None:
+                task = asyncio.create_task(self._generate(url, dest))
+                self._pending[key] = task
+                task.add_done_callback(lambda t: self._finished(key, url, t))
+            try:
+                # 生成太慢就先发原图，生成在后台继续
+                await asyncio.wait_for(
+                    asyncio.shield(task), plugin_config.derivative_wait
+                )
+            except Exception:
+                # 超时或失败都发原图，失败的处理在 _finished 中
+                return url
+        else:
+            self.hits += 1
+        if key not in self.entries:
+            return url
+        self._touch(key)
+        if self.entries[key] == 0:
+            return url
+        self._served[key] = time.monotonic()
+        return key
+
+    def _finished(self, key: str, url: str, task: asyncio.Task):
+        """生成结束时的回调，等待超时后在后台结束的任务也经过这里"""
+        self._pending.pop(key, None)
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is None:
+            return
+        if isinstance(e, ImportError):
+            if not self._disabled:
+                self._disabled = True
+                logger.warning("未安装 Pillow，无法生成衍生图，发送原图")
+            return
+        logger.warning(f"生成衍生图失败，发送原图: {url}, {e}")
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries or {}),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+DERIVATIVES = DerivativeCache(plugin_config.derivative_cache_bytes)
+METRICS.component("derivatives", DERIVATIVES.stats)
+
+
+@get_driver().on_shutdown
+async def _():
+    DERIVATIVES.close()
@@ -0,0 +1,169 @@
+"""
+嵌入请求的合并调度。
+
+- 相同的输入在请求未完成前只发一次，结果分发给所有等待者；
+- embedding_batch_size > 1 时，在 embedding_batch_window 内收集单段输入，
+  合并成一次请求（要求接口对 input 列表逐项返回 data: [{index, embedding}]）。
+
+多段输入（例如 标题 + 图片）：
+- 不合并时整体发送，由多模态接口融合为一个向量；
+- 合并时，支持的提供者（fuse_batch）整体放进批次；否则批量接口只会逐项返回向量，
+  因此各段拆成单段输入分别参与合并，再像本地模型一样在客户端融合
+  （各段的单位向量求和后归一化）。补全向量与批量导入的 标题 + 图片 也因此能被合并。
+
+实际的计算由 provider.py 中的提供者完成，返回的向量会被调整为 VECTOR_DIM 维。
+"""
+
+import json
+import asyncio
+import numpy as np
+
+from typing import Optional
+from nonebot import get_driver
+from nonebot.log import logger
+
+from .metrics import METRICS
+from .provider import EmbeddingProvider, create_provider, fit_dimension
+from ..config import plugin_config
+
+
+_Item = tuple[str, list[dict], asyncio.Future]
+
+
+class EmbeddingDispatcher:
+    """合并并发的嵌入请求"""
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._queue: list[_Item] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+        self.requests = 0
+        """调用 embed 的次数"""
+        self.deduped = 0
+        """因为输入相同而被合并掉的次数"""
+        self.calls = 0
+        """实际调用提供者的次数"""
+        self._provider: Optional[EmbeddingProvider] = None
+
+    @property
+    def provider(self) -> EmbeddingProvider:
+        """嵌入提供者，首次使用时按配置创建"""
+        if self._provider is None:
+            self._provider = create_provider()
+        return self._provider
+
+    async def close(self):
+        if self._provider is not None:
+            await self._provider.close()
+            self._provider = None
+
+    async def embed(self, input: list[dict]) -> Optional[np.ndarray]:
+        """获取一个输入的嵌入向量，失败返回 None
+
+        Parameters
+        ----------
+        input: list[dict]
+            接口的 input 字段，多段会被融合为一个向量
+        """
+        self.requests += 1
+        key = json.dumps(input, sort_keys=True, ensure_ascii=False)
+        if fut := self._inflight.get(key):
+            self.deduped += 1
+            METRICS.count("embedding_deduped")
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        fut.add_done_callback(lambda f: self._forget(key, f))
+
+        size = plugin_config.embedding_batch_size
+        if size <= 1 or plugin_config.embedding_batch_window <= 0:
+            self._spawn([(key, input, fut)])
+        elif len(input) != 1 and not self.provider.fuse_batch:
+            self._split(input, fut)
+        else:
+            self._queue.append((key, input, fut))
+            if len(self._queue) >= size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(
+                    plugin_config.embedding_batch_window, self._flush
+                )
+        return await asyncio.shield(fut)
+
+    def _split(self, input: list[dict], fut: asyncio.Future):
+        """多段输入拆成单段分别请求，完成后融合，结果写入 fut"""
+
+        async def run():
+            ret = None
+            try:
+                parts = await asyncio.gather(*(self.embed([p]) for p in input))
+                if all(p is not None for p in parts):
+                    ret = _fuse(parts)
+            finally:
+                # 出错或被取消时也要让等待者拿到结果
+                if not fut.done():
+                    fut.set_result(ret)
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _forget(self, key: str, fut: asyncio.Future):
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        queue, self._queue = self._queue, []
+        size = max(plugin_config.embedding_batch_size, 1)
+        for i in range(0, len(queue), size):
+            self._spawn(queue[i : i + size])
+
+    def _spawn(self, batch: list[_Item]):
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @METRICS.timed("embedding")
+    async def _send(self, batch: list[_Item]):
+        self.calls += 1
+        if METRICS.enabled:
+            METRICS.embed_batch.observe(len(batch))
+        try:
+            try:
+                results = list(await self.provider.embed([item[1] for item in batch]))
+            except Exception as e:
+                logger.warning(f"Network seems down, cannot access internet: {e}")
+                METRICS.count("embedding_failed", len(batch))
+                results = [None] * len(batch)
+            if len(results) != len(batch):
+                logger.warning(
+                    f"嵌入接口返回了 {len(results)} 个结果，请求了 {len(batch)} 个"
+                )
+                METRICS.count("embedding_failed", abs(len(batch) - len(results)))
+            for (_, _, fut), ret in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(None if ret is None else fit_dimension(ret))
+        finally:
+            # 结果缺失、处理出错或被取消时，也不能让等待者一直挂起
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+
+
+def _fuse(parts: list[np.ndarray]) -> np.ndarray:
+    """各段的单位向量求和后归一化，与本地模型融合多段输入的方式一致"""
+    ret = sum(p / np.linalg.norm(p) for p in parts)
+    return ret / np.linalg.norm(ret)
+
+
+DISPATCHER = EmbeddingDispatcher()
+
+
+@get_driver().on_shutdown
+async def _():
+    await DISPATCHER.close()
@@ -17,6 +17,19 @@ class SimilarPictureException(Exception):
         return "Picture {} is similar to {}%".format(self.name, self.similarity * 100)
 
 
+class NearDuplicateException(SimilarPictureException):
+    """感知哈希相近，只是相似，不表示内容相同"""
+
+    def __init__(self, name, distance: int, url: str):
+        super().__init__(name, 1 - distance / 64, url)
+        self.distance = distance
+
+    def __str__(self):
+        return "Picture {} is within phash distance {}".format(
+            self.name, self.distance
+        )
+
+
 class NoPictureException(Exception):
     def __init__(self, name):
         self.name = name
@@ -32,3 +45,12 @@ class PermissionException(Exception):
 
     def __str__(self):
         return "No permission to access {}: {}".format(self.name, self.reason)
+
+
+class DownloadLimitException(Exception):
+    def __init__(self, url, reason):
+        self.url = url
+        self.reason = reason
+
+    def __str__(self):
+        return "Picture {} is too large to download: {}".format(self.url, self.reason)
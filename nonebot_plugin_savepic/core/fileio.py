@@ -1,43 +1,191 @@
-import httpx
+import os
+import mmap
+import asyncio
 import hashlib
 import pathlib
+import tempfile
+import contextlib
+
+from typing import Iterator, Optional
+
+from .error import DownloadLimitException
+from .client import get_client
+from .metrics import METRICS
+from .storage import STORE, PicStore, store_for, store_of
+from ..config import plugin_config
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StagedPic:
+    """下载（或定位）完成、已经算好 SHA-256 的图片，还没有放进存储
+
+    远程图片被流式写入存储目录下的临时文件，本地图片直接引用原文件。
+    调用方可以 read / open / mmap 它，最后 commit 进存储或 discard。
+    """
+
+    def __init__(self, path: pathlib.Path, digest: str, size: int, temp: bool):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.temp = temp
+        """path 是否是本次下载的临时文件"""
+
+    async def read(self) -> bytes:
+        return await asyncio.to_thread(self.path.read_bytes)
+
+    def open(self):
+        """以二进制只读方式打开（阻塞，适合在线程中流式读取）"""
+        return open(self.path, "rb")
+
+    @contextlib.contextmanager
+    def mmap(self) -> Iterator[memoryview]:
+        """只读映射文件内容，不复制"""
+        with open(self.path, "rb") as f:
+            if self.size == 0:
+                yield memoryview(b"")
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    yield view
+                finally:
+                    view.release()
+
+    async def commit(self, store: PicStore = STORE) -> str:
+        """放进存储并 pin 住，返回保存路径；之后需调用 release_pic"""
+        path = await store.adopt(self.path, self.digest, move=self.temp)
+        self.temp = False
+        return path
+
+    async def discard(self):
+        if self.temp:
+            await asyncio.to_thread(self.path.unlink, True)
+            self.temp = False
+
+
+def _hash_file(path: pathlib.Path, max_bytes: int) -> tuple[str, int]:
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise DownloadLimitException(path.as_posix(), f"超过 {max_bytes} 字节")
+            h.update(chunk)
+    return h.hexdigest(), size
+
+
+@METRICS.timed("fetch_pic")
+async def fetch_pic(
+    url: str, max_bytes: Optional[int] = None, timeout: Optional[float] = None
+) -> StagedPic:
+    """流式获取图片，边下载边计算 SHA-256
+
+    Parameters
+    ----------
+    url: str
+        http(s) 地址或本地路径
+    max_bytes: Optional[int]
+        大小上限，默认为 download_max_bytes，0 表示不限制
+    timeout: Optional[float]
+        整个下载的时间上限（秒），默认为 download_timeout，0 表示不限制
+
+    Exceptions
+    ----------
+    DownloadLimitException
+        超过大小或时间上限
+    """
+    if max_bytes is None:
+        max_bytes = plugin_config.download_max_bytes
+    if timeout is None:
+        timeout = plugin_config.download_timeout
+
+    if not url.startswith("http"):
+        path = pathlib.Path(url)
+        if not await asyncio.to_thread(path.is_file):
+            raise Exception(f"不支持的 URL\n{url}")
+        digest, size = await asyncio.to_thread(_hash_file, path, max_bytes)
+        return StagedPic(path, digest, size, temp=False)
+
+    tmp_dir = STORE.root / ".tmp"
+    await asyncio.to_thread(tmp_dir.mkdir, parents=True, exist_ok=True)
+    fd, name = await asyncio.to_thread(tempfile.mkstemp, dir=tmp_dir)
+    tmp = pathlib.Path(name)
+    f = os.fdopen(fd, "wb")
+    h = hashlib.sha256()
+    size = 0
+    try:
+        async with asyncio.timeout(timeout or None):
+            async with get_client().stream("GET", url) as resp:
+                resp.raise_for_status()
+                length = resp.headers.get("Content-Length")
+                if max_bytes and length and int(length) > max_bytes:
+                    raise DownloadLimitException(url, f"超过 {max_bytes} 字节")
+                async for chunk in resp.aiter_bytes(CHUNK_SIZE):
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        raise DownloadLimitException(url, f"超过 {max_bytes} 字节")
+                    h.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+        if STORE.fsync:
+            await asyncio.to_thread(f.flush)
+            await asyncio.to_thread(os.fsync, f.fileno())
+    except TimeoutError:
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(tmp.unlink, True)
+        raise DownloadLimitException(url, f"超过 {timeout} 秒")
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(tmp.unlink, True)
+        raise
+    await asyncio.to_thread(f.close)
+    if METRICS.enabled:
+        METRICS.download_bytes.inc(amount=size)
+    return StagedPic(tmp, h.hexdigest(), size, temp=True)
 
 
 async def del_pic(url: str | pathlib.Path):
+    """删除图片文件；仍被数据库中的行或正在进行的保存引用时保留"""
+    if isinstance(url, pathlib.Path):
+        url = url.as_posix()
+    await store_of(url).release(url, pinned=False)
+
+
+async def release_pic(url: str | pathlib.Path):
+    """保存流程结束（无论成功与否）时调用，解除 write_bytes 的占用，没有引用时删除"""
     if isinstance(url, pathlib.Path):
         url = url.as_posix()
-    if url.startswith("http"):
-        return
-    if isinstance(url, str):
-        _ = pathlib.Path(url)
-    else:
-        _ = url
-    if _.exists():
-        _.unlink()
+    await store_of(url).release(url)
 
 
 async def load_pic(url: str) -> bytes:
-    if url.startswith("http"):
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            return resp.content
+    """读取整张图片，受 download_max_bytes / download_timeout 限制
 
-    if pathlib.Path(url).exists():
-        with open(url, "rb") as f:
-            return f.read()
-    raise Exception(f"不支持的 URL\n{url}")
+    大图请使用 fetch_pic，避免整张复制到内存。
+    """
+    staged = await fetch_pic(url)
+    try:
+        return await staged.read()
+    finally:
+        await staged.discard()
 
 
+@METRICS.timed("write_pic")
 async def write_pic(url: str, des_dir: str | None = None) -> str:
-    if not des_dir:
-        des_dir = "savepic"
-    path = pathlib.Path(des_dir)
-    path.mkdir(parents=True, exist_ok=True)
+    """下载并保存图片，不经过内存中的完整副本；需调用 release_pic"""
+    staged = await fetch_pic(url)
+    try:
+        return await staged.commit(store_for(des_dir))
+    finally:
+        await staged.discard()
+
 
-    byte = await load_pic(url)
-    file = path / hashlib.sha256(byte).hexdigest()
+async def write_bytes(byte: bytes, des_dir: str | None = None) -> str:
+    """按内容保存图片，返回保存路径
 
-    with open(file, "wb") as f:
-        f.write(byte)
-    return file.as_posix()
+    文件会被占用，直到调用 release_pic，期间不会被当作无引用的文件删除。
+    """
+    path, _ = await store_for(des_dir).put(byte)
+    return path
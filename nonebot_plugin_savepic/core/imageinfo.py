@@ -0,0 +1,177 @@
+"""
+图片元数据与感知哈希。
+
+保存时在进程池里解码一次图片，得到宽高、字节数、MIME、帧数与 64 位 dHash。
+dHash 对重新编码、缩放不敏感，汉明距离很小的两张图基本就是同一张，
+可以在请求嵌入接口之前就拦下来。
+
+数据库中 phash 按 16 位切成 4 段分别建索引：汉明距离不超过 3 时，
+至少有一段完全相同（抽屉原理），所以先按段等值查找候选，再精确计算距离。
+
+解码需要 Pillow，未安装时只记录字节数与 MIME。
+"""
+
+import asyncio
+
+from io import BytesIO
+from typing import NamedTuple, Optional
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from nonebot import get_driver, logger
+
+from ..config import plugin_config
+
+
+PHASH_BANDS = 4
+"""phash 切分的段数，段内等值可以走索引"""
+
+PHASH_SQL = "\n".join(
+    f"CREATE INDEX IF NOT EXISTS picdata_phash_{i} ON picdata "
+    f"(((phash >> {16 * i}) & 65535)) WHERE phash IS NOT NULL;"
+    for i in range(PHASH_BANDS)
+)
+"""phash 分段索引"""
+
+
+def near_sql(distance: int) -> str:
+    """查找本域或全局中 phash 汉明距离不超过 distance 的最近一张图
+
+    参数：$1 phash, $2 作用域, $3 distance, $4.. 各段的值（见 bands）。
+    distance 小于段数时先用分段索引筛选候选，否则只能全表比较。
+    """
+    where = ""
+    if distance < PHASH_BANDS:
+        clauses = " OR ".join(
+            f"((phash >> {16 * i}) & 65535) = ${4 + i}" for i in range(PHASH_BANDS)
+        )
+        where = f"AND ({clauses})"
+    return (
+        "SELECT name, url, d FROM ("
+        "SELECT name, url, "
+        "length(replace(((phash # $1::bigint)::bit(64))::text, '0', '')) AS d "
+        "FROM picdata WHERE phash IS NOT NULL "
+        f"AND scope && ARRAY[$2, 'globe'] {where}"
+        ") t WHERE d <= $3 ORDER BY d LIMIT 1;"
+    )
+
+
+class ImageInfo(NamedTuple):
+    size: Optional[int]
+    """字节数"""
+    mime: Optional[str]
+    width: Optional[int] = None
+    height: Optional[int] = None
+    frames: Optional[int] = None
+    phash: Optional[int] = None
+    """64 位 dHash，按有符号整数存入 bigint"""
+
+
+_MAGIC = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+
+def sniff_mime(head: bytes) -> Optional[str]:
+    """根据文件头判断 MIME"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime in _MAGIC:
+        if head.startswith(magic):
+            return mime
+    return None
+
+
+def dhash(image) -> int:
+    """64 位差值哈希：缩成 9x8 灰度图，比较每行相邻像素"""
+    small = image.convert("L").resize((9, 8))
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            i = row * 9 + col
+            bits = (bits << 1) | (px[i] > px[i + 1])
+    # 转为有符号 64 位整数，与 PostgreSQL 的 bigint 一致
+    return bits - (1 << 64) if bits >= 1 << 63 else bits
+
+
+def analyze(data: bytes | str) -> ImageInfo:
+    """解析图片，在 worker 中运行；传入路径时由 worker 自己读取，不经过进程间复制"""
+    if isinstance(data, str):
+        with open(data, "rb") as f:
+            data = f.read()
+    mime = sniff_mime(data[:16])
+    try:
+        from PIL import Image
+    except ImportError:
+        return ImageInfo(len(data), mime)
+    try:
+        with Image.open(BytesIO(data)) as image:
+            mime = Image.MIME.get(image.format or "", mime)
+            frames = getattr(image, "n_frames", 1)
+            # 动图取第一帧
+            image.seek(0)
+            return ImageInfo(
+                len(data), mime, image.width, image.height, frames, dhash(image)
+            )
+    except Exception:
+        return ImageInfo(len(data), mime)
+
+
+def hamming(a: int, b: int) -> int:
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+def bands(phash: int) -> list[int]:
+    """phash 的各段，顺序与 PHASH_SQL 一致"""
+    return [(phash >> (16 * i)) & 65535 for i in range(PHASH_BANDS)]
+
+
+_EXECUTOR: Optional[Executor] = None
+_WARNED = False
+
+
+def _executor() -> Executor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        workers = plugin_config.phash_workers
+        _EXECUTOR = (
+            ProcessPoolExecutor(workers) if workers > 0 else ThreadPoolExecutor(1)
+        )
+    return _EXECUTOR
+
+
+async def image_info(data: bytes | str) -> ImageInfo:
+    """在进程池中解析图片
+
+    Parameters
+    ----------
+    data: bytes | str
+        图片内容，或本地文件路径
+
+    Returns
+    -------
+    ImageInfo
+        元数据；无法解码（或没有 Pillow）时只有 size 与 mime
+    """
+    global _WARNED
+    info = await asyncio.get_running_loop().run_in_executor(
+        _executor(), analyze, data
+    )
+    if info.phash is None and not _WARNED:
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            _WARNED = True
+            logger.warning("未安装 Pillow，无法计算感知哈希与图片尺寸")
+    return info
+
+
+@get_driver().on_shutdown
+async def _():
+    global _EXECUTOR
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        _EXECUTOR = None
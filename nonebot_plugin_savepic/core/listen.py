@@ -0,0 +1,234 @@
+import json
+import asyncio
+import asyncpg
+
+from abc import ABC, abstractmethod
+from typing import Optional
+from nonebot import logger
+
+
+CHANNEL = "picdata_changed"
+"""picdata 变更通知所用的频道"""
+
+NOTIFY_SQL = f"""
+CREATE OR REPLACE FUNCTION picdata_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{CHANNEL}', json_build_object(
+        'op', TG_OP,
+        'old', CASE WHEN TG_OP IN ('UPDATE', 'DELETE')
+            THEN json_build_object('name', OLD.name, 'scope', OLD.scope, 'url', OLD.url)
+            END,
+        'new', CASE WHEN TG_OP IN ('INSERT', 'UPDATE')
+            THEN json_build_object('name', NEW.name, 'scope', NEW.scope, 'url', NEW.url)
+            END
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS picdata_notify_trigger ON picdata;
+CREATE TRIGGER picdata_notify_trigger
+AFTER INSERT OR DELETE OR UPDATE OF name, scope, url ON picdata
+FOR EACH ROW EXECUTE FUNCTION picdata_notify();
+"""
+"""安装变更通知触发器的 SQL，只在 name / scope / url 变化时通知（更新 vec 不通知）"""
+
+RELOAD_SQL = f"""SELECT pg_notify('{CHANNEL}', '{{"op": "RELOAD"}}');"""
+"""通知所有监听者重新加载，用于关闭触发器的批量写入之后"""
+
+
+class PicSubscriber(ABC):
+    """picdata 变更的订阅者
+
+    ready 为 False 时，订阅者的数据不可信，调用方应当回退到数据库查询。
+    """
+
+    ready: bool = False
+
+    @abstractmethod
+    async def reload(self, conn: asyncpg.Connection):
+        """从数据库完整加载数据"""
+
+    @abstractmethod
+    def apply(self, op: str, old: Optional[dict], new: Optional[dict]):
+        """应用一条变更
+
+        Parameters
+        ----------
+        op: str
+            INSERT / UPDATE / DELETE
+        old: Optional[dict]
+            变更前的行（name, scope, url）
+        new: Optional[dict]
+            变更后的行（name, scope, url）
+        """
+
+    def invalidate(self):
+        self.ready = False
+
+
+class PicListener:
+    """通过一条独立连接 LISTEN picdata 的变更，并分发给所有订阅者
+
+    连接断开或首次连接失败时，所有订阅者被标记为不可用，随后在后台重连并重新加载。
+    加载是串行的，每次加载期间收到的通知缓存在本次加载自己的缓冲区里，加载完成后重放。
+    """
+
+    def __init__(self):
+        self.subscribers: list[PicSubscriber] = []
+        self.conn: Optional[asyncpg.Connection] = None
+        self._dsn: str = ""
+        self._pool: Optional[asyncpg.Pool] = None
+        self._buffer: Optional[list[tuple[str, Optional[dict], Optional[dict]]]] = None
+        self._reconnect: Optional[asyncio.Task] = None
+        self._reload: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._closed = False
+
+    def subscribe(self, sub: PicSubscriber):
+        if sub not in self.subscribers:
+            self.subscribers.append(sub)
+
+    def _on_notify(self, conn, pid, channel, payload: str):
+        try:
+            data = json.loads(payload)
+            event = (data["op"], data.get("old"), data.get("new"))
+        except Exception as e:
+            logger.error(f"无法解析 picdata 变更通知: {payload}, {e}")
+            return
+        if event[0] == "RELOAD":
+            if self._reload is None or self._reload.done():
+                self._reload = asyncio.create_task(self._reload_all())
+            return
+        if self._buffer is not None:
+            self._buffer.append(event)
+            return
+        self._dispatch(*event)
+
+    def _dispatch(self, op: str, old: Optional[dict], new: Optional[dict]):
+        for sub in self.subscribers:
+            if not sub.ready:
+                continue
+            try:
+                sub.apply(op, old, new)
+            except Exception as e:
+                logger.error(f"{type(sub).__name__} 应用变更失败，标记为不可用: {e}")
+                sub.invalidate()
+
+    def _on_terminate(self, conn):
+        if self._closed:
+            return
+        logger.warning("picdata 变更监听连接已断开，缓存暂时失效")
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        for sub in self.subscribers:
+            sub.invalidate()
+        if self._reconnect is None or self._reconnect.done():
+            self._reconnect = asyncio.create_task(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        delay = 1.0
+        while not self._closed:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+                logger.info("picdata 变更监听已恢复")
+                return
+            except Exception as e:
+                logger.warning(f"picdata 变更监听重连失败: {e}")
+                delay = min(delay * 2, 60.0)
+
+    async def _connect(self):
+        assert self._pool is not None
+        conn = await asyncpg.connect(self._dsn)
+
+        async def listen():
+            # 先 LISTEN 再加载，加载期间收到的通知缓存起来，加载完成后重放
+            await conn.add_listener(CHANNEL, self._on_notify)
+            conn.add_termination_listener(self._on_terminate)
+
+        try:
+            await self._load(listen)
+        except BaseException:
+            # 由调用者决定是否重试，关闭连接不应再触发一次重连
+            conn.remove_termination_listener(self._on_terminate)
+            await conn.close()
+            raise
+        self.conn = conn
+
+    async def _load(self, before=None):
+        """串行地重新加载所有订阅者
+
+        Parameters
+        ----------
+        before: Optional[Callable[[], Awaitable[None]]]
+            开始缓存通知之后、加载之前执行，用于建立 LISTEN
+        """
+        assert self._pool is not None
+        async with self._lock:
+            buffer: list[tuple[str, Optional[dict], Optional[dict]]] = []
+            self._buffer = buffer
+            try:
+                if before is not None:
+                    await before()
+                async with self._pool.acquire() as conn:
+                    for sub in self.subscribers:
+                        await sub.reload(conn)
+            finally:
+                self._buffer = None
+                for event in buffer:
+                    self._dispatch(*event)
+
+    async def _reload_all(self):
+        logger.info("收到 picdata 重新加载通知")
+        for sub in self.subscribers:
+            sub.invalidate()
+        delay = 1.0
+        while not self._closed:
+            try:
+                await self._load()
+                return
+            except Exception as e:
+                logger.error(f"picdata 重新加载失败，{delay:.0f} 秒后重试: {e}")
+            for sub in self.subscribers:
+                sub.invalidate()
+            if self.conn is None or self.conn.is_closed():
+                # 监听连接也断了，交给重连流程重新加载
+                self._schedule_reconnect()
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+    async def start(self, dsn: str, pool: asyncpg.Pool):
+        """开始监听
+
+        Parameters
+        ----------
+        dsn: str
+            主库地址，NOTIFY 只在主库上产生
+        pool: asyncpg.Pool
+            用于加载数据的连接池
+        """
+        self._dsn = dsn
+        self._pool = pool
+        self._closed = False
+        try:
+            await self._connect()
+        except Exception:
+            # 首次连接失败同样在后台重试，调用方只需记录日志
+            self._schedule_reconnect()
+            raise
+
+    async def close(self):
+        self._closed = True
+        if self._reconnect:
+            self._reconnect.cancel()
+        if self._reload:
+            self._reload.cancel()
+        if self.conn and not self.conn.is_closed():
+            await self.conn.close()
+        for sub in self.subscribers:
+            sub.invalidate()
+
+
+LISTENER = PicListener()
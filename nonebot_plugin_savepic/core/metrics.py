@@ -0,0 +1,452 @@
+"""
+可选的运行指标：调用延迟直方图、计数器与连接池状态。
+
+metrics 关闭时，每个埋点只多一次布尔判断（timed 另外记下当前函数名，供慢查询日志使用）。开启后：
+- 驱动带有 HTTP 服务端（如 FastAPI）时，在 metrics_path 以 Prometheus 文本格式暴露；
+- 超级用户可以用 pic.stats 查看摘要。
+
+不依赖 prometheus_client，只实现 counter / gauge / histogram 三种指标。
+"""
+
+import math
+import time
+import bisect
+import functools
+
+from contextvars import ContextVar
+from typing import Any, Callable, Iterable, Optional, Awaitable, TypeVar, ParamSpec
+from nonebot import get_driver, logger
+from nonebot.consts import PREFIX_KEY, CMD_KEY
+from nonebot.matcher import Matcher
+from nonebot.message import run_preprocessor, run_postprocessor
+from nonebot.typing import T_State
+
+from ..config import plugin_config
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+Labels = tuple[str, ...]
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+"""延迟直方图的桶（秒）"""
+
+CURRENT_CALL: ContextVar[str] = ContextVar("savepic_current_call", default="")
+"""正在执行的被 timed 包装的函数名"""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge:
+    """抓取时才求值的指标，collect 返回 [(标签值, 数值)]"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Labels,
+        collect: Callable[[], Iterable[tuple[Labels, float]]],
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def render(self) -> Iterable[str]:
+        for labels, value in self.collect():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series: dict[Labels, list[float]] = {}
+        """标签值 -> [各桶计数..., 超出最大桶的计数, 总和]"""
+
+    def observe(self, value: float, *labels: str):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [0.0] * (len(self.buckets) + 2)
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def count(self, labels: Labels) -> int:
+        return int(sum(self.series.get(labels, [0.0])[:-1]))
+
+    def quantile(self, q: float, labels: Labels) -> float:
+        """按桶线性插值估算分位数，落在最大的桶之外时返回最大桶的上界"""
+        s = self.series.get(labels)
+        if not s:
+            return math.nan
+        counts = s[:-1]
+        rank = q * sum(counts)
+        seen = 0.0
+        for i, c in enumerate(counts):
+            if c and seen + c >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+    def render(self) -> Iterable[str]:
+        names = self.labelnames + ("le",)
+        for labels, s in self.series.items():
+            total = 0.0
+            for bound, c in zip(self.buckets + (math.inf,), s[:-1]):
+                total += c
+                le = "+Inf" if bound == math.inf else repr(bound)
+                bucket = _format_labels(names, labels + (le,))
+                yield f"{self.name}_bucket{bucket} {total}"
+            label_text = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_text} {s[-1]}"
+            yield f"{self.name}_count{label_text} {total}"
+
+
+class MeteredPool:
+    """包装 asyncpg.Pool，记录 acquire 的等待时间；其余属性原样转发"""
+
+    def __init__(self, pool, name: str, registry: "Registry"):
+        self.pool = pool
+        self.name = name
+        self.registry = registry
+        self.waiting = 0
+        """正在等待空闲连接的协程数"""
+
+    def acquire(self, *, timeout: Optional[float] = None) -> "_MeteredAcquire":
+        return _MeteredAcquire(self, timeout)
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self.pool, item)
+
+
+class _MeteredAcquire:
+    def __init__(self, owner: MeteredPool, timeout: Optional[float]):
+        self.owner = owner
+        self.timeout = timeout
+        self.conn = None
+
+    async def _acquire(self):
+        owner = self.owner
+        owner.waiting += 1
+        start = time.perf_counter()
+        try:
+            return await owner.pool.acquire(timeout=self.timeout)
+        finally:
+            owner.waiting -= 1
+            owner.registry.pool_wait.observe(time.perf_counter() - start, owner.name)
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+    async def __aenter__(self):
+        self.conn = await self._acquire()
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        conn, self.conn = self.conn, None
+        await self.owner.pool.release(conn)
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+        self.pools: dict[str, MeteredPool] = {}
+        self.components: dict[str, Callable[[], dict[str, float]]] = {}
+        """组件名 -> stats()，如 HTTP 连接池、文本嵌入缓存、衍生图缓存"""
+        self.calls = self.histogram(
+            "savepic_call_seconds", "数据层与嵌入等函数的调用耗时", ("fn",)
+        )
+        self.errors = self.counter(
+            "savepic_call_errors_total", "函数调用抛出的异常数", ("fn", "error")
+        )
+        self.handlers = self.histogram(
+            "savepic_handler_seconds", "事件处理器的耗时", ("matcher",)
+        )
+        self.handler_errors = self.counter(
+            "savepic_handler_errors_total", "事件处理器未捕获的异常数", ("matcher",)
+        )
+        self.pool_wait = self.histogram(
+            "savepic_pool_acquire_seconds", "从连接池取得连接的等待时间", ("pool",)
+        )
+        self.events = self.counter(
+            "savepic_events_total",
+            "缓存命中、rkey 刷新、嵌入失败等事件的次数",
+            ("event",),
+        )
+        self.download_bytes = self.counter(
+            "savepic_download_bytes_total", "下载的图片字节数"
+        )
+        self.embed_batch = self.histogram(
+            "savepic_embedding_batch_size",
+            "每次调用嵌入提供者合并的输入数",
+            buckets=(1, 2, 4, 8, 16, 32, 64),
+        )
+        self.gauge(
+            "savepic_pool_connections",
+            "连接池的连接数，state 为 size / idle / max / waiting",
+            ("pool", "state"),
+            self._pool_gauges,
+        )
+        self.gauge(
+            "savepic_component",
+            "各组件 stats() 的取值，如 HTTP 连接池、文本嵌入缓存、衍生图缓存",
+            ("component", "stat"),
+            self._component_gauges,
+        )
+        self.startup: dict[str, float] = {}
+        """启动各阶段的耗时（秒），由 init_db 记录"""
+        self.gauge(
+            "savepic_startup_seconds",
+            "数据库初始化各阶段的耗时",
+            ("phase",),
+            lambda: (((k,), v) for k, v in self.startup.items()),
+        )
+
+    def _register(self, metric):
+        self.metrics.setdefault(metric.name, metric)
+        return self.metrics[metric.name]
+
+    def counter(self, name: str, help: str, labelnames: Labels = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        labelnames: Labels,
+        collect: Callable[[], Iterable[tuple[Labels, float]]],
+    ) -> Gauge:
+        return self._register(Gauge(name, help, labelnames, collect))
+
+    def component(self, name: str, stats: Callable[[], dict[str, float]]):
+        """登记一个组件的 stats()，抓取与 pic.stats 时求值"""
+        self.components[name] = stats
+
+    def _component_gauges(self) -> Iterable[tuple[Labels, float]]:
+        for name, stats in self.components.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logger.debug(f"读取 {name} 的统计失败: {e}")
+                continue
+            for key, value in values.items():
+                yield (name, key), float(value)
+
+    def _pool_gauges(self) -> Iterable[tuple[Labels, float]]:
+        for name, p in self.pools.items():
+            yield (name, "size"), p.pool.get_size()
+            yield (name, "idle"), p.pool.get_idle_size()
+            yield (name, "max"), p.pool.get_max_size()
+            yield (name, "waiting"), p.waiting
+
+    def count(self, event: str, amount: float = 1.0):
+        """记录一次事件"""
+        if self.enabled:
+            self.events.inc(event, amount=amount)
+
+    def wrap_pool(self, pool, name: str):
+        """开启时返回记录等待时间的连接池，否则原样返回"""
+        if not self.enabled:
+            return pool
+        metered = MeteredPool(pool, name, self)
+        self.pools[name] = metered
+        return metered
+
+    def timed(self, name: str):
+        """记录异步函数的耗时与异常"""
+
+        def decorator(
+            func: Callable[P, Awaitable[R]],
+        ) -> Callable[P, Awaitable[R]]:
+            @functools.wraps(func)
+            async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+                token = CURRENT_CALL.set(name)
+                if not self.enabled:
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        CURRENT_CALL.reset(token)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    self.errors.inc(name, type(e).__name__)
+                    raise
+                finally:
+                    self.calls.observe(time.perf_counter() - start, name)
+                    CURRENT_CALL.reset(token)
+
+            return wrapper
+
+        return decorator
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        for m in self.metrics.values():
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """给 pic.stats 的摘要：各函数与处理器的次数、错误率、p50 / p99"""
+        lines = []
+        for title, hist, errors in (
+            ("函数", self.calls, self.errors),
+            ("处理器", self.handlers, self.handler_errors),
+        ):
+            if not hist.series:
+                continue
+            lines.append(f"[{title}] 次数 错误 p50/p99 ms")
+            for labels in sorted(hist.series):
+                n = hist.count(labels)
+                failed = sum(
+                    v for k, v in errors.values.items() if k[0] == labels[0]
+                )
+                lines.append(
+                    f"{labels[0]}: {n} {failed / n if n else 0:.1%} "
+                    f"{hist.quantile(0.5, labels) * 1000:.1f}/"
+                    f"{hist.quantile(0.99, labels) * 1000:.1f}"
+                )
+        if self.startup:
+            lines.append(
+                "[启动] "
+                + ", ".join(f"{k} {v * 1000:.0f} ms" for k, v in self.startup.items())
+            )
+        for (pool, state), value in self._pool_gauges():
+            if state == "size":
+                lines.append(f"[连接池 {pool}]")
+            lines.append(f"{state}: {value}")
+        current = None
+        for (name, key), value in self._component_gauges():
+            if name != current:
+                current = name
+                lines.append(f"[{name}]")
+            lines.append(f"{key}: {value:g}")
+        for m in self.metrics.values():
+            if isinstance(m, Counter) and m not in (self.errors, self.handler_errors):
+                for labels, value in m.values.items():
+                    label_text = _format_labels(m.labelnames, labels)
+                    lines.append(f"{m.name}{label_text}: {value:g}")
+        return "\n".join(lines) or "还没有数据"
+
+
+METRICS = Registry(plugin_config.metrics)
+_PACKAGE = __name__.split(".")[0]
+_STARTED: dict[int, float] = {}
+"""id(matcher) -> 开始处理的时间"""
+
+
+def _matcher_label(matcher: Matcher, state: T_State) -> str:
+    command = state.get(PREFIX_KEY, {}).get(CMD_KEY)
+    if command:
+        return ".".join(command)
+    return (matcher.module_name or "").rsplit(".", 1)[-1]
+
+
+def _ours(matcher: Matcher) -> bool:
+    return METRICS.enabled and (matcher.module_name or "").startswith(_PACKAGE)
+
+
+@run_preprocessor
+async def _(matcher: Matcher):
+    if _ours(matcher):
+        _STARTED[id(matcher)] = time.perf_counter()
+
+
+@run_postprocessor
+async def _(matcher: Matcher, state: T_State, exception: Optional[Exception]):
+    if not _ours(matcher) or (start := _STARTED.pop(id(matcher), None)) is None:
+        return
+    label = _matcher_label(matcher, state)
+    METRICS.handlers.observe(time.perf_counter() - start, label)
+    if exception is not None:
+        METRICS.handler_errors.inc(label)
+
+
+if METRICS.enabled:
+    from nonebot.drivers import URL, Request, Response, ReverseMixin, HTTPServerSetup
+
+    async def _export(request: Request) -> Response:
+        return Response(
+            200,
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+            content=METRICS.render(),
+        )
+
+    driver = get_driver()
+    if isinstance(driver, ReverseMixin):
+        driver.setup_http(
+            HTTPServerSetup(
+                URL(plugin_config.metrics_path), "GET", "savepic_metrics", _export
+            )
+        )
+    else:
+        logger.warning("当前驱动没有 HTTP 服务端，指标只能通过 pic.stats 查看")
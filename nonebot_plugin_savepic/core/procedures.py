@@ -0,0 +1,160 @@
+"""
+保存、重命名、删除的服务端函数，每个用户命令只需一次往返。
+
+检查与写入在同一个语句里完成，并对 (作用域, 名字) 加事务级咨询锁，
+避免并发时“先查后写”的竞态。函数返回状态码，由 sql.py 转换为 error.py 中的异常。
+"""
+
+
+SAVE_OK = 0
+SAVE_SAME_NAME = 1
+SAVE_SAME_URL = 2
+SAVE_SIMILAR = 3
+
+RENAME_OK = 0
+RENAME_NOT_FOUND = 1
+RENAME_PERMISSION = 2
+RENAME_SAME_NAME = 3
+
+DELETE_OK = 0
+DELETE_NOT_FOUND = 1
+
+
+FUNCTIONS_SQL = f"""
+DROP FUNCTION IF EXISTS picdata_save(text, text, text, halfvec, text, text, boolean);
+CREATE OR REPLACE FUNCTION picdata_save(
+    _name text, _scope text, _url text, _vec halfvec, _uploader text,
+    _hash text, _check boolean,
+    _width int, _height int, _size int, _mime text, _frames int, _phash bigint,
+    OUT r_status int, OUT r_name text, OUT r_url text,
+    OUT r_similarity double precision
+) AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext(_scope), hashtext(_name));
+    r_status := {SAVE_OK};
+
+    -- 同一作用域内已存在相同名字
+    IF EXISTS (
+        SELECT 1 FROM picdata p WHERE p.name = _name AND p.scope @> ARRAY[_scope]
+    ) THEN
+        r_status := {SAVE_SAME_NAME};
+        r_name := _name;
+        RETURN;
+    END IF;
+
+    -- 相同文件已经在本域或全局
+    SELECT p.name INTO r_name FROM picdata p
+    WHERE p.url = _url AND p.scope && ARRAY[_scope, 'globe'] LIMIT 1;
+    IF FOUND THEN
+        r_status := {SAVE_SAME_URL};
+        r_url := _url;
+        RETURN;
+    END IF;
+
+    -- 向量检索相似图片，按距离排序才能用上 HNSW 索引
+    IF _check AND _vec IS NOT NULL THEN
+        SELECT p.name, p.url, -(p.vec <#> _vec)
+        INTO r_name, r_url, r_similarity
+        FROM picdata p
+        WHERE p.vec IS NOT NULL AND p.scope && ARRAY[_scope, 'globe']
+        ORDER BY p.vec <#> _vec LIMIT 1;
+        IF FOUND AND r_similarity >= 0.75 THEN
+            r_status := {SAVE_SIMILAR};
+            RETURN;
+        END IF;
+        r_url := NULL;
+        r_similarity := NULL;
+    END IF;
+
+    INSERT INTO picdata (
+        name, scope, url, vec, uploader, hash,
+        width, height, size, mime, frames, phash
+    )
+    VALUES (
+        _name, ARRAY[_scope]::text[], _url, _vec, _uploader, _hash,
+        _width, _height, _size, _mime, _frames, _phash
+    )
+    ON CONFLICT (url) DO UPDATE
+    SET
+        scope = CASE
+                WHEN EXCLUDED.scope = ARRAY['globe']::text[]
+                    THEN ARRAY['globe']::text[]
+                WHEN NOT (picdata.scope @> EXCLUDED.scope)
+                    THEN array_append(picdata.scope, EXCLUDED.scope[1])
+                ELSE picdata.scope
+                END,
+        vec   = COALESCE(EXCLUDED.vec, picdata.vec),
+        hash  = COALESCE(EXCLUDED.hash, picdata.hash),
+        width  = COALESCE(EXCLUDED.width, picdata.width),
+        height = COALESCE(EXCLUDED.height, picdata.height),
+        size   = COALESCE(EXCLUDED.size, picdata.size),
+        mime   = COALESCE(EXCLUDED.mime, picdata.mime),
+        frames = COALESCE(EXCLUDED.frames, picdata.frames),
+        phash  = COALESCE(EXCLUDED.phash, picdata.phash)
+    RETURNING picdata.name INTO r_name;
+    r_url := _url;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION picdata_rename(
+    _ori text, _des text, _src text, _dst text, _admin boolean, _vec halfvec
+) RETURNS int AS $$
+DECLARE
+    n int;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext(_dst), hashtext(_des));
+
+    SELECT array_length(p.scope, 1) INTO n FROM picdata p
+    WHERE p.name = _ori AND p.scope @> ARRAY[_src] LIMIT 1;
+    IF NOT FOUND THEN
+        RETURN {RENAME_NOT_FOUND};
+    END IF;
+    -- 如果域不只一个，且不是管理员权限，则不允许修改
+    IF NOT _admin AND n > 1 THEN
+        RETURN {RENAME_PERMISSION};
+    END IF;
+    IF EXISTS (
+        SELECT 1 FROM picdata p WHERE p.name = _des AND p.scope @> ARRAY[_dst]
+    ) THEN
+        RETURN {RENAME_SAME_NAME};
+    END IF;
+
+    UPDATE picdata SET name = _des, scope = CASE
+        WHEN _dst = 'globe' THEN ARRAY['globe']::text[]
+        WHEN scope @> ARRAY['globe'] THEN ARRAY[_dst]::text[]
+        ELSE CASE
+            WHEN array_remove(scope, _src) @> ARRAY[_dst]
+                THEN array_remove(scope, _src)
+            ELSE array_append(array_remove(scope, _src), _dst)
+        END END,
+    vec = CASE WHEN name <> _des THEN _vec ELSE vec END
+    WHERE name = _ori AND scope @> ARRAY[_src];
+    RETURN {RENAME_OK};
+END;
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION IF EXISTS picdata_delete(text, text);
+CREATE OR REPLACE FUNCTION picdata_delete(
+    _name text, _scope text, OUT r_status int, OUT r_urls text[]
+) AS $$
+DECLARE
+    updated int;
+BEGIN
+    -- 被整行删除的 URL 交给调用方清理文件
+    WITH d AS (
+        DELETE FROM picdata WHERE name = _name AND scope = ARRAY[_scope]::text[]
+        RETURNING url
+    )
+    SELECT COALESCE(array_agg(url), ARRAY[]::text[]) INTO r_urls FROM d;
+    UPDATE picdata SET scope = array_remove(scope, _scope)
+    WHERE name = _name AND scope @> ARRAY[_scope];
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    IF cardinality(r_urls) + updated = 0 THEN
+        r_status := {DELETE_NOT_FOUND};
+        RETURN;
+    END IF;
+    r_status := {DELETE_OK};
+END;
+$$ LANGUAGE plpgsql;
+"""
+"""安装服务端函数的 SQL"""
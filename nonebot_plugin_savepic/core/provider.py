@@ -0,0 +1,237 @@
+"""
+嵌入向量的提供者，由 embedding_provider 选择：
+
+- http：OpenAI 风格的远程接口（默认）；
+- local：在本机 CPU 上运行 sentence-transformers 模型（例如 CLIP），
+  权重从 embedding_local_path 加载，可放在进程池里运行；
+- stub：根据输入的哈希生成确定的随机单位向量，用于测试与基准测试。
+
+向量维度必须与 picdata.vec 的 halfvec(2048) 一致，
+维度不同时可以开启 embedding_project 投影到 2048 维。
+"""
+
+import json
+import base64
+import asyncio
+import hashlib
+import numpy as np
+
+from io import BytesIO
+from abc import ABC, abstractmethod
+from typing import Optional
+from pathlib import Path
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from nonebot.log import logger
+
+from .client import get_client
+from ..config import plugin_config
+
+
+VECTOR_DIM = 2048
+"""picdata.vec 的维度"""
+
+Input = list[dict]
+"""接口的 input 字段：若干段文本 / 图片，会被融合为一个向量"""
+
+
+class EmbeddingProvider(ABC):
+    """嵌入提供者的基类"""
+
+    name: str = ""
+    """模型标识，用作缓存键，换模型后旧的缓存自动失效"""
+    fuse_batch: bool = False
+    """能否在一次调用中处理多段的输入；为 False 时只有单段输入会被合并"""
+
+    @abstractmethod
+    async def embed(self, inputs: list[Input]) -> list[Optional[list[float]]]:
+        """计算一批输入的向量，与 inputs 一一对应，失败的位置为 None"""
+
+    async def close(self):
+        pass
+
+
+class HttpProvider(EmbeddingProvider):
+    """OpenAI 风格的远程接口"""
+
+    def __init__(self):
+        self.name = plugin_config.embedding_model
+
+    async def embed(self, inputs: list[Input]) -> list[Optional[list[float]]]:
+        count = len(inputs)
+        rsp = await get_client().post(
+            plugin_config.embedding_url,
+            json={
+                "model": plugin_config.embedding_model,
+                "input": inputs[0] if count == 1 else [i[0] for i in inputs],
+            },
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {plugin_config.embedding_key}",
+            },
+        )
+        rsp.raise_for_status()
+        data = rsp.json()
+        try:
+            if isinstance(data["data"], dict):
+                # 多模态接口：整个 input 融合为一个向量
+                if count > 1:
+                    logger.error(
+                        "接口不支持批量输入，请将 embedding_batch_size 设为 1"
+                    )
+                    return [None] * count
+                return [data["data"]["embedding"]]
+            ret: list[Optional[list[float]]] = [None] * count
+            for item in data["data"]:
+                ret[item.get("index", 0)] = item["embedding"]
+            return ret
+        except Exception as e:
+            logger.error(f"Error while parsing embedding response: {e}")
+            return [None] * count
+
+
+class StubProvider(EmbeddingProvider):
+    """确定性的假向量：相同输入得到相同的单位向量，不同输入近似正交"""
+
+    name = "stub"
+    fuse_batch = True
+
+    def __init__(self, dim: int = VECTOR_DIM):
+        self.dim = dim
+
+    def vector(self, input: Input) -> list[float]:
+        key = json.dumps(input, sort_keys=True, ensure_ascii=False).encode()
+        seed = int.from_bytes(hashlib.sha256(key).digest()[:8], "little")
+        vec = np.random.default_rng(seed).standard_normal(self.dim)
+        return (vec / np.linalg.norm(vec)).tolist()
+
+    async def embed(self, inputs: list[Input]) -> list[Optional[list[float]]]:
+        return [self.vector(i) for i in inputs]
+
+
+_MODEL = None
+
+
+def _load_model(path: str):
+    global _MODEL
+    if _MODEL is None:
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "本地嵌入需要安装 sentence-transformers 与 pillow"
+            ) from e
+        _MODEL = SentenceTransformer(path, device="cpu")
+    return _MODEL
+
+
+def _encode(
+    path: str, inputs: list[list[tuple[str, str | bytes]]]
+) -> list[list[float]]:
+    """在 worker 中运行：每个输入的各段分别编码，取平均后归一化"""
+    from PIL import Image
+
+    model = _load_model(path)
+    texts: list[str] = []
+    images: list = []
+    owners: list[tuple[int, bool, int]] = []
+    for n, parts in enumerate(inputs):
+        for kind, value in parts:
+            if kind == "text":
+                owners.append((n, False, len(texts)))
+                texts.append(value)
+            else:
+                owners.append((n, True, len(images)))
+                images.append(Image.open(BytesIO(value)).convert("RGB"))
+
+    text_vecs = model.encode(texts, normalize_embeddings=True) if texts else []
+    image_vecs = model.encode(images, normalize_embeddings=True) if images else []
+    sums: list = [None] * len(inputs)
+    for n, is_image, i in owners:
+        v = np.asarray(image_vecs[i] if is_image else text_vecs[i], dtype=np.float32)
+        sums[n] = v if sums[n] is None else sums[n] + v
+    return [(s / np.linalg.norm(s)).tolist() for s in sums]
+
+
+class LocalProvider(EmbeddingProvider):
+    """在本机 CPU 上运行的 sentence-transformers 模型
+
+    embedding_local_workers 为 0 时在线程中运行（模型只加载一次，推理时释放 GIL），
+    大于 0 时使用进程池，每个进程各加载一份模型。
+    """
+
+    fuse_batch = True
+
+    def __init__(self, path: str, workers: int = 0):
+        if not Path(path).exists():
+            raise FileNotFoundError(f"找不到本地模型：{path}")
+        self.path = path
+        self.name = f"local:{Path(path).name}"
+        self.executor: Executor = (
+            ProcessPoolExecutor(workers) if workers > 0 else ThreadPoolExecutor(1)
+        )
+
+    async def _part(self, item: dict) -> tuple[str, str | bytes]:
+        if item.get("type") == "text":
+            return ("text", item["text"])
+        url: str = item["image_url"]["url"]
+        if url.startswith("data:"):
+            return ("image", base64.b64decode(url.split(",", 1)[1]))
+        rsp = await get_client().get(url)
+        rsp.raise_for_status()
+        return ("image", rsp.content)
+
+    async def embed(self, inputs: list[Input]) -> list[Optional[list[float]]]:
+        parts = [await asyncio.gather(*(self._part(p) for p in i)) for i in inputs]
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, _encode, self.path, parts
+        )
+
+    async def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+_PROJECTIONS: dict[int, np.ndarray] = {}
+
+
+def fit_dimension(vec: list[float]) -> Optional[np.ndarray]:
+    """把向量调整为 VECTOR_DIM 维
+
+    维度一致时原样返回；不一致且开启了 embedding_project 时，
+    较短的向量补零（内积不变），较长的向量用固定种子的高斯随机矩阵投影后重新归一化。
+    否则返回 None。
+    """
+    ret = np.asarray(vec, dtype=np.float64)
+    dim = ret.shape[0]
+    if dim == VECTOR_DIM:
+        return ret
+    if not plugin_config.embedding_project:
+        logger.error(
+            f"嵌入向量维度为 {dim}，与数据库的 {VECTOR_DIM} 不符，"
+            "请更换模型或开启 embedding_project"
+        )
+        return None
+    if dim < VECTOR_DIM:
+        return np.pad(ret, (0, VECTOR_DIM - dim))
+    if dim not in _PROJECTIONS:
+        rng = np.random.default_rng(dim)
+        _PROJECTIONS[dim] = rng.standard_normal((dim, VECTOR_DIM)) / np.sqrt(
+            VECTOR_DIM
+        )
+    ret = ret @ _PROJECTIONS[dim]
+    return ret / np.linalg.norm(ret)
+
+
+def create_provider() -> EmbeddingProvider:
+    """根据配置创建嵌入提供者"""
+    kind = plugin_config.embedding_provider
+    if kind == "http":
+        return HttpProvider()
+    if kind == "stub":
+        return StubProvider()
+    if kind == "local":
+        if not plugin_config.embedding_local_path:
+            raise ValueError("embedding_provider=local 需要配置 embedding_local_path")
+        return LocalProvider(
+            plugin_config.embedding_local_path, plugin_config.embedding_local_workers
+        )
+    raise ValueError(f"未知的 embedding_provider：{kind}")
@@ -0,0 +1,236 @@
+"""
+只读副本的读路由。
+
+cache_sqlurl 与 read_sqlurls 中的每个地址是一个只读副本（流复制的备库，或逻辑复制的订阅端）。
+后台每隔 read_probe_interval 秒探测一次：
+
+- 连不上、没有 picdata 表的副本视为不健康；
+- 比较主库当前的 WAL 位置与副本已回放（或订阅已确认）的位置，追上了延迟记为 0，
+  否则取副本最后一次回放距今的秒数；两种复制都不是时无法判断，视为没有延迟。
+
+读取在健康且延迟不超过 read_max_lag 的副本间轮流分配，没有可用副本时回到主库。
+某个作用域写入后的 read_your_writes 秒内，该作用域的读取直接走主库，刚保存的图片不会查不到；
+全局（globe）的写入对所有作用域生效。
+"""
+
+import time
+import asyncio
+import asyncpg
+import itertools
+
+from typing import Any, Optional
+from nonebot import logger
+
+from .metrics import METRICS
+from ..config import plugin_config
+
+
+PROBE_SQL = (
+    "SELECT to_regclass('picdata') IS NOT NULL AS has_table, "
+    "CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() >= $1::pg_lsn "
+    "ELSE (SELECT max(latest_end_lsn) >= $1::pg_lsn FROM pg_stat_subscription) "
+    "END AS caught_up, "
+    "EXTRACT(EPOCH FROM now() - CASE WHEN pg_is_in_recovery() "
+    "THEN pg_last_xact_replay_timestamp() "
+    "ELSE (SELECT max(latest_end_time) FROM pg_stat_subscription) END)::float8 "
+    "AS behind;"
+)
+"""副本的探测语句，$1 为主库当前的 WAL 位置"""
+
+_CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+)
+
+
+class Replica:
+    """一个只读副本及其探测结果"""
+
+    def __init__(self, name: str, pool: asyncpg.Pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = False
+        self.lag = float("inf")
+        """复制延迟（秒），未探测或无法判断追赶进度时为 inf"""
+        self.error = "尚未探测"
+
+    def usable(self) -> bool:
+        return self.healthy and self.lag <= plugin_config.read_max_lag
+
+    def mark(self, healthy: bool, lag: float, error: str = ""):
+        if self.healthy and not healthy:
+            logger.warning(f"只读副本 {self.name} 不可用: {error}")
+        elif healthy and not self.healthy:
+            logger.info(f"只读副本 {self.name} 恢复可用")
+        self.healthy, self.lag, self.error = healthy, lag, error
+
+    def fail(self, error: BaseException):
+        """读取时连接出错，立即停止分配，等下一次探测恢复"""
+        self.mark(False, float("inf"), f"{type(error).__name__}: {error}")
+
+
+class ReadRouter:
+    """为只读查询选择连接池，接口与 asyncpg.Pool 的 acquire 一致"""
+
+    def __init__(self):
+        self.primary: Optional[asyncpg.Pool] = None
+        self.replicas: list[Replica] = []
+        self._turn = itertools.count()
+        self._recent: dict[str, float] = {}
+        """作用域 -> 读写一致窗口的截止时间（time.monotonic）"""
+        self._recent_all = 0.0
+        """全局写入的截止时间，对所有作用域生效"""
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pools(self) -> dict[str, asyncpg.Pool]:
+        return {r.name: r.pool for r in self.replicas}
+
+    async def bind(self, primary: asyncpg.Pool, replicas: dict[str, asyncpg.Pool]):
+        """记下主库与副本，探测一次后开始定期探测"""
+        await self.close()
+        self.primary = primary
+        self.replicas = [Replica(name, pool) for name, pool in replicas.items()]
+        if not self.replicas:
+            return
+        try:
+            await self.probe()
+        except Exception as e:
+            logger.warning(f"只读副本探测失败: {e}")
+        for r in self.replicas:
+            if not r.healthy:
+                logger.warning(f"只读副本 {r.name} 不可用，读取将改用主库: {r.error}")
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """停止探测并关闭副本的连接池，主库由调用者关闭"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for r in self.replicas:
+            await r.pool.close()
+        self.replicas = []
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(plugin_config.read_probe_interval)
+            try:
+                await self.probe()
+            except Exception as e:
+                logger.warning(f"只读副本探测失败: {e}")
+
+    async def probe(self):
+        """探测所有副本的健康状态与复制延迟"""
+        assert self.primary
+        async with self.primary.acquire() as conn:
+            lsn = await conn.fetchval("SELECT pg_current_wal_lsn()::text;")
+        await asyncio.gather(*(self._probe(r, lsn) for r in self.replicas))
+
+    async def _probe(self, replica: Replica, lsn: str):
+        try:
+            async with replica.pool.acquire(
+                timeout=plugin_config.read_probe_interval
+            ) as conn:
+                row = await conn.fetchrow(PROBE_SQL, lsn)
+        except Exception as e:
+            replica.mark(False, float("inf"), f"{type(e).__name__}: {e}")
+            return
+        if not row["has_table"]:
+            replica.mark(False, float("inf"), "不存在 picdata 表")
+        elif row["caught_up"] is None or row["caught_up"]:
+            replica.mark(True, 0.0)
+        else:
+            behind = row["behind"]
+            replica.mark(True, float("inf") if behind is None else max(behind, 0.0))
+
+    def wrote(self, scope: str):
+        """记录一次写入，之后 read_your_writes 秒内该作用域的读取走主库"""
+        if not self.replicas or plugin_config.read_your_writes <= 0:
+            return
+        now = time.monotonic()
+        deadline = now + plugin_config.read_your_writes
+        if scope == "globe":
+            self._recent_all = deadline
+            return
+        self._recent[scope] = deadline
+        if len(self._recent) > 1024:
+            self._recent = {k: v for k, v in self._recent.items() if v > now}
+
+    def pick(self, scope: Optional[str] = None) -> Optional[Replica]:
+        """选择副本，返回 None 表示读主库"""
+        if not self.replicas:
+            return None
+        now = time.monotonic()
+        if self._recent_all > now or (
+            scope is not None and self._recent.get(scope, 0.0) > now
+        ):
+            return None
+        usable = [r for r in self.replicas if r.usable()]
+        if not usable:
+            METRICS.count("replica_fallback")
+            return None
+        return usable[next(self._turn) % len(usable)]
+
+    def acquire(
+        self, scope: Optional[str] = None, *, timeout: Optional[float] = None
+    ) -> "_RoutedAcquire":
+        """取得一个只读连接
+
+        Parameters
+        ----------
+        scope: Optional[str]
+            查询的作用域，用于读写一致；不按作用域查询时不传
+        """
+        return _RoutedAcquire(self, scope, timeout)
+
+    def _lag_gauges(self):
+        for r in self.replicas:
+            yield (r.name, "lag"), r.lag
+            yield (r.name, "healthy"), float(r.healthy)
+
+
+class _RoutedAcquire:
+    def __init__(self, router: ReadRouter, scope: Optional[str], timeout):
+        self.router = router
+        self.scope = scope
+        self.timeout = timeout
+        self.replica: Optional[Replica] = None
+        self.pool: Any = None
+        self.conn = None
+
+    async def __aenter__(self):
+        replica = self.router.pick(self.scope)
+        if replica is not None:
+            try:
+                self.conn = await replica.pool.acquire(timeout=self.timeout)
+                self.replica, self.pool = replica, replica.pool
+                return self.conn
+            except _CONNECTION_ERRORS as e:
+                replica.fail(e)
+                METRICS.count("replica_fallback")
+        assert self.router.primary
+        self.pool = self.router.primary
+        self.conn = await self.pool.acquire(timeout=self.timeout)
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.replica is not None and isinstance(exc, _CONNECTION_ERRORS):
+            self.replica.fail(exc)
+        conn, self.conn = self.conn, None
+        await self.pool.release(conn)
+
+
+READS = ReadRouter()
+METRICS.gauge(
+    "savepic_replica",
+    "只读副本的复制延迟（秒）与健康状态，state 为 lag / healthy",
+    ("replica", "state"),
+    READS._lag_gauges,
+)
@@ -0,0 +1,191 @@
+"""
+慢查询日志。
+
+连接池的每个连接都挂上 asyncpg 的查询日志回调（asyncpg 0.29+），
+耗时超过 slow_query_ms 的语句连同归一化的 SQL、参数与发起的函数（被 METRICS.timed 包装的函数名）
+写入日志，并保存在长度为 slow_query_buffer 的环形缓冲区里，超级用户可用 pic.slow 查看。
+
+slow_query_explain > 0 时，按比例对慢查询重新执行一次 EXPLAIN (ANALYZE, BUFFERS)，
+只针对 SELECT / WITH（不含调用 picdata_* 存储过程的写操作），
+且在只读事务中执行、结束后回滚，同一时间最多一个。
+"""
+
+import re
+import time
+import random
+import asyncio
+import asyncpg
+import numpy as np
+
+from typing import Any, Optional
+from collections import deque
+from contextvars import ContextVar
+from nonebot import logger
+
+from .metrics import METRICS, CURRENT_CALL
+from ..config import plugin_config
+
+
+_EXPLAINING: ContextVar[bool] = ContextVar("savepic_explaining", default=False)
+"""EXPLAIN 自身的查询不再记录"""
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r"\s+")
+_WRITE = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE)\b|\bpicdata_\w+\s*\(", re.IGNORECASE
+)
+"""会写入的语句：DML，或以 SELECT 调用的 picdata_save / rename / delete 等存储过程"""
+
+
+def normalize_sql(query: str) -> str:
+    """合并空白，字面量替换为 ?，同一语句的不同取值归为一类"""
+    query = _STRING.sub("?", query)
+    query = _NUMBER.sub("?", query)
+    return _SPACE.sub(" ", query).strip()
+
+
+def format_param(value: Any, limit: int = 120) -> str:
+    if isinstance(value, np.ndarray):
+        return f"<vector {value.shape[0] if value.ndim else 0}>"
+    text = repr(value)
+    if len(text) > limit:
+        text = text[:limit] + "…"
+    return text
+
+
+class SlowQuery:
+    """一条慢查询记录"""
+
+    def __init__(
+        self,
+        pool: str,
+        caller: str,
+        query: str,
+        args: tuple,
+        elapsed: float,
+        error: Optional[str],
+    ):
+        self.time = time.time()
+        self.pool = pool
+        self.caller = caller or "?"
+        self.query = query
+        self.sql = normalize_sql(query)
+        self.params = [format_param(a) for a in args]
+        self.elapsed = elapsed
+        self.error = error
+        self.plan: Optional[str] = None
+
+    def format(self, plan: bool = True) -> str:
+        lines = [
+            f"{time.strftime('%m-%d %H:%M:%S', time.localtime(self.time))} "
+            f"{self.elapsed * 1000:.0f} ms [{self.pool}] {self.caller}",
+            self.sql,
+        ]
+        if self.params:
+            lines.append("参数: " + ", ".join(self.params))
+        if self.error:
+            lines.append(f"异常: {self.error}")
+        if plan and self.plan:
+            lines.append(self.plan)
+        return "\n".join(lines)
+
+
+class SlowQueryLog:
+    """记录慢查询，必要时抓取执行计划"""
+
+    def __init__(self, threshold_ms: int, explain_rate: float, size: int):
+        self.threshold = threshold_ms / 1000
+        self.explain_rate = explain_rate
+        self.entries: deque[SlowQuery] = deque(maxlen=max(size, 1))
+        self.pools: dict[str, asyncpg.Pool] = {}
+        self._explaining = False
+        self._tasks: set[asyncio.Task] = set()
+        self._warned = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def attach(self, conn: asyncpg.Connection, pool: str):
+        """在新连接上挂日志回调，作为连接池 init 的一部分"""
+        if not self.enabled:
+            return
+        if not hasattr(conn, "add_query_logger"):
+            if not self._warned:
+                self._warned = True
+                logger.warning("asyncpg 版本低于 0.29，不支持慢查询日志")
+            return
+        conn.add_query_logger(lambda record: self._record(pool, record))
+
+    def bind(self, pools: dict[str, asyncpg.Pool]):
+        """记下连接池，EXPLAIN 在慢查询所在的池上执行"""
+        self.pools = pools
+
+    def _record(self, pool: str, record):
+        # 回调由 call_soon 调度，上下文是执行查询时的副本
+        if record.elapsed < self.threshold or _EXPLAINING.get():
+            return
+        error = record.exception
+        entry = SlowQuery(
+            pool,
+            CURRENT_CALL.get(),
+            record.query,
+            tuple(record.args or ()),
+            record.elapsed,
+            f"{type(error).__name__}: {error}" if error else None,
+        )
+        self.entries.append(entry)
+        METRICS.count("slow_query")
+        logger.warning(f"慢查询 {entry.format(plan=False)}")
+        if (
+            self.explain_rate > 0
+            and not self._explaining
+            and not error
+            and entry.sql[:4].upper() in ("SELE", "WITH")
+            and not _WRITE.search(entry.sql)
+            and pool in self.pools
+            and random.random() < self.explain_rate
+        ):
+            self._explaining = True
+            task = asyncio.create_task(self._explain(entry, tuple(record.args or ())))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _explain(self, entry: SlowQuery, args: tuple):
+        _EXPLAINING.set(True)
+        timeout = min(60.0, max(1.0, entry.elapsed * 3))
+        try:
+            async with self.pools[entry.pool].acquire() as conn:
+                tr = conn.transaction(readonly=True)
+                await tr.start()
+                try:
+                    await conn.execute(
+                        f"SET LOCAL statement_timeout = {int(timeout * 1000)};"
+                    )
+                    rows = await conn.fetch(
+                        "EXPLAIN (ANALYZE, BUFFERS) " + entry.query.rstrip("; \n"),
+                        *args,
+                    )
+                finally:
+                    await tr.rollback()
+            entry.plan = "\n".join(r[0] for r in rows)
+            logger.info(f"慢查询的执行计划（{entry.caller}）:\n{entry.plan}")
+        except Exception as e:
+            entry.plan = f"EXPLAIN 失败: {e}"
+        finally:
+            self._explaining = False
+
+    def dump(self, count: int = 5) -> str:
+        """最近 count 条慢查询，新的在前"""
+        if not self.entries:
+            return "还没有慢查询"
+        recent = list(self.entries)[-count:][::-1]
+        return "\n\n".join(e.format() for e in recent)
+
+
+SLOW_LOG = SlowQueryLog(
+    plugin_config.slow_query_ms,
+    plugin_config.slow_query_explain,
+    plugin_config.slow_query_buffer,
+)
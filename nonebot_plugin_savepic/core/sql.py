@@ -1,7 +1,12 @@
+import json
+import time
+import asyncio
+import base64
 import numpy as np
 import asyncpg
 
-from typing import Optional
+from typing import Optional, AsyncIterator
+from contextlib import aclosing
 from nonebot import get_driver, logger
 
 from .types import PicData
@@ -10,32 +15,86 @@ from .error import (
     NoPictureException,
     PermissionException,
     SimilarPictureException,
+    NearDuplicateException,
+)
+from .codec import register_vector_codecs
+from .storage import store_of, bind_stores
+from .provider import VECTOR_DIM
+from .imageinfo import PHASH_SQL, ImageInfo, near_sql, bands
+from .embedding import DISPATCHER
+from .utils import word2vec, mean_vector
+from .deck import RandomDeck
+from .cache import NAME_INDEX, SCOPE_COUNTER, TEXT_CACHE
+from .listen import LISTENER, NOTIFY_SQL
+from .vecsearch import VEC_SEARCH, server_settings
+from .metrics import METRICS
+from .slowlog import SLOW_LOG
+from .replica import READS
+from .procedures import (
+    FUNCTIONS_SQL,
+    SAVE_SAME_NAME,
+    SAVE_SAME_URL,
+    SAVE_SIMILAR,
+    RENAME_NOT_FOUND,
+    RENAME_PERMISSION,
+    RENAME_SAME_NAME,
+    DELETE_NOT_FOUND,
 )
-from .utils import word2vec
 from ..config import plugin_config
 
 
 gdriver = get_driver()
 POOL: Optional[asyncpg.Pool] = None
-POOL_LOCAL: asyncpg.Pool
-"""没啥特别的，单纯是订阅/发布模式用来加速读取的，不涉及 vec 的原子读操作理论上是走这个。"""
+POOL_LOCAL = READS
+"""只读查询的连接，在健康的副本间分配，没有可用副本时走主库，见 replica.py"""
+RANDOM_DECK = RandomDeck(plugin_config.random_deck_max)
+COUNT_CACHE: dict[tuple[str, str], tuple[float, int, bool]] = {}
+"""(scope, reg) -> (过期时间, 数量, 是否为估算)"""
+VEC_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS picdata_vec_hnsw_ip ON picdata "
+    "USING hnsw (vec halfvec_ip_ops) WITH (m = 16, ef_construction = 64);"
+)
+"""向量的 HNSW 索引，恢复数据时先删除、导入后再重建"""
+SELECT_STRICT_SQL = (
+    "SELECT url FROM picdata WHERE name = $1 AND scope @> ARRAY[$2] LIMIT 1;"
+)
+SELECT_SQL = (
+    "SELECT url FROM picdata WHERE name = $1 AND scope && ARRAY[$2, 'globe'] "
+    "ORDER BY scope @> ARRAY[$2] DESC LIMIT 1;"
+)
+CHECK_HASH_SQL = (
+    "SELECT name, url, vec, (scope && ARRAY[$2, 'globe']) AS visible "
+    "FROM picdata WHERE hash = $1;"
+)
+WARM_STATEMENTS = [SELECT_STRICT_SQL, SELECT_SQL, CHECK_HASH_SQL]
+"""新连接上预先执行的语句，参数都是 ('', '')，不会命中任何行"""
 
 
 @gdriver.on_startup
 async def _():
     if not plugin_config.savepic_sqlurl:
         raise Exception("请配置 savepic_sqlurl")
+    if plugin_config.embedding_provider == "http" and not plugin_config.embedding_url:
+        raise Exception("请配置 embedding_url，或选择其它 embedding_provider")
 
     await init_db()
 
 
 @gdriver.on_shutdown
 async def _():
+    await close_db()
+
+
+async def close_db():
     global POOL
+    await LISTENER.close()
+    await READS.close()
     if POOL:
         await POOL.close()
+        POOL = None
 
 
+@METRICS.timed("select_pic")
 async def select_pic(filename: str, scope: str, strict: bool = False) -> Optional[str]:
     """根据名字和作用域查询图片 URL
 
@@ -56,20 +115,18 @@ async def select_pic(filename: str, scope: str, strict: bool = False) -> Optiona
         logger.warning("未配置 savepic_sqlurl，无法使用查询功能")
         return None
 
-    async with POOL_LOCAL.acquire() as conn:
-        ret = await conn.fetchval(
-            "SELECT url FROM picdata WHERE name = $1 AND scope @> ARRAY[$2] LIMIT 1;",
-            filename,
-            scope,
-        )
-        if ret or strict:
-            return ret
-        return await conn.fetchval(
-            "SELECT url FROM picdata WHERE name = $1 AND scope @> ARRAY['globe'] LIMIT 1;",
-            filename,
-        )
+    # 内存索引可用时，命中与未命中都不需要访问数据库
+    if NAME_INDEX.ready:
+        return NAME_INDEX.select(filename, scope, strict)
+
+    async with READS.acquire(scope) as conn:
+        if strict:
+            return await conn.fetchval(SELECT_STRICT_SQL, filename, scope)
+        # 本域优先，其次全局
+        return await conn.fetchval(SELECT_SQL, filename, scope)
 
 
+@METRICS.timed("savepic")
 async def savepic(
     filename: str,
     url: str,
@@ -77,6 +134,8 @@ async def savepic(
     uploader: str = "unknown",
     vec: Optional[np.ndarray] = None,
     collision_allow: bool = False,
+    digest: Optional[str] = None,
+    info: Optional[ImageInfo] = None,
 ) -> Optional[str]:
     """保存图片
 
@@ -92,6 +151,10 @@ async def savepic(
         图片向量
     collision_allow: bool
         是否允许相似图片存在
+    digest: Optional[str]
+        图片内容的 SHA-256
+    info: Optional[ImageInfo]
+        图片元数据（宽高、字节数、MIME、帧数、感知哈希）
 
     Returns
     -------
@@ -111,70 +174,92 @@ async def savepic(
         logger.warning("未配置 savepic_sqlurl，无法使用保存功能")
         return
 
+    info = info or ImageInfo(None, None)
     async with POOL.acquire() as conn:
-        # 判断是否存在相同名字的图片
-        ret = await conn.fetchval(
-            "SELECT url FROM picdata WHERE name = $1 AND scope @> ARRAY[$2];",
+        row = await conn.fetchrow(
+            "SELECT * FROM picdata_save("
+            "$1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13);",
             filename,
             scope,
-        )
-        if ret:
-            raise SameNameException(filename, scope)
-
-        # 如果 URL 已经存在，且对应图片名字不为空，则相似图片错误
-        name = await conn.fetchval(
-            "SELECT name FROM picdata WHERE url = $1 AND scope && ARRAY[$2, 'globe'];",
             url,
-            scope,
+            vec,
+            uploader,
+            digest,
+            not collision_allow,
+            info.width,
+            info.height,
+            info.size,
+            info.mime,
+            info.frames,
+            info.phash,
         )
-        if name:
-            raise SimilarPictureException(name, float("inf"), url)
 
-        # 从向量检索相似图片
-        if not collision_allow and vec is not None:
-            row = await conn.fetchrow(
-                (
-                    "SELECT name, url, -(vec <#> $1::halfvec) AS similarity FROM picdata "
-                    "WHERE vec IS NOT NULL AND (scope && ARRAY[$2, 'globe']::text[]) "
-                    "AND -(vec <#> $1::halfvec) >= 0.6 "
-                    "ORDER BY similarity DESC LIMIT 1;"
-                ),
-                str(vec.tolist()),
-                scope,
-            )
-            if row and row["similarity"] >= 0.75:
-                raise SimilarPictureException(
-                    row["name"], row["similarity"], row["url"]
-                )
+    READS.wrote(scope)
+    if row["r_status"] == SAVE_SAME_NAME:
+        raise SameNameException(filename, scope)
+    if row["r_status"] == SAVE_SAME_URL:
+        raise SimilarPictureException(row["r_name"], float("inf"), url)
+    if row["r_status"] == SAVE_SIMILAR:
+        raise SimilarPictureException(row["r_name"], row["r_similarity"], row["r_url"])
+    if row["r_name"] != filename:
+        return row["r_name"]
 
-        # 事务
-        async with conn.transaction():
-            row = await conn.fetchrow(
-                """
-INSERT INTO picdata (name, scope, url, vec, uploader)
-VALUES ($1, ARRAY[$2]::text[], $3, $4::halfvec, $5)
-ON CONFLICT (url) DO UPDATE
-SET
-    scope = CASE
-            WHEN EXCLUDED.scope = ARRAY['globe']::text[]
-                THEN ARRAY['globe']::text[]
-            WHEN NOT (picdata.scope @> EXCLUDED.scope)
-                THEN array_append(picdata.scope, EXCLUDED.scope[1])
-            ELSE picdata.scope
-            END,
-    vec   = COALESCE(EXCLUDED.vec, picdata.vec)
-RETURNING name;""",
-                filename,  # $1: 传入的 name
-                scope,  # $2
-                url,  # $3
-                (str(vec.tolist()) if vec is not None else None),  # $4
-                uploader,  # $5
-            )
 
-            if row["name"] != filename:
-                return row["name"]
+@METRICS.timed("check_hash")
+async def check_hash(
+    digest: str,
+    scope: str = "globe",
+    phash: Optional[int] = None,
+    collision_allow: bool = False,
+) -> Optional[np.ndarray]:
+    """根据内容哈希与感知哈希检查图片是否已经保存过，在计算向量之前调用
 
+    Parameters
+    ----------
+    digest: str
+        图片内容的 SHA-256
+    scope: str
+        作用域
+    phash: Optional[int]
+        感知哈希，汉明距离不超过 phash_distance 的视为相似
+    collision_allow: bool
+        是否允许相似图片存在，为 True 时只检查相同内容
 
+    Returns
+    -------
+    Optional[np.ndarray]
+        相同内容的图片在其它域中已有的向量，可以直接复用
+
+    Exceptions
+    ----------
+    SimilarPictureException
+        本域或全局中已经有相同内容的图片
+    NearDuplicateException
+        开启 phash_distance 时，本域或全局中有感知哈希相近的图片
+    """
+    if not POOL:
+        logger.warning("未配置 savepic_sqlurl，无法使用保存功能")
+        return None
+
+    distance = plugin_config.phash_distance
+    async with POOL.acquire() as conn:
+        rows = await conn.fetch(CHECK_HASH_SQL, digest, scope)
+        for row in rows:
+            if row["visible"]:
+                raise SimilarPictureException(row["name"], float("inf"), row["url"])
+        if phash is not None and not collision_allow and distance >= 0:
+            near = await conn.fetchrow(
+                near_sql(distance), phash, scope, distance, *bands(phash)
+            )
+            if near:
+                raise NearDuplicateException(near["name"], near["d"], near["url"])
+    for row in rows:
+        if row["vec"] is not None:
+            return row["vec"]
+    return None
+
+
+@METRICS.timed("simpic")
 async def simpic(
     img_vec: np.ndarray, scope: str = "globe", sort_asc: bool = False
 ) -> tuple[float, Optional[PicData]]:
@@ -199,16 +284,9 @@ async def simpic(
         return 0, None
 
     async with POOL.acquire() as conn:
-        row = await conn.fetchrow(
-            (
-                "SELECT -(vec <#> $1::halfvec) AS similarity, name, url FROM picdata "
-                "WHERE vec IS NOT NULL AND (scope && ARRAY[$2, 'globe']::text[]) "
-                f"ORDER BY similarity {'ASC' if sort_asc else 'DESC'} LIMIT 1;"
-            ),
-            str(img_vec.tolist()),
-            scope,
-        )
-        if row:
+        rows = await VEC_SEARCH.nearest(conn, img_vec, scope, farthest=sort_asc)
+        if rows:
+            row = rows[0]
             return row["similarity"], PicData(
                 name=row["name"],
                 url=row["url"],
@@ -216,6 +294,7 @@ async def simpic(
         return 0, None
 
 
+@METRICS.timed("rename")
 async def rename(
     ori: str,
     des: str,
@@ -251,53 +330,27 @@ async def rename(
         return
 
     async with POOL.acquire() as conn:
-        # 判断目标名字是否存在
-        if not await conn.fetchval(
-            "SELECT 1 FROM picdata WHERE name = $1 AND scope @> ARRAY[$2];",
+        status = await conn.fetchval(
+            "SELECT picdata_rename($1, $2, $3, $4, $5, $6);",
             ori,
-            source_scope,
-        ):
-            raise NoPictureException(ori)
-
-        # 如果域不只一个，且不是管理员权限，则不允许修改
-        if (
-            not is_admin
-            and await conn.fetchval(
-                "SELECT array_length(scope, 1) FROM picdata WHERE name = $1 AND scope @> ARRAY[$2];",
-                ori,
-                source_scope,
-            )
-            > 1
-        ):
-            raise PermissionException(ori, "图片存在所处域不止一个")
-
-        # 判断目标名字是否存在
-        if await conn.fetchval(
-            "SELECT 1 FROM picdata WHERE name = $1 AND scope @> ARRAY[$2];",
-            des,
-            dest_scope,
-        ):
-            raise SameNameException(des, dest_scope)
-
-        await conn.execute(
-            "UPDATE picdata SET name = $1, scope = CASE "
-            "  WHEN $3 = 'globe' THEN ARRAY['globe']::text[] "
-            "  WHEN scope @> ARRAY['globe'] THEN ARRAY[$3]::text[] "
-            "  ELSE CASE "
-            "    WHEN array_remove(scope, $4) @> ARRAY[$3] "
-            "        THEN array_remove(scope, $4) "
-            "    ELSE array_append(array_remove(scope, $4), $3) "
-            "  END END, "
-            "vec = CASE WHEN name <> $1 THEN $5 ELSE vec END "
-            "WHERE name = $2 AND scope @> ARRAY[$4];",
             des,
-            ori,
-            dest_scope,
             source_scope,
-            str(vec.tolist()) if vec is not None else None,
+            dest_scope,
+            is_admin,
+            vec,
         )
 
+    READS.wrote(source_scope)
+    READS.wrote(dest_scope)
+    if status == RENAME_NOT_FOUND:
+        raise NoPictureException(ori)
+    if status == RENAME_PERMISSION:
+        raise PermissionException(ori, "图片存在所处域不止一个")
+    if status == RENAME_SAME_NAME:
+        raise SameNameException(des, dest_scope)
 
+
+@METRICS.timed("delete")
 async def delete(filename: str, scope: str):
     """删除图片
 
@@ -318,34 +371,71 @@ async def delete(filename: str, scope: str):
         return
 
     async with POOL.acquire() as conn:
-        if not await conn.fetchval(
-            "SELECT 1 FROM picdata WHERE name = $1 AND scope @> ARRAY[$2];",
-            filename,
-            scope,
-        ):
-            raise NoPictureException(filename)
-        await conn.execute(
-            "DELETE FROM picdata WHERE name = $1 AND scope = ARRAY[$2]::text[];",
-            filename,
-            scope,
-        )
-        await conn.execute(
-            "UPDATE picdata SET scope = array_remove(scope, $2) WHERE name = $1 AND scope @> ARRAY[$2];",
+        row = await conn.fetchrow(
+            "SELECT * FROM picdata_delete($1, $2);",
             filename,
             scope,
         )
+    READS.wrote(scope)
+    if row["r_status"] == DELETE_NOT_FOUND:
+        raise NoPictureException(filename)
+    # 最后一个引用没了，文件随之删除
+    for url in row["r_urls"]:
+        await store_of(url).release(url, pinned=False)
 
 
+@METRICS.timed("randpic")
 async def randpic(
     name: str, scope: str = "globe", vector: bool = False
 ) -> tuple[PicData | None, str]:
-    name = name.strip().replace("%", r"\%").replace("_", r"\_")
+    keyword = name.strip()
+    name = keyword.replace("%", r"\%").replace("_", r"\_")
     if not POOL:
         logger.warning("未配置 savepic_sqlurl，无法使用查询功能")
         return None, ""
 
+    if RANDOM_DECK.ready:
+        if pic := RANDOM_DECK.draw(RANDOM_DECK.key(scope, like=keyword)):
+            return pic, ""
+        if not keyword:
+            return None, ""
+    else:
+        pic, t = await _randpic_db(name, scope)
+        if pic or not name:
+            return pic, t
+
+    if not vector:
+        return None, ""
+    v = await word2vec(keyword)
+    if v is None:
+        return None, ""
+
+    # 如果没有找到，且需要向量检索，则进行向量检索
+    async with POOL.acquire() as conn:
+        rows = await VEC_SEARCH.nearest(conn, v, scope, 5, "name, scope, url")
+        if rows:
+            p = np.exp(np.array([1 + row["similarity"] for row in rows]) ** 2 / 0.2)
+            row = rows[
+                np.random.choice(
+                    a=len(rows),
+                    p=p / p.sum(),
+                )
+            ]
+            return (
+                PicData(
+                    name=row["name"],
+                    scope=row["scope"],
+                    url=row["url"],
+                ),
+                f"（语义相似度检索，{row['similarity'] * 100:.2f}%）",
+            )
+    return None, ""
+
+
+async def _randpic_db(name: str, scope: str) -> tuple[PicData | None, str]:
+    """牌堆不可用时，直接用数据库随机抽取"""
     # 优先从只读连接池查询
-    async with POOL_LOCAL.acquire() as conn:
+    async with READS.acquire(scope) as conn:
         if not name:
             row = await conn.fetchrow(
                 (
@@ -384,43 +474,10 @@ async def randpic(
                 ),
                 "",
             )
-
-    if not vector:
-        return None, ""
-    v = await word2vec(name)
-    if v is None:
-        return None, ""
-
-    # 如果没有找到，且需要向量检索，则进行向量检索
-    async with POOL.acquire() as conn:
-        rows = await conn.fetch(
-            (
-                "SELECT name, scope, url, -(vec <#> $2::halfvec) as similarity FROM picdata "
-                "WHERE (scope && ARRAY[$1, 'globe']::text[]) "
-                "AND vec IS NOT NULL ORDER BY similarity DESC LIMIT 5;"
-            ),
-            scope,
-            str(v.tolist()),
-        )
-        if rows:
-            p = np.exp(np.array([1 + row["similarity"] for row in rows]) ** 2 / 0.2)
-            row = rows[
-                np.random.choice(
-                    a=len(rows),
-                    p=p / p.sum(),
-                )
-            ]
-            return (
-                PicData(
-                    name=row["name"],
-                    scope=row["scope"],
-                    url=row["url"],
-                ),
-                f"（语义相似度检索，{row['similarity'] * 100:.2f}%）",
-            )
     return None, ""
 
 
+@METRICS.timed("cipdnar")
 async def cipdnar(name: str, scope: str = "globe") -> tuple[PicData | None, str]:
     if not POOL:
         logger.warning("未配置 savepic_sqlurl，无法使用查询功能")
@@ -429,14 +486,8 @@ async def cipdnar(name: str, scope: str = "globe") -> tuple[PicData | None, str]
     if v is None:
         return None, ""
     async with POOL.acquire() as conn:
-        rows = await conn.fetch(
-            (
-                "SELECT name, scope, url, -(vec <#> $2::halfvec) as similarity FROM picdata "
-                "WHERE (scope && ARRAY[$1, 'globe']::text[]) "
-                "AND vec IS NOT NULL ORDER BY similarity LIMIT 5;"
-            ),
-            scope,
-            str(v.tolist()),
+        rows = await VEC_SEARCH.nearest(
+            conn, v, scope, 5, "name, scope, url", farthest=True
         )
         if rows:
             p = np.exp(np.array([abs(row["similarity"]) for row in rows]) ** 2 / 0.2)
@@ -457,6 +508,7 @@ async def cipdnar(name: str, scope: str = "globe") -> tuple[PicData | None, str]
     return None, ""
 
 
+@METRICS.timed("regexp_pic")
 async def regexp_pic(reg: str, scope: str = "globe") -> Optional[PicData]:
     """根据正则表达式随机查询一张图片
 
@@ -479,7 +531,21 @@ async def regexp_pic(reg: str, scope: str = "globe") -> Optional[PicData]:
     if not reg:
         reg = ".*"
 
-    async with POOL_LOCAL.acquire() as conn:
+    if RANDOM_DECK.ready:
+        key = RANDOM_DECK.key(scope, regex="" if reg == ".*" else reg)
+        if not RANDOM_DECK.has(key):
+            # 正则交给数据库匹配，只取候选 URL，之后的抽取都在内存里
+            async with READS.acquire(scope) as conn:
+                rows = await conn.fetch(
+                    "SELECT url FROM picdata "
+                    "WHERE (scope && ARRAY[$1, 'globe']::text[]) AND name ~* $2;",
+                    scope,
+                    reg,
+                )
+            RANDOM_DECK.fill(key, [r["url"] for r in rows])
+        return RANDOM_DECK.draw(key)
+
+    async with READS.acquire(scope) as conn:
         row = await conn.fetchrow(
             (
                 "SELECT name, scope, url FROM picdata "
@@ -498,6 +564,29 @@ async def regexp_pic(reg: str, scope: str = "globe") -> Optional[PicData]:
             )
 
 
+def _cached_count(scope: str, reg: str) -> Optional[tuple[int, bool]]:
+    if (cached := COUNT_CACHE.get((scope, reg))) and cached[0] > time.monotonic():
+        return cached[1], cached[2]
+    return None
+
+
+def _cache_count(scope: str, reg: str, count: int, approximate: bool):
+    if plugin_config.countpic_cache_ttl <= 0:
+        return
+    now = time.monotonic()
+    if len(COUNT_CACHE) >= 1024:
+        for k in [k for k, v in COUNT_CACHE.items() if v[0] <= now]:
+            del COUNT_CACHE[k]
+        if len(COUNT_CACHE) >= 1024:
+            COUNT_CACHE.pop(next(iter(COUNT_CACHE)))
+    COUNT_CACHE[(scope, reg)] = (
+        now + plugin_config.countpic_cache_ttl,
+        count,
+        approximate,
+    )
+
+
+@METRICS.timed("countpic")
 async def countpic(reg: str, scope: str = "globe") -> int:
     """
     统计图片数量
@@ -522,8 +611,14 @@ async def countpic(reg: str, scope: str = "globe") -> int:
     if not reg:
         reg = ".*"
 
-    async with POOL_LOCAL.acquire() as conn:
-        return (
+    # 不带条件的总数直接用增量维护的计数
+    if reg == ".*" and SCOPE_COUNTER.ready:
+        return SCOPE_COUNTER.count(scope)
+    if (cached := _cached_count(scope, reg)) and not cached[1]:
+        return cached[0]
+
+    async with READS.acquire(scope) as conn:
+        count = (
             await conn.fetchval(
                 (
                     "SELECT COUNT(*) FROM picdata "
@@ -535,13 +630,14 @@ async def countpic(reg: str, scope: str = "globe") -> int:
             )
             or 0
         )
+    _cache_count(scope, reg, count, False)
+    return count
 
 
-async def listpic(
-    reg: str, scope: str = "globe", pages: int = 0
-) -> list[tuple[str, bool]]:
+@METRICS.timed("estimate_pic")
+async def estimate_pic(reg: str, scope: str = "globe") -> tuple[int, bool]:
     """
-    列出图片
+    统计图片数量，可见图片过多时抽样估算
 
     Parameters
     ----------
@@ -549,24 +645,141 @@ async def listpic(
         正则表达式
     scope: str
         作用域
-    pages: int
-        页码
 
     Returns
     -------
-    list[tuple[str, bool]]
-        (图片名, 是否为全局) 列表
+    tuple[int, bool]
+        (图片数量, 是否为估算)
+    """
+    if not POOL:
+        logger.warning("未配置 savepic_sqlurl，无法使用统计功能")
+        return 0, False
+
+    reg = reg.strip()
+    if not reg:
+        reg = ".*"
+
+    if reg == ".*" and SCOPE_COUNTER.ready:
+        return SCOPE_COUNTER.count(scope), False
+    if cached := _cached_count(scope, reg):
+        return cached
+    if (
+        not SCOPE_COUNTER.ready
+        or SCOPE_COUNTER.count(scope) <= plugin_config.countpic_approximate_above
+    ):
+        return await countpic(reg, scope), False
+
+    async with READS.acquire(scope) as conn:
+        rows = await conn.fetchval(
+            "SELECT reltuples FROM pg_class WHERE relname = 'picdata';"
+        )
+        percent = 100.0 * plugin_config.countpic_sample_rows / max(rows or 0, 1)
+        if percent >= 100:
+            return await countpic(reg, scope), False
+        # 按数据页抽样，再按比例放大
+        sampled = await conn.fetchval(
+            (
+                f"SELECT COUNT(*) FROM picdata TABLESAMPLE SYSTEM ({percent:.6f}) "
+                "WHERE (scope && ARRAY[$1, 'globe']::text[]) "
+                "AND name ~* $2;"
+            ),
+            scope,
+            reg,
+        )
+    count = round((sampled or 0) * 100.0 / percent)
+    _cache_count(scope, reg, count, True)
+    return count, True
+
+
+def encode_page_token(name: str, url: str, page: int = 1) -> str:
+    """生成 listpic 的翻页令牌：从 (name, url) 这一张之后继续，即第 page 页"""
+    raw = json.dumps([name, url, page], ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_page_token(token: str) -> tuple[str, str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        name, url, page = json.loads(raw)
+        return str(name), str(url), int(page)
+    except Exception:
+        raise ValueError("无效的翻页令牌")
+
+
+async def listpic_stream(
+    reg: str, scope: str = "globe", token: str = "", pages: int = 0
+) -> AsyncIterator[tuple[str, bool, tuple[str, str]]]:
+    """
+    逐行列出图片，使用服务端游标，不会一次性取回全部结果
+
+    有 token 时按 (name, url) 键集翻页；否则按 pages 偏移（兼容旧的页码）。
+
+    Parameters
+    ----------
+    reg: str
+        正则表达式
+    scope: str
+        作用域
+    token: str
+        翻页令牌，由本函数产出
+    pages: int
+        页码
+
+    Yields
+    ------
+    tuple[str, bool, tuple[str, str]]
+        (图片名, 是否为全局, 键集位置 (name, url))，键集位置传给 encode_page_token 即可从这一张之后继续
     """
 
     if not POOL:
         logger.warning("未配置 savepic_sqlurl，无法使用统计功能")
-        return []
+        return
 
     reg = reg.strip()
     if not reg:
         reg = ".*"
 
-    pages = max(pages - 1, 0)
+    prefetch = max(plugin_config.count_per_page_in_list, 1) + 1
+    select = (
+        "SELECT name, url, (scope @> ARRAY['globe']) AS is_global FROM picdata "
+        "WHERE (scope && ARRAY[$1, 'globe']::text[]) AND name ~* $2 "
+    )
+    if token:
+        # 名字在不同作用域可能重复，(name, url) 才是唯一的键
+        after, url, _ = decode_page_token(token)
+        query = select + "AND (name, url) > ($3, $4) ORDER BY name, url;"
+        args: tuple = (after, url)
+    else:
+        query = select + "ORDER BY name, url OFFSET $3;"
+        args = (max(pages - 1, 0) * plugin_config.count_per_page_in_list,)
+
+    async with READS.acquire(scope) as conn, conn.transaction():
+        cursor = conn.cursor(query, scope, reg, *args, prefetch=prefetch)
+        async for r in cursor:
+            yield r["name"], r["is_global"], (r["name"], r["url"])
+
+
+@METRICS.timed("listpic")
+async def listpic(
+    reg: str, scope: str = "globe", pages: int = 0
+) -> list[tuple[str, bool]]:
+    """
+    列出图片
+
+    Parameters
+    ----------
+    reg: str
+        正则表达式
+    scope: str
+        作用域
+    pages: int
+        页码
+
+    Returns
+    -------
+    list[tuple[str, bool]]
+        (图片名, 是否为全局) 列表
+    """
     _count = min(
         max(
             1, plugin_config.count_per_page_in_list * plugin_config.max_page_in_listpic
@@ -574,23 +787,16 @@ async def listpic(
         1000,
     )
 
-    async with POOL_LOCAL.acquire() as conn:
-        row = await conn.fetch(
-            (
-                "SELECT name, (scope @> ARRAY['globe']) AS is_global FROM picdata "
-                "WHERE (scope && ARRAY[$1, 'globe']::text[]) "
-                "AND name ~* $2 ORDER BY name OFFSET $3 LIMIT $4;"
-            ),
-            scope,
-            reg,
-            pages * plugin_config.count_per_page_in_list,
-            _count,
-        )
-        if row:
-            return [(r["name"], r["is_global"]) for r in row]
-        return []
+    ret = []
+    async with aclosing(listpic_stream(reg, scope, pages=pages)) as rows:
+        async for name, is_global, _ in rows:
+            ret.append((name, is_global))
+            if len(ret) >= _count:
+                break
+    return ret
 
 
+@METRICS.timed("check_uploader")
 async def check_uploader(filename: str, scope: str, uploader: str) -> bool:
     """获取图片上传者
 
@@ -612,7 +818,7 @@ async def check_uploader(filename: str, scope: str, uploader: str) -> bool:
         logger.warning("未配置 savepic_sqlurl，无法使用查询功能")
         return False
 
-    async with POOL_LOCAL.acquire() as conn:
+    async with READS.acquire(scope) as conn:
         return bool(
             await conn.fetchval(
                 "SELECT 1 FROM picdata WHERE name = $1 AND scope @> ARRAY[$2] AND uploader = $3;",
@@ -623,25 +829,102 @@ async def check_uploader(filename: str, scope: str, uploader: str) -> bool:
         )
 
 
-async def init_db():
-    global POOL, POOL_LOCAL
-    POOL = await asyncpg.create_pool(
-        plugin_config.savepic_sqlurl,
-        min_size=1,
-        max_size=10,
-        timeout=60,
-        max_inactive_connection_lifetime=300,
-    )
-    if plugin_config.cache_sqlurl:
-        POOL_LOCAL = await asyncpg.create_pool(
-            plugin_config.cache_sqlurl,
-            min_size=1,
+def _init_conn(pool: str):
+    """连接池的 init 回调：注册向量编解码，挂上慢查询日志，预先执行常用语句"""
+
+    async def init(conn: asyncpg.Connection):
+        await register_vector_codecs(conn)
+        SLOW_LOG.attach(conn, pool)
+        if plugin_config.db_warmup:
+            await _warm(conn)
+
+    return init
+
+
+async def _warm(conn: asyncpg.Connection):
+    """执行一遍 WARM_STATEMENTS，语句与结果类型进入连接的语句缓存
+
+    首次启动时表还不存在，失败直接忽略。
+    """
+    try:
+        for query in WARM_STATEMENTS:
+            await conn.fetch(query, "", "")
+    except (asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+        logger.debug(f"连接预热跳过: {e}")
+
+
+async def _create_pool(dsn: str, name: str, min_size: int = 1):
+    return METRICS.wrap_pool(
+        await asyncpg.create_pool(
+            dsn,
+            min_size=min_size,
             max_size=10,
             timeout=60,
             max_inactive_connection_lifetime=300,
-        )
-    else:
-        POOL_LOCAL = POOL
+            init=_init_conn(name),
+            server_settings=server_settings(),
+        ),
+        name,
+    )
+
+
+async def _prewarm_index(pool: asyncpg.Pool, name: str):
+    """用 pg_prewarm 把向量索引读入共享缓冲区，在后台执行"""
+    start = time.perf_counter()
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm;")
+            for index in ["picdata_vec_hnsw_ip", *VEC_SEARCH.indexes.values()]:
+                await conn.fetchval("SELECT pg_prewarm($1::regclass);", index)
+    except Exception as e:
+        logger.warning(f"向量索引预热失败（{name}）: {e}")
+        return
+    METRICS.startup[f"prewarm_{name}"] = time.perf_counter() - start
+    logger.info(
+        f"向量索引预热完成（{name}），用时 {time.perf_counter() - start:.1f} 秒"
+    )
+
+
+_PREWARM_TASKS: set[asyncio.Task] = set()
+
+
+async def init_db(listen: bool = True):
+    """初始化连接池与表结构
+
+    Parameters
+    ----------
+    listen: bool
+        是否加载内存索引并监听变更，命令行工具不需要
+    """
+    global POOL
+    started = clock = time.perf_counter()
+
+    def phase(name: str):
+        nonlocal clock
+        now = time.perf_counter()
+        METRICS.startup[name] = now - clock
+        clock = now
+
+    # 各连接池与均值向量互不依赖，同时准备
+    # 副本的连接池不预先建立连接，副本暂时连不上也不影响启动，由探测决定是否使用
+    urls = [plugin_config.cache_sqlurl] if plugin_config.cache_sqlurl else []
+    urls += plugin_config.read_sqlurls
+    names = ["local"] if len(urls) == 1 else [f"replica{i}" for i in range(len(urls))]
+    jobs = [
+        asyncio.to_thread(mean_vector),
+        _create_pool(plugin_config.savepic_sqlurl, "primary"),
+        *(_create_pool(url, name, min_size=0) for url, name in zip(urls, names)),
+    ]
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        for r in results[1:]:
+            if not isinstance(r, BaseException):
+                await r.close()
+        raise errors[0]
+    POOL = results[1]
+    replicas = dict(zip(names, results[2:]))
+    phase("pools")
 
     async def create_table(pool: asyncpg.Pool):
         async with pool.acquire() as conn:
@@ -650,7 +933,7 @@ async def init_db():
                 "SELECT EXISTS (SELECT FROM pg_tables WHERE tablename = 'picdata');"
             ):
                 logger.info("picdata 表已存在，跳过创建")
-                return
+                return False
             async with conn.transaction():
                 # 启用插件
                 await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
@@ -664,8 +947,15 @@ async def init_db():
                         "  name     text   NOT NULL, \n"
                         "  scope    text[] NOT NULL, \n"
                         "  url      text   PRIMARY KEY, \n"
-                        "  vec      halfvec(2048), \n"
+                        f"  vec      halfvec({VECTOR_DIM}), \n"
                         "  uploader text   NOT NULL, \n"
+                        "  hash     text, \n"
+                        "  width    int, \n"
+                        "  height   int, \n"
+                        "  size     int, \n"
+                        "  mime     text, \n"
+                        "  frames   int, \n"
+                        "  phash    bigint \n"
                         ");"
                     )
                 )
@@ -676,22 +966,91 @@ async def init_db():
                     "CREATE INDEX IF NOT EXISTS picdata_name_lower_btree ON picdata (lower(name)); \n"
                     "CREATE INDEX IF NOT EXISTS picdata_name_trgm ON picdata USING GIN (lower(name) gin_trgm_ops); \n"
                     "CREATE INDEX IF NOT EXISTS picdata_scope_gin ON picdata USING GIN (scope); \n"
-                    "CREATE INDEX IF NOT EXISTS picdata_vec_hnsw_ip ON picdata USING hnsw (vec halfvec_ip_ops) WITH (m = 16, ef_construction = 64);"
+                    + VEC_INDEX_SQL
                 )
                 logger.info("已创建 picdata 表的索引")
+        return True
 
-    await create_table(POOL)
+    if await create_table(POOL):
+        # 建表时才安装的 vector 扩展，已有连接上没有注册编解码，需要重连
+        await POOL.expire_connections()
 
-    # 判断只读池是否有表 picdata，没有则改用主池
-    if POOL_LOCAL is not POOL:
-        async with POOL_LOCAL.acquire() as conn:
-            if not await conn.fetchval(
-                "SELECT EXISTS (SELECT FROM pg_tables WHERE tablename = 'picdata');"
-            ):
-                logger.warning(
-                    "只读连接池中不存在 picdata 表，改用主连接池作为只读连接池"
-                )
-                POOL_LOCAL = POOL
+    # 升级旧表：内容哈希列，本地文件的文件名就是 SHA-256，直接回填
+    async with POOL.acquire() as conn:
+        await conn.execute(
+            "ALTER TABLE picdata ADD COLUMN IF NOT EXISTS hash text; \n"
+            "CREATE INDEX IF NOT EXISTS picdata_hash ON picdata (hash); \n"
+            "UPDATE picdata SET hash = substring(url from '([0-9a-f]{64})$') "
+            "WHERE hash IS NULL AND url !~ '^https?://' AND url ~ '[0-9a-f]{64}$';"
+        )
+    # 升级旧表：图片元数据与感知哈希，旧数据用命令行 analyze 补全
+    async with POOL.acquire() as conn:
+        await conn.execute(
+            "ALTER TABLE picdata "
+            "ADD COLUMN IF NOT EXISTS width int, "
+            "ADD COLUMN IF NOT EXISTS height int, "
+            "ADD COLUMN IF NOT EXISTS size int, "
+            "ADD COLUMN IF NOT EXISTS mime text, "
+            "ADD COLUMN IF NOT EXISTS frames int, "
+            "ADD COLUMN IF NOT EXISTS phash bigint; \n"
+            "CREATE INDEX IF NOT EXISTS picdata_mime ON picdata (mime); \n"
+            + PHASH_SQL
+        )
 
-    if POOL_LOCAL is not POOL:
-        logger.info("使用了独立的只读连接池，请确保设定了数据库的同步复制。")
+    # 安装变更通知触发器与服务端函数
+    async with POOL.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(NOTIFY_SQL)
+            await conn.execute(FUNCTIONS_SQL)
+        await VEC_SEARCH.bind(conn)
+
+    bind_stores(POOL)
+    phase("schema")
+
+    await READS.bind(POOL, replicas)
+    if replicas:
+        usable = sum(r.usable() for r in READS.replicas)
+        logger.info(f"只读副本 {usable}/{len(replicas)} 可用")
+        phase("replicas")
+
+    if listen and plugin_config.name_cache:
+        LISTENER.subscribe(NAME_INDEX)
+    if listen and plugin_config.random_deck:
+        LISTENER.subscribe(RANDOM_DECK)
+    if listen:
+        LISTENER.subscribe(SCOPE_COUNTER)
+        LISTENER.subscribe(VEC_SEARCH)
+    if LISTENER.subscribers:
+        try:
+            await LISTENER.start(plugin_config.savepic_sqlurl, POOL)
+            logger.info("已加载 picdata 内存索引与牌堆，并开始监听变更")
+        except Exception as e:
+            logger.warning(f"picdata 变更监听启动失败，将在后台重试: {e}")
+        phase("listen")
+
+    if plugin_config.text_cache:
+        try:
+            model = DISPATCHER.provider.name
+        except Exception as e:
+            # 配置错误或缺少依赖，嵌入本身也无法使用，不能当作缓存的问题吞掉
+            logger.error(f"无法创建嵌入提供者（embedding_provider）: {e}")
+        else:
+            try:
+                await TEXT_CACHE.bind(POOL, model, mean_vector())
+            except Exception as e:
+                logger.warning(f"文本嵌入缓存的数据库部分不可用，仅使用内存缓存: {e}")
+        phase("text_cache")
+
+    SLOW_LOG.bind({"primary": POOL, **READS.pools})
+
+    if plugin_config.db_prewarm_index:
+        for name, pool in {"primary": POOL, **READS.pools}.items():
+            task = asyncio.create_task(_prewarm_index(pool, name))
+            _PREWARM_TASKS.add(task)
+            task.add_done_callback(_PREWARM_TASKS.discard)
+
+    METRICS.startup["total"] = time.perf_counter() - started
+    logger.info(
+        "数据库初始化完成，用时 "
+        + ", ".join(f"{k} {v * 1000:.0f} ms" for k, v in METRICS.startup.items())
+    )
@@ -0,0 +1,349 @@
+"""
+按内容寻址的图片存储。
+
+文件名是内容的 SHA-256，按前缀分两级子目录存放（savepic/ab/cd/abcd…），
+避免单个目录下文件过多。写入先写临时文件再原子地 rename，可选 fsync；
+所有磁盘操作都在线程中执行，不阻塞事件循环。
+
+相同内容只存一份，一个文件可能被数据库中的行引用，也可能正被某次保存使用
+（文件已写入、行还没插入）。只有两者都没有时才真正删除：
+- 进程内通过 pin / release 计数；
+- 数据库中是否还有行的 url 指向该文件，删除前查询确认；
+- 其它进程（如命令行批量导入）可能复用了已有文件、行还没提交，
+  因此修改时间在 ORPHAN_GRACE 秒以内的文件也保留，复用时会刷新修改时间。
+
+每个存储根目录只有一个 PicStore（store_for），pin 计数才能在写入与释放之间对上。
+"""
+
+import os
+import time
+import shutil
+import asyncio
+import asyncpg
+import hashlib
+
+from typing import Optional
+from pathlib import Path
+from collections import Counter
+from nonebot import logger
+
+from ..config import plugin_config
+
+
+ORPHAN_GRACE = 3600.0
+"""修改时间在此秒数以内的无引用文件不删除"""
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PicStore:
+    """图片文件存储
+
+    Parameters
+    ----------
+    root: str
+        存储根目录
+    fsync: bool
+        写入后是否 fsync 文件与目录
+    """
+
+    def __init__(self, root: str, fsync: bool = False):
+        self.root = Path(root or "savepic")
+        self.fsync = fsync
+        self.pool: Optional[asyncpg.Pool] = None
+        self.pins: Counter[str] = Counter()
+        """path -> 正在使用该文件的保存操作数"""
+        self.reserved: set[str] = {".derived"}
+        """根目录下由其它模块管理的子目录，sweep 时跳过"""
+
+    def bind(self, pool: asyncpg.Pool):
+        """绑定连接池，删除文件前用它确认没有行引用，在 init_db 中调用"""
+        self.pool = pool
+
+    def path_for(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def owns(self, url: str) -> bool:
+        """url 是否是本存储中的文件"""
+        if url.startswith("http"):
+            return False
+        try:
+            Path(url).relative_to(self.root)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def _reuse(dest: Path) -> bool:
+        """目标已存在时刷新修改时间，让其它进程的清理把它当作刚写入的文件"""
+        try:
+            os.utime(dest)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _write(self, data: bytes, dest: Path):
+        if self._reuse(dest):
+            return
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+        if self.fsync:
+            self._fsync_dir(dest.parent)
+
+    @staticmethod
+    def _fsync_dir(path: Path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _put(self, data: bytes) -> tuple[str, str]:
+        digest = hashlib.sha256(data).hexdigest()
+        dest = self.path_for(digest)
+        self._write(data, dest)
+        return dest.as_posix(), digest
+
+    async def put(self, data: bytes) -> tuple[str, str]:
+        """保存图片内容，并 pin 住该文件
+
+        保存完成（行已写入数据库）或放弃时，调用方必须调用 release。
+
+        Returns
+        -------
+        tuple[str, str]
+            (文件路径, SHA-256)
+        """
+        path, digest = await asyncio.to_thread(self._put, data)
+        self.pins[path] += 1
+        return path, digest
+
+    async def adopt(self, src: Path, digest: str, move: bool = False) -> str:
+        """把已经算好哈希的文件放进存储，并 pin 住该文件
+
+        Parameters
+        ----------
+        src: Path
+            源文件，move 为 True 时必须与存储在同一文件系统
+        digest: str
+            源文件内容的 SHA-256
+        move: bool
+            直接 rename 源文件（下载的临时文件），否则复制
+
+        Returns
+        -------
+        str
+            文件路径，之后需调用 release
+        """
+        dest = self.path_for(digest)
+
+        def copy():
+            tmp = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+            try:
+                shutil.copyfile(src, tmp)
+                if self.fsync:
+                    with open(tmp, "rb+") as f:
+                        os.fsync(f.fileno())
+                os.replace(tmp, dest)
+            finally:
+                tmp.unlink(missing_ok=True)
+
+        def place():
+            if self._reuse(dest):
+                if move:
+                    src.unlink(missing_ok=True)
+                return
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            if not move:
+                copy()
+            else:
+                try:
+                    os.replace(src, dest)
+                except OSError:
+                    # 临时目录与存储不在同一文件系统
+                    copy()
+                    src.unlink(missing_ok=True)
+            if self.fsync:
+                self._fsync_dir(dest.parent)
+
+        await asyncio.to_thread(place)
+        path = dest.as_posix()
+        self.pins[path] += 1
+        return path
+
+    def copy_in(self, src: Path, digest: Optional[str] = None) -> str:
+        """把本地文件复制进存储（不 pin），返回路径；会阻塞，需在线程中调用"""
+        dest = self.path_for(digest or _sha256(src))
+        if not self._reuse(dest):
+            self._write(src.read_bytes(), dest)
+        return dest.as_posix()
+
+    async def read(self, url: str) -> bytes:
+        return await asyncio.to_thread(Path(url).read_bytes)
+
+    async def referenced(self, url: str) -> bool:
+        if self.pins[url] > 0:
+            return True
+        if self.pool is None:
+            # 无法确认时保守处理，不删除
+            return True
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM picdata WHERE url = $1);", url
+            )
+
+    async def release(self, url: str, pinned: bool = True):
+        """不再使用该文件；如果没有任何引用，且不是最近写入或复用的，则删除
+
+        Parameters
+        ----------
+        url: str
+            文件路径
+        pinned: bool
+            是否由 put 得到（需要解除 pin），数据库行被删除后调用时为 False
+        """
+        if pinned and self.pins[url] > 0:
+            self.pins[url] -= 1
+            if self.pins[url] == 0:
+                del self.pins[url]
+        if self.pins.get(url) or not self.owns(url) or await self.referenced(url):
+            return
+
+        def unlink():
+            path = Path(url)
+            try:
+                if path.stat().st_mtime > time.time() - ORPHAN_GRACE:
+                    # 留给 sweep 清理
+                    return
+            except FileNotFoundError:
+                return
+            path.unlink(missing_ok=True)
+
+        await asyncio.to_thread(unlink)
+
+    async def sweep(self, grace: float = ORPHAN_GRACE) -> int:
+        """删除没有行引用的孤儿文件
+
+        Parameters
+        ----------
+        grace: float
+            修改时间在此秒数以内的文件不删除，避免误删其它进程（如批量导入）
+            刚写入、还没来得及插入行的文件
+
+        Returns
+        -------
+        int
+            删除的文件数
+        """
+        assert self.pool is not None
+        used: set[str] = set()
+        async with self.pool.acquire() as conn, conn.transaction():
+            async for r in conn.cursor("SELECT url FROM picdata;"):
+                used.add(Path(r["url"]).as_posix())
+
+        def scan() -> int:
+            deadline = time.time() - grace
+            removed = 0
+            for p in self.root.rglob("*"):
+                if not p.is_file() or p.as_posix() in used:
+                    continue
+                if p.relative_to(self.root).parts[0] in self.reserved:
+                    continue
+                if p.as_posix() in self.pins or p.stat().st_mtime > deadline:
+                    continue
+                p.unlink(missing_ok=True)
+                removed += 1
+            return removed
+
+        return await asyncio.to_thread(scan)
+
+    async def migrate_flat(self) -> int:
+        """把旧版平铺在根目录下的文件移动到分级目录，并更新数据库中的 url
+
+        Returns
+        -------
+        int
+            移动的文件数
+        """
+        assert self.pool is not None
+        moved = 0
+        flat = [
+            p
+            for p in await asyncio.to_thread(lambda: list(self.root.iterdir()))
+            if p.is_file() and len(p.name) == 64
+        ]
+        for p in flat:
+            old = p.as_posix()
+            new = self.path_for(p.name)
+            # 先放一份到新位置，数据库更新成功后再删除旧文件
+            await asyncio.to_thread(_link, p, new)
+            async with self.pool.acquire() as conn:
+                status = await conn.execute(
+                    "UPDATE picdata SET url = $2 WHERE url = $1 AND NOT EXISTS "
+                    "(SELECT 1 FROM picdata WHERE url = $2);",
+                    old,
+                    new.as_posix(),
+                )
+                still_used = await conn.fetchval(
+                    "SELECT EXISTS (SELECT 1 FROM picdata WHERE url = $1);", old
+                )
+            if not still_used:
+                await asyncio.to_thread(p.unlink, True)
+            if status != "UPDATE 0":
+                moved += 1
+        logger.info(f"已将 {moved} 张图片移动到分级目录")
+        return moved
+
+
+def _link(src: Path, dest: Path):
+    if dest.exists():
+        return
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+STORE = PicStore(plugin_config.savepic_dir, plugin_config.savepic_fsync)
+_STORES: dict[Path, PicStore] = {STORE.root.resolve(): STORE}
+
+
+def store_for(root: Optional[str] = None) -> PicStore:
+    """根目录对应的存储，同一目录总是返回同一个实例；root 为空时为 STORE"""
+    if not root:
+        return STORE
+    key = Path(root).resolve()
+    if key not in _STORES:
+        store = PicStore(root, STORE.fsync)
+        store.pool = STORE.pool
+        _STORES[key] = store
+    return _STORES[key]
+
+
+def store_of(url: str) -> PicStore:
+    """文件所在的存储，不属于任何存储时为 STORE"""
+    for store in _STORES.values():
+        if store is not STORE and store.owns(url):
+            return store
+    return STORE
+
+
+def bind_stores(pool: asyncpg.Pool):
+    """为所有存储绑定连接池，在 init_db 中调用"""
+    for store in _STORES.values():
+        store.bind(pool)
@@ -1,65 +1,117 @@
-import httpx
+import base64
+import asyncio
+import functools
 import numpy as np
 
-from io import BytesIO
+from typing import Optional
 from pathlib import Path
 from nonebot.log import logger
 
+from .cache import TEXT_CACHE
+from .metrics import METRICS
+from .embedding import DISPATCHER
+from .imageinfo import sniff_mime
 from ..config import plugin_config
 
 
-MEAN_VECTOR = None
+def _parse_mean_vector(path: Path) -> np.ndarray:
+    # 文本格式的均值向量，是 list[float]
+    text = path.read_text().strip()
+    if text.startswith("[") and text.endswith("]"):
+        text = text[1:-1]
+    return np.array([float(x) for x in text.split(",")])
 
-if plugin_config.normalize_vector and Path(plugin_config.normalize_vector).exists():
-    with open(plugin_config.normalize_vector, "r") as f:
-        # 读取均值向量，是list[float]
-        _ = f.read().strip()
-        if _.startswith("[") and _.endswith("]"):
-            _ = _[1:-1]
-        MEAN_VECTOR = np.array([float(x) for x in _.split(",")])
-        logger.info(f"Loaded mean vector from {plugin_config.normalize_vector}")
 
+@functools.cache
+def mean_vector() -> Optional[np.ndarray]:
+    """均值向量，首次调用时加载，init_db 会在后台线程中提前加载
 
+    normalize_vector 是 .npy 时以内存映射方式打开；是文本文件时解析一次，
+    并在旁边写一份 .npy，之后启动直接映射，不再逐个解析浮点数。
+    """
+    if not plugin_config.normalize_vector:
+        return None
+    path = Path(plugin_config.normalize_vector)
+    if not path.exists():
+        logger.warning(f"均值向量文件不存在: {path}")
+        return None
+    if path.suffix == ".npy":
+        ret = np.load(path, mmap_mode="r")
+    else:
+        binary = path.with_name(path.name + ".npy")
+        if binary.exists() and binary.stat().st_mtime >= path.stat().st_mtime:
+            ret = np.load(binary, mmap_mode="r")
+        else:
+            ret = _parse_mean_vector(path)
+            try:
+                np.save(binary, ret)
+            except OSError as e:
+                logger.debug(f"无法写入 {binary}，下次启动仍需解析文本: {e}")
+    logger.info(f"Loaded mean vector from {path}")
+    return ret
+
+
+@METRICS.timed("word2vec")
 async def word2vec(word: str) -> np.ndarray | None:
     if not word:
         return None
-    async with httpx.AsyncClient() as client:
+    if plugin_config.text_cache:
         try:
-            rsp = await client.post(
-                plugin_config.embedding_url,
-                json={
-                    "model": plugin_config.embedding_model,
-                    "input": [
-                        {
-                            "type": "text",
-                            "text": word,
-                        }
-                    ],
-                },
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {plugin_config.embedding_key}",
-                },
-            )
-            rsp.raise_for_status()
-            data = rsp.json()
+            if (ret := await TEXT_CACHE.get(word)) is not None:
+                METRICS.count("text_cache_hit")
+                return ret
+            METRICS.count("text_cache_miss")
         except Exception as e:
-            logger.warning(f"Network seems down, cannot access internet: {e}")
-            return None
+            logger.warning(f"读取文本嵌入缓存失败: {e}")
+    data = await DISPATCHER.embed(
+        [
+            {
+                "type": "text",
+                "text": word,
+            }
+        ]
+    )
+    if data is None:
+        return None
     try:
-        ret = np.array(data["data"]["embedding"])
+        ret = np.array(data)
     except Exception as e:
         logger.error(f"Error while embedding word: {word}, {e}")
         return None
-    if MEAN_VECTOR is not None and len(MEAN_VECTOR) == len(ret):
-        ret = ret - MEAN_VECTOR
+    mean = mean_vector()
+    if mean is not None and len(mean) == len(ret):
+        ret = ret - mean
         # 归一化
         ret = ret / np.linalg.norm(ret)
+    if plugin_config.text_cache:
+        TEXT_CACHE.put(word, ret)
     return ret
 
 
-async def img2vec(img: str, title: str = "") -> np.ndarray | None:
-    # img 转为 base64 url，获取mime类型
+async def to_data_url(img: bytes | str | Path) -> str:
+    """把图片内容或本地文件转为 base64 data URI，http(s) 地址原样返回"""
+    if isinstance(img, str):
+        if img.startswith("http"):
+            return img
+        img = Path(img)
+    if isinstance(img, Path):
+        img = await asyncio.to_thread(img.read_bytes)
+    mime = sniff_mime(img[:16]) or "application/octet-stream"
+    return f"data:{mime};base64,{base64.b64encode(img).decode()}"
+
+
+@METRICS.timed("img2vec")
+async def img2vec(img: bytes | str | Path, title: str = "") -> np.ndarray | None:
+    """计算图片的向量
+
+    Parameters
+    ----------
+    img: bytes | str | Path
+        图片内容、本地路径或 http(s) 地址。
+        内容与本地文件以 data URI 内联发送，嵌入接口不必再下载一次
+    title: str
+        图片标题，与图片融合为一个向量
+    """
     input = []
     if title:
         input.append(
@@ -68,69 +120,25 @@ async def img2vec(img: str, title: str = "") -> np.ndarray | None:
                 "text": f"Title of the image: {title}",
             }
         )
-    if img.startswith("http"):
-        input.append(
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": img,
-                },
-            }
-        )
-    else:
-        raise ValueError("img must be a valid URL string")
-    async with httpx.AsyncClient() as client:
-        try:
-            rsp = await client.post(
-                plugin_config.embedding_url,
-                json={
-                    "model": plugin_config.embedding_model,
-                    "input": input,
-                },
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {plugin_config.embedding_key}",
-                },
-            )
-            rsp.raise_for_status()
-            data = rsp.json()
-        except Exception as e:
-            logger.warning(f"Network seems down, cannot access internet: {e}")
-            return None
+    input.append(
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": await to_data_url(img),
+            },
+        }
+    )
+    data = await DISPATCHER.embed(input)
+    if data is None:
+        return None
     try:
-        ret = np.array(data["data"]["embedding"])
+        ret = np.array(data)
     except Exception as e:
         logger.error(f"Error while embedding image: {title}, {e}")
         return None
-    if MEAN_VECTOR is not None and len(MEAN_VECTOR) == len(ret):
-        ret = ret - MEAN_VECTOR
+    mean = mean_vector()
+    if mean is not None and len(mean) == len(ret):
+        ret = ret - mean
         # 归一化
         ret = ret / np.linalg.norm(ret)
     return ret
-
-
-async def upload_image(
-    img: bytes | Path | str, filename: str = "image.png"
-) -> str | None:
-    """上传图片到图床，返回图片URL"""
-    if isinstance(img, Path):
-        if not img.exists():
-            return None
-        img = img.read_bytes()
-    elif isinstance(img, str):
-        if img.startswith("http"):
-            return img
-        p = Path(img)
-        if not p.exists():
-            return None
-        img = p.read_bytes()
-    files = {"file": (filename, BytesIO(img), "application/octet-stream")}
-    async with httpx.AsyncClient() as client:
-        try:
-            rsp = await client.post("https://tmpfiles.org/api/v1/upload", files=files)
-            rsp.raise_for_status()
-            data = rsp.json()
-            return data["data"]["url"].replace("tmpfiles.org/", "tmpfiles.org/dl/")
-        except Exception as e:
-            logger.warning(f"Network seems down, cannot access internet: {e}")
-            return None
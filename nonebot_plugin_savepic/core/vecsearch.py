@@ -0,0 +1,256 @@
+"""
+按作用域过滤的向量检索。
+
+picdata_vec_hnsw_ip 是整张表的 HNSW 索引，scope 过滤发生在索引扫描之后：
+ef_search 个候选里属于本域的可能不足 LIMIT 条，小群甚至一条都找不到。
+因此按候选集的大小选择检索方式：
+
+- exact：本域与全局加起来不超过 vec_exact_threshold 张时，先用 scope 的 GIN 索引取出候选，
+  再逐个计算距离，召回率 100%；
+- partial：作用域有专属的部分 HNSW 索引（命令行 vec-index 为最大的几个作用域建立）时，
+  把作用域写成字面量，规划器才能用上部分索引；
+- hnsw：其余情况走整表的索引。pgvector 0.8 起可以开启迭代扫描（hnsw.iterative_scan），
+  过滤后不足 LIMIT 条时继续扫描，直到扫过 hnsw.max_scan_tuples 个元组。
+
+hnsw.ef_search / iterative_scan / max_scan_tuples 作为连接参数设置，
+连接池归还连接时的 RESET ALL 会恢复到这些值，不需要每次查询前 SET。
+"""
+
+import re
+import asyncpg
+import hashlib
+import numpy as np
+
+from typing import Literal, Optional
+from nonebot import logger
+
+from .cache import SCOPE_COUNTER
+from .listen import PicSubscriber
+from ..config import plugin_config
+
+
+Plan = Literal["exact", "partial", "hnsw"]
+
+SCOPE_INDEX_PREFIX = "picdata_vec_hnsw_s_"
+"""部分索引的名字前缀，索引的注释是它对应的作用域"""
+
+
+def server_settings() -> dict[str, str]:
+    """连接参数，传给 asyncpg.create_pool 的 server_settings"""
+    settings = {"hnsw.ef_search": str(plugin_config.vec_ef_search)}
+    if plugin_config.vec_iterative_scan != "off":
+        settings["hnsw.iterative_scan"] = plugin_config.vec_iterative_scan
+        settings["hnsw.max_scan_tuples"] = str(plugin_config.vec_max_scan_tuples)
+    return settings
+
+
+def _literal(text: str) -> str:
+    return "'" + text.replace("'", "''") + "'"
+
+
+def scope_index_name(scope: str) -> str:
+    return SCOPE_INDEX_PREFIX + hashlib.sha1(scope.encode()).hexdigest()[:16]
+
+
+class VecSearch(PicSubscriber):
+    """选择检索方式并生成 SQL，同时记录已有的部分索引
+
+    订阅变更通知只是为了在 RELOAD 时重新读取部分索引，单行变更与它无关。
+    """
+
+    def __init__(self):
+        self.version: tuple[int, ...] = ()
+        """pgvector 版本"""
+        self.indexes: dict[str, str] = {}
+        """作用域 -> 可用的部分索引名"""
+
+    async def bind(self, conn: asyncpg.Connection):
+        """读取 pgvector 版本与部分索引，在 init_db 中调用"""
+        version = await conn.fetchval(
+            "SELECT extversion FROM pg_extension WHERE extname = 'vector';"
+        )
+        self.version = tuple(int(x) for x in re.findall(r"\d+", version or ""))
+        if plugin_config.vec_iterative_scan != "off" and self.version < (0, 8):
+            logger.warning(
+                f"pgvector {version} 不支持迭代扫描，小作用域的向量检索可能结果不足，"
+                "请升级到 0.8 以上或调大 vec_exact_threshold"
+            )
+        await self.reload(conn)
+
+    async def reload(self, conn: asyncpg.Connection):
+        rows = await conn.fetch(
+            "SELECT c.relname, obj_description(c.oid, 'pg_class') AS scope "
+            "FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname LIKE $1 AND i.indisvalid;",
+            SCOPE_INDEX_PREFIX + "%",
+        )
+        self.indexes = {r["scope"]: r["relname"] for r in rows if r["scope"]}
+        self.ready = True
+
+    def apply(self, op: str, old: Optional[dict], new: Optional[dict]):
+        pass
+
+    def plan(self, scope: str) -> Plan:
+        """选择检索方式"""
+        if (
+            SCOPE_COUNTER.ready
+            and SCOPE_COUNTER.count(scope) <= plugin_config.vec_exact_threshold
+        ):
+            return "exact"
+        if scope in self.indexes:
+            return "partial"
+        return "hnsw"
+
+    def sql(
+        self,
+        scope: str,
+        limit: int,
+        columns: str = "name, url",
+        farthest: bool = False,
+        plan: Optional[Plan] = None,
+    ) -> tuple[str, bool]:
+        """生成检索语句
+
+        参数：$1 向量，$2 作用域（partial 时没有）。
+        结果含 columns 与 similarity，按相似度从高到低（farthest 时从低到高）排序。
+
+        Parameters
+        ----------
+        scope: str
+            作用域
+        limit: int
+            返回条数
+        columns: str
+            需要返回的列
+        farthest: bool
+            检索最不相似的图片，索引帮不上忙，总是精确检索
+        plan: Optional[Plan]
+            强制使用某种检索方式，默认由 plan() 选择
+
+        Returns
+        -------
+        tuple[str, bool]
+            (SQL, 是否需要传入作用域参数)
+        """
+        plan = "exact" if farthest else plan or self.plan(scope)
+        if plan == "partial" and scope not in self.indexes:
+            plan = "hnsw"
+        if plan == "partial":
+            where = f"scope && ARRAY[{_literal(scope)}, 'globe']::text[]"
+        else:
+            where = "scope && ARRAY[$2, 'globe']::text[]"
+
+        if plan == "exact":
+            order = "DESC" if farthest else "ASC"
+            # MATERIALIZED 阻止规划器把 ORDER BY 推给 HNSW 索引
+            return (
+                f"WITH c AS MATERIALIZED (SELECT {columns}, vec FROM picdata "
+                f"WHERE vec IS NOT NULL AND {where}) "
+                f"SELECT {columns}, -(vec <#> $1::halfvec) AS similarity FROM c "
+                f"ORDER BY vec <#> $1::halfvec {order} LIMIT {int(limit)};",
+                True,
+            )
+        # 只有按距离升序排序才能用上索引；relaxed_order 的结果可能略微乱序，外层再排一次
+        return (
+            f"SELECT * FROM (SELECT {columns}, -(vec <#> $1::halfvec) AS similarity "
+            f"FROM picdata WHERE vec IS NOT NULL AND {where} "
+            f"ORDER BY vec <#> $1::halfvec LIMIT {int(limit)}) t "
+            "ORDER BY similarity DESC;",
+            plan != "partial",
+        )
+
+    async def nearest(
+        self,
+        conn: asyncpg.Connection,
+        vec: np.ndarray,
+        scope: str,
+        limit: int = 1,
+        columns: str = "name, url",
+        farthest: bool = False,
+    ) -> list[asyncpg.Record]:
+        """检索本域与全局中最相似（或最不相似）的图片
+
+        Parameters
+        ----------
+        conn: asyncpg.Connection
+            数据库连接
+        vec: np.ndarray
+            查询向量
+        scope: str
+            作用域
+        limit: int
+            返回条数
+        columns: str
+            需要返回的列，结果另有 similarity 列
+        farthest: bool
+            检索最不相似的图片
+        """
+        query, with_scope = self.sql(scope, limit, columns, farthest)
+        if with_scope:
+            return await conn.fetch(query, vec, scope)
+        return await conn.fetch(query, vec)
+
+    async def build_indexes(
+        self, pool: asyncpg.Pool, count: int, min_rows: int
+    ) -> list[str]:
+        """为图片最多的几个作用域建立部分 HNSW 索引，删除不再需要的
+
+        使用 CREATE INDEX CONCURRENTLY，建立期间不阻塞读写。
+
+        Parameters
+        ----------
+        pool: asyncpg.Pool
+            主库连接池
+        count: int
+            最多为几个作用域建立索引，0 表示删除全部
+        min_rows: int
+            作用域（不含全局）至少有多少张带向量的图片才建立
+
+        Returns
+        -------
+        list[str]
+            有部分索引的作用域
+        """
+        async with pool.acquire() as conn:
+            wanted = [
+                r["s"]
+                for r in await conn.fetch(
+                    "SELECT s FROM picdata, unnest(scope) AS s "
+                    "WHERE s <> 'globe' AND vec IS NOT NULL "
+                    "GROUP BY s HAVING COUNT(*) >= $2 ORDER BY COUNT(*) DESC LIMIT $1;",
+                    count,
+                    min_rows,
+                )
+            ]
+            existing = {
+                r["relname"]: (r["scope"], r["indisvalid"])
+                for r in await conn.fetch(
+                    "SELECT c.relname, i.indisvalid, "
+                    "obj_description(c.oid, 'pg_class') AS scope "
+                    "FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                    "WHERE c.relname LIKE $1;",
+                    SCOPE_INDEX_PREFIX + "%",
+                )
+            }
+            for name, (scope, valid) in existing.items():
+                # 建立中断留下的无效索引也要删掉重建
+                if scope not in wanted or not valid:
+                    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+                    logger.info(f"已删除作用域 {scope} 的部分索引 {name}")
+            for scope in wanted:
+                name = scope_index_name(scope)
+                if name in existing and existing[name][1]:
+                    continue
+                logger.info(f"正在为作用域 {scope} 建立部分索引 {name}")
+                await conn.execute(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON picdata "
+                    "USING hnsw (vec halfvec_ip_ops) WITH (m = 16, ef_construction = 64) "
+                    f"WHERE scope && ARRAY[{_literal(scope)}, 'globe']::text[];"
+                )
+                await conn.execute(f"COMMENT ON INDEX {name} IS {_literal(scope)};")
+            await conn.execute("ANALYZE picdata;")
+            await self.reload(conn)
+        return wanted
+
+
+VEC_SEARCH = VecSearch()
@@ -1,5 +1,6 @@
-from nonebot import on_command
+from nonebot import on_command, logger
 from datetime import datetime, timedelta
+from contextlib import aclosing
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 from arclet.alconna import Alconna, Args, Option, CommandMeta, Arparma
 from nonebot.params import CommandArg
@@ -11,9 +12,10 @@ from nonebot.adapters.onebot.v11.message import Message as V11Msg
 from nonebot.adapters.onebot.v11.message import MessageSegment as V11Seg
 
 from .rule import PIC_ADMIN
-from .mvpic import logger
 from .config import plugin_config
-from .core.sql import listpic, delete, check_uploader
+from .core.sql import delete, check_uploader
+from .core.sql import listpic_stream, encode_page_token, decode_page_token
+from .core.metrics import METRICS
 
 rmpic = on_alconna(
     Alconna(
@@ -44,6 +46,7 @@ async def rkey(bot: Bot, url: str) -> str:
     ):
         return url
     if RKEY.get("group", (datetime.min, ""))[0] < datetime.now():
+        METRICS.count("rkey_refresh")
         ret = await bot.call_api("get_rkey")
         if isinstance(ret, dict):
             ret = ret.get("rkeys", [])
@@ -67,12 +70,17 @@ async def rkey(bot: Bot, url: str) -> str:
 @s_listpic.handle()
 async def _(bot: Bot, event, args: V11Msg = CommandArg()):
     reg = args.extract_plain_text().strip().rsplit("\\page", maxsplit=1)
+    token = ""
     try:
         if len(reg) > 1:
-            reg, pages = reg
+            reg, pages = reg[0].strip(), reg[1].strip()
         else:
-            reg, pages = reg[0], 1
-        pages = int(pages)
+            reg, pages = reg[0], "1"
+        if pages.isdigit():
+            pages = int(pages)
+        else:
+            # 翻页令牌
+            token, pages = pages, decode_page_token(pages)[2]
     except Exception as ex:
         await s_listpic.finish(f"出错了。{ex}")
 
@@ -80,30 +88,50 @@ async def _(bot: Bot, event, args: V11Msg = CommandArg()):
     if isinstance(event, V11GME):
         group_id = f"qq_group:{event.group_id}"
 
+    cpp = max(plugin_config.count_per_page_in_list, 1)
+    max_page = (
+        min(max(plugin_config.max_page_in_listpic, 1), max(1000 // cpp, 1))
+        if plugin_config.forward_when_listpic
+        else 1
+    )
+
     try:
-        pics = await listpic(reg, group_id, pages=pages)
-        if not pics:
+        # 边读边分页，超出的那一张用来判断是否还有下一页
+        books: list[list[str]] = []
+        position = None
+        next_token = ""
+        async with aclosing(listpic_stream(reg, group_id, token, pages)) as rows:
+            async for name, is_global, key in rows:
+                if not books or len(books[-1]) >= cpp:
+                    if len(books) >= max_page:
+                        if position:
+                            next_token = encode_page_token(
+                                *position, pages + len(books)
+                            )
+                        break
+                    books.append([])
+                books[-1].append(name + ("" if is_global else " ⭐"))
+                position = key
+        if not books:
             return
-        pics = [pic[0] + ("" if pic[1] else " ⭐") for pic in pics]
+        if next_token:
+            books[-1].append(f"\n下一页：listpic {reg}\\page {next_token}")
 
-        cpp = max(plugin_config.count_per_page_in_list, 1)
         if plugin_config.forward_when_listpic:
             message = []
-            for i in range(len(pics) // cpp + 1):
-                if pics[i * cpp : (i + 1) * cpp]:
-                    message.append(
-                        {
-                            "type": "node",
-                            "data": {
-                                "uin": str(event.get_user_id()),
-                                "name": f"Page {pages+i}",
-                                "content": V11Seg.text(
-                                    "\n".join(pics[i * cpp : (i + 1) * cpp])
-                                    + f"\n\nPage {pages+i}"
-                                ),
-                            },
+            for i, book in enumerate(books):
+                message.append(
+                    {
+                        "type": "node",
+                        "data": {
+                            "uin": str(event.get_user_id()),
+                            "name": f"Page {pages+i}",
+                            "content": V11Seg.text(
+                                "\n".join(book) + f"\n\nPage {pages+i}"
+                            ),
                         },
-                    )
+                    },
+                )
 
             if isinstance(event, V11GME):
                 await bot.call_api(
@@ -119,7 +147,7 @@ async def _(bot: Bot, event, args: V11Msg = CommandArg()):
                 )
             return
 
-        await s_listpic.send("\n".join(pics[:cpp]))
+        await s_listpic.send("\n".join(books[0]))
     except Exception as ex:
         await s_listpic.finish(f"出错了。{ex}")
 
@@ -1,7 +1,6 @@
 import shlex
 
-from pathlib import Path
-from nonebot import on_command, logger
+from nonebot import on_command
 from nonebot.params import CommandArg
 from nonebot.permission import SUPERUSER
 from nonebot.adapters.onebot.v11 import Bot
@@ -9,10 +8,12 @@ from nonebot.adapters.onebot.v11.event import GroupMessageEvent as V11GME
 from nonebot.adapters.onebot.v11.permission import GROUP_ADMIN
 
 from .rule import PIC_ADMIN
+from .config import plugin_config
 from .core.sql import rename, select_pic, check_uploader
-from .core.utils import img2vec, upload_image
+from .core.utils import img2vec
 from .core.error import NoPictureException
 from .core.error import SameNameException
+from .core.backfill import VecBackfill, BackfillRunning
 
 # INVALID_FILENAME_CHARACTERS = r''
 s_mvpic = on_command("mvpic", priority=5)
@@ -95,9 +96,6 @@ async def _(bot: Bot, event: V11GME, args=CommandArg()):
         url = await select_pic(sname, sg, True)
         if not url:
             await s_mvpic.finish(f"{sname} 没有找到哦")
-        url = await upload_image(url if url.startswith("http") else Path(url))
-        if not url:
-            await s_mvpic.finish("图片上传失败，无法获取特征向量")
         v = await img2vec(url, dname)
 
     try:
@@ -112,48 +110,20 @@ async def _(bot: Bot, event: V11GME, args=CommandArg()):
 
 
 @update_vec.handle()
-async def _(bot: Bot):
+async def _(bot: Bot, args=CommandArg()):
     from .core import sql
 
     if not sql.POOL:
         await update_vec.finish("数据库未初始化")
+    restart = args.extract_plain_text().strip() in ("restart", "--restart")
+    backfill = VecBackfill(
+        plugin_config.backfill_workers, plugin_config.backfill_batch_size
+    )
     await update_vec.send("开始更新图片特征向量...")
-    async with sql.POOL.acquire() as conn:
-        count = await conn.fetchval("SELECT COUNT(*) FROM picdata WHERE vec IS NULL;")
-        if count == 0:
-            await update_vec.finish("没有需要更新的图片特征向量")
-        finish = 0
-        await update_vec.send(f"共有 {count} 张图片需要更新")
-        async with conn.transaction():
-            async for record in conn.cursor(
-                "SELECT name, url FROM picdata WHERE vec IS NULL;"
-            ):
-                finish += 1
-                # 每10%更新一次进度
-                if finish % max(1, count // 10) == 0:
-                    await update_vec.send(
-                        f"已完成 {finish}/{count} 张图片的特征向量更新"
-                    )
-                try:
-                    url = await upload_image(
-                        record["url"]
-                        if record["url"].startswith("http")
-                        else Path(record["url"])
-                    )
-                    if not url:
-                        logger.warning(f"图片 {record['name']} 上传失败，跳过")
-                        continue
-                    vec = await img2vec(url, record["name"])
-                    if vec is None:
-                        logger.warning(f"图片 {record['name']} 特征提取失败，跳过")
-                        continue
-                    await conn.execute(
-                        "UPDATE picdata SET vec = $1 WHERE url = $2;",
-                        str(vec.tolist()),
-                        record["url"],
-                    )
-                except Exception as ex:
-                    logger.error(
-                        f"图片 {record['name']} 特征提取失败，跳过，错误信息：{ex}"
-                    )
-    await update_vec.finish("图片特征向量更新完成")
+    try:
+        done, failed = await backfill.run(restart, on_progress=update_vec.send)
+    except BackfillRunning:
+        await update_vec.finish("已有特征向量更新任务在运行")
+    if done + failed == 0:
+        await update_vec.finish("没有需要更新的图片特征向量")
+    await update_vec.finish(f"图片特征向量更新完成，成功 {done} 张，失败 {failed} 张")
@@ -0,0 +1,185 @@
+"""
+savepic 维护工具，不需要运行 bot。
+
+在 bot 项目目录（.env 所在目录）下运行，配置与 bot 相同：
+
+    python scripts/savepic_cli.py import <目录|压缩包.zip|清单.csv> [-s 作用域]
+    python scripts/savepic_cli.py export <归档目录> [-s 作用域]
+    python scripts/savepic_cli.py restore <归档目录>
+    python scripts/savepic_cli.py backfill [--restart]
+    python scripts/savepic_cli.py analyze
+    python scripts/savepic_cli.py migrate-storage
+    python scripts/savepic_cli.py vec-index [-n 数量] [--min-rows 行数]
+"""
+
+import csv
+import asyncio
+import argparse
+
+from pathlib import Path
+
+import nonebot
+
+
+async def run_import(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.bulk import BulkImporter, iter_source
+    from nonebot_plugin_savepic.core.client import CLIENT
+
+    await sql.init_db(listen=False)
+    try:
+        importer = BulkImporter(
+            uploader=args.uploader,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            allow_similar=args.allow_similar,
+        )
+        await importer.run(iter_source(Path(args.source), args.scope))
+        if args.report:
+            with open(args.report, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(["source", "status", "detail"])
+                writer.writerows(importer.report)
+    finally:
+        await sql.close_db()
+        await CLIENT.close()
+
+
+async def run_export(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.archive import export_library
+
+    await sql.init_db(listen=False)
+    try:
+        await export_library(Path(args.dest), args.scope, args.batch_size)
+    finally:
+        await sql.close_db()
+
+
+async def run_restore(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.archive import restore_library
+
+    await sql.init_db(listen=False)
+    try:
+        await restore_library(
+            Path(args.source),
+            batch_size=args.batch_size,
+            maintenance_work_mem=args.maintenance_work_mem,
+            build_workers=args.build_workers,
+        )
+    finally:
+        await sql.close_db()
+
+
+async def run_backfill(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.backfill import VecBackfill
+    from nonebot_plugin_savepic.core.client import CLIENT
+
+    await sql.init_db(listen=False)
+    try:
+        await VecBackfill(args.workers, args.batch_size).run(
+            args.restart, report_every=args.report_every
+        )
+    finally:
+        await sql.close_db()
+        await CLIENT.close()
+
+
+async def run_analyze(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.backfill import backfill_info
+    from nonebot_plugin_savepic.core.client import CLIENT
+
+    await sql.init_db(listen=False)
+    try:
+        await backfill_info(args.workers, args.batch_size)
+    finally:
+        await sql.close_db()
+        await CLIENT.close()
+
+
+async def run_migrate_storage(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.storage import STORE
+
+    await sql.init_db(listen=False)
+    try:
+        await STORE.migrate_flat()
+    finally:
+        await sql.close_db()
+
+
+async def run_vec_index(args: argparse.Namespace):
+    from nonebot_plugin_savepic.core import sql
+    from nonebot_plugin_savepic.core.listen import RELOAD_SQL
+    from nonebot_plugin_savepic.core.vecsearch import VEC_SEARCH
+
+    await sql.init_db(listen=False)
+    try:
+        assert sql.POOL
+        scopes = await VEC_SEARCH.build_indexes(sql.POOL, args.count, args.min_rows)
+        print(f"有部分索引的作用域：{', '.join(scopes) or '无'}")
+        # 通知正在运行的 bot 重新读取部分索引
+        async with sql.POOL.acquire() as conn:
+            await conn.execute(RELOAD_SQL)
+    finally:
+        await sql.close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="savepic 维护工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("import", help="批量导入图片")
+    p.add_argument("source", help="目录、.zip 压缩包或 .csv 清单（列：path,name,scope）")
+    p.add_argument("-s", "--scope", default="globe", help="默认作用域，如 qq_group:123")
+    p.add_argument("-u", "--uploader", default="import", help="记录的上传者")
+    p.add_argument("-w", "--workers", type=int, default=8, help="并发数")
+    p.add_argument("-b", "--batch-size", type=int, default=200, help="每批写入行数")
+    p.add_argument("--allow-similar", action="store_true", help="放行相似图片")
+    p.add_argument("--report", help="将跳过与失败的条目写入该 CSV 文件")
+    p.set_defaults(func=run_import)
+
+    p = sub.add_parser("export", help="导出整个图库")
+    p.add_argument("dest", help="归档目录（不存在或为空）")
+    p.add_argument("-s", "--scope", help="只导出该作用域可见的图片")
+    p.add_argument("-b", "--batch-size", type=int, default=500, help="每批读取行数")
+    p.set_defaults(func=run_export)
+
+    p = sub.add_parser("restore", help="从归档恢复图库")
+    p.add_argument("source", help="export 导出的归档目录")
+    p.add_argument("-b", "--batch-size", type=int, default=1000, help="每批写入行数")
+    p.add_argument("--maintenance-work-mem", help="重建索引时的内存，如 2GB")
+    p.add_argument("--build-workers", type=int, help="重建索引的并行数")
+    p.set_defaults(func=run_restore)
+
+    p = sub.add_parser("backfill", help="补全缺失的图片向量")
+    p.add_argument("-w", "--workers", type=int, default=4, help="并发数")
+    p.add_argument("-b", "--batch-size", type=int, default=50, help="每批写回行数")
+    p.add_argument("--restart", action="store_true", help="忽略检查点，从头开始")
+    p.add_argument("--report-every", type=float, default=10.0, help="进度输出间隔（秒）")
+    p.set_defaults(func=run_backfill)
+
+    p = sub.add_parser("analyze", help="补全旧图片的尺寸、格式与感知哈希")
+    p.add_argument("-w", "--workers", type=int, default=4, help="并发数")
+    p.add_argument("-b", "--batch-size", type=int, default=200, help="每批写回行数")
+    p.set_defaults(func=run_analyze)
+
+    p = sub.add_parser("migrate-storage", help="把旧版平铺的图片移动到分级目录")
+    p.set_defaults(func=run_migrate_storage)
+
+    p = sub.add_parser("vec-index", help="为图片最多的作用域建立部分向量索引")
+    p.add_argument("-n", "--count", type=int, default=4, help="作用域数，0 删除全部")
+    p.add_argument("--min-rows", type=int, default=20000, help="作用域的最少图片数")
+    p.set_defaults(func=run_vec_index)
+
+    args = parser.parse_args()
+    nonebot.init(driver="~none")
+    nonebot.load_plugin("nonebot_plugin_savepic")
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()